@@ -0,0 +1,187 @@
+"""
+access log written by a background thread
+
+requests only put a record on a bounded queue, the writer thread appends them to the csv file in batches
+and rotates the file by size or date, records are dropped and counted when the queue is full
+"""
+
+import csv
+import datetime
+import os
+import queue
+import threading
+import time
+
+from ollama_proxy_server.ollama_logger import get_logger
+
+FIELDNAMES = [
+    "time_stamp",
+    "request_id",
+    "event",
+    "user_name",
+    "ip_address",
+    "access",
+    "server",
+    "nb_queued_requests_on_server",
+    "error",
+]
+
+_STOP = object()
+
+
+class AccessLog:  # pylint: disable=too-many-instance-attributes
+    """
+    batched csv access log
+
+        path:           the csv file
+        max_queue:      records kept in memory before new ones are dropped
+        batch_size:     records written with one write
+        flush_interval: max seconds a record waits in memory
+        max_bytes:      rotate when the file grows past this size, 0 never
+        daily:          rotate when the date changes
+        backup_count:   rotated files kept when rotating by size
+    """
+
+    def __init__(
+        self,
+        path,
+        max_queue=10000,
+        batch_size=256,
+        flush_interval=1.0,
+        max_bytes=0,
+        daily=False,
+        backup_count=5,
+    ):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self.path = str(path)
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._max_bytes = max_bytes
+        self._daily = daily
+        self._backup_count = backup_count
+        self._file = None
+        self._writer = None
+        self._date = None
+        self._written = 0
+        self._dropped = 0
+        self._dropped_lock = threading.Lock()
+        self._reported_dropped = 0
+        self._thread = None
+        self._log = get_logger(__name__, "INFO")
+
+    def log(self, rid, event, user_name, ip_address, access, server, nb_queued_requests_on_server, error=""):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        """queues a record, never blocks"""
+        row = (str(datetime.datetime.now()), rid, event, user_name, ip_address, access, server, nb_queued_requests_on_server, error)
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            with self._dropped_lock:
+                self._dropped += 1
+
+    def __call__(self, **fields):
+        self.log(**fields)
+
+    def stats(self):
+        """counters of the log"""
+        return {"queued": self._queue.qsize(), "written": self._written, "dropped": self._dropped}
+
+    def start(self):
+        """starts the writer thread"""
+        self._thread = threading.Thread(target=self._run, name="access-log-writer", daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self):
+        """writes what is queued and stops the writer"""
+        if self._thread is not None:
+            # the writer is stopped by a marker, wait for room if the queue is full
+            self._queue.put(_STOP)
+            self._thread.join()
+            self._thread = None
+        else:
+            self._drain()
+        self._close_file()
+
+    def _drain(self):
+        """writes everything queued, used without a writer thread"""
+        batch = []
+        while True:
+            try:
+                row = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if row is not _STOP:
+                batch.append(row)
+        self._write(batch)
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                row = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                row = None
+            if row is _STOP:
+                self._write(batch)
+                return
+            if row is not None:
+                batch.append(row)
+                if deadline is None:
+                    deadline = time.monotonic() + self._flush_interval
+            if batch and (len(batch) >= self._batch_size or time.monotonic() >= deadline):
+                try:
+                    self._write(batch)
+                except OSError:
+                    self._log.exception("could not write the access log %s", self.path)
+                    with self._dropped_lock:
+                        self._dropped += len(batch)
+                    self._close_file()
+                batch = []
+                deadline = None
+
+    def _write(self, batch):
+        """writes a batch, must only be called by the writer"""
+        if batch:
+            self._open()
+            self._writer.writerows(batch)
+            self._file.flush()
+            self._written += len(batch)
+            self._maybe_rotate()
+        if self._dropped != self._reported_dropped:
+            self._log.warning("access log queue full, %d records dropped", self._dropped - self._reported_dropped)
+            self._reported_dropped = self._dropped
+
+    def _open(self):
+        today = datetime.date.today()
+        if self._file is not None and self._daily and today != self._date:
+            self._close_file()
+            self._rotate(f"{self.path}.{self._date.isoformat()}")
+        if self._file is None:
+            self._file = open(self.path, mode="a", newline="", encoding="utf-8")  # noqa: SIM115 pylint: disable=consider-using-with
+            self._writer = csv.writer(self._file)
+            if self._file.tell() == 0:
+                self._writer.writerow(FIELDNAMES)
+            self._date = today
+
+    def _maybe_rotate(self):
+        if self._max_bytes and self._file.tell() >= self._max_bytes:
+            self._close_file()
+            for i in range(self._backup_count - 1, 0, -1):
+                if os.path.exists(f"{self.path}.{i}"):
+                    os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+            if self._backup_count > 0:
+                self._rotate(f"{self.path}.1")
+            else:
+                os.remove(self.path)
+
+    def _rotate(self, target):
+        if os.path.exists(self.path):
+            os.replace(self.path, target)
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._writer = None
@@ -0,0 +1,890 @@
+"""
+asyncio proxy engine
+handles auth, scheduling and upstream streaming for all clients on one event loop
+instead of blocking one os thread per request for the length of a generation
+"""
+
+import asyncio
+import functools
+import json
+import ssl
+import time
+import uuid
+from http import HTTPStatus
+from urllib.parse import urlsplit
+
+from ollama_proxy_server.auth import request_tenant, validate_auth_header
+from ollama_proxy_server.cluster import AGGREGATED_PATHS, MODEL_PATHS, ClusterView
+from ollama_proxy_server.embed_batcher import BATCH_PATH, AsyncEmbedBatcher, batch_key
+from ollama_proxy_server.embedding_cache import EMBED_PATHS
+from ollama_proxy_server.failover import RETRY_WAIT, RetryBudget, retryable_status
+from ollama_proxy_server.json_peek import ROUTING_FIELDS
+from ollama_proxy_server.metrics import RequestTimer
+from ollama_proxy_server.ollama_logger import get_logger
+from ollama_proxy_server.ollama_queues.admission import (
+    TIMEOUT_HEADER,
+    Overloaded,
+    parse_timeout,
+)
+from ollama_proxy_server.rate_limit import (
+    LIMITED_PATHS,
+    RateLimited,
+    RateLimiter,
+    UsageMeter,
+    count_tokens,
+    retry_after_header,
+)
+from ollama_proxy_server.relay import (
+    DEFAULT_BUFFER_SIZE,
+    NdjsonCoalescer,
+    coalesce_window,
+)
+from ollama_proxy_server.request_body import (
+    BLOCK_SIZE,
+    DEFAULT_SPOOL_THRESHOLD,
+    RequestBody,
+)
+from ollama_proxy_server.response_cache import CACHE_FIELDS, cache_key, is_deterministic
+
+QUEUED_PATHS = ("/api/generate", "/api/chat", "/v1/chat/completions")
+
+# hop by hop and framing headers we never forward to the client
+_SKIP_HEADERS = ("content-length", "transfer-encoding", "content-encoding", "connection", "keep-alive")
+
+
+class UpstreamError(Exception):
+    """the upstream server sent something we cant parse"""
+
+
+async def _read_headers(reader):
+    """reads header lines until the empty line, returns a list of (name, value)"""
+    headers = []
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            return headers
+        name, _, value = line.decode("latin-1").partition(":")
+        headers.append((name.strip(), value.strip()))
+
+
+def _get_header(headers, name, default=None):
+    """case insensitive header lookup"""
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return default
+
+
+async def _iter_chunked(reader, read_timeout):
+    """yields the decoded payload of a chunked transfer encoded body"""
+    while True:
+        line = await asyncio.wait_for(reader.readline(), read_timeout)
+        if not line:
+            raise UpstreamError("connection closed inside chunked body")
+        size = int(line.split(b";", 1)[0].strip(), 16)
+        if size == 0:
+            # skip trailers
+            await _read_headers(reader)
+            return
+        # a chunk can be as large as the sender likes, hand it on in blocks
+        while size > 0:
+            data = await asyncio.wait_for(reader.read(min(size, BLOCK_SIZE)), read_timeout)
+            if not data:
+                raise UpstreamError("connection closed inside chunked body")
+            size -= len(data)
+            yield data
+        await reader.readline()
+
+
+async def _with_deadline(chunks, coalescer):
+    """yields the chunks and b"" whenever the lines held back by coalescer are due before the next chunk arrives"""
+    # no aiter and anext builtins before python 3.10
+    chunks = chunks.__aiter__()  # pylint: disable=unnecessary-dunder-call
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                # a task, not wait_for, so a timeout does not cancel the read
+                pending = asyncio.ensure_future(chunks.__anext__())  # pylint: disable=unnecessary-dunder-call
+            done, _ = await asyncio.wait((pending,), timeout=coalescer.pending())
+            if not done:
+                yield b""
+                continue
+            task, pending = pending, None
+            try:
+                chunk = task.result()
+            except StopAsyncIteration:
+                return
+            yield chunk
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+
+async def _off_loop(body, func, *args):
+    """func(*args), which reads body, in a thread when body is large enough to hold up the event loop"""
+    if len(body) < BLOCK_SIZE:
+        return func(*args)
+    return await asyncio.to_thread(func, *args)
+
+
+async def _iter_request_body(body):
+    """yields the blocks of a request body, read from the temp file in a thread when it is spooled"""
+    if not body.spooled:
+        for block in body:
+            yield block
+        return
+    blocks = iter(body)
+    while True:
+        block = await asyncio.to_thread(next, blocks, None)
+        if block is None:
+            return
+        yield block
+
+
+def _decode(body):
+    return json.loads(body.view()[:])
+
+
+class UpstreamResponse:  # pylint: disable=too-many-instance-attributes
+    """
+    response from a backend server, the body is read lazily with iter_body
+    """
+
+    def __init__(self, reader, writer, status, reason, headers, has_body=True, release=None):  # pylint: disable=too-many-positional-arguments
+        self.reader = reader
+        self.writer = writer
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.has_body = has_body
+        self._release = release
+        self.complete = not has_body
+        # seconds spent opening the connection, 0 if an idle one was reused
+        self.connect_time = 0.0
+        chunked = (_get_header(headers, "transfer-encoding") or "").lower() == "chunked"
+        framed = chunked or _get_header(headers, "content-length") is not None or not has_body
+        self.keep_alive = framed and (_get_header(headers, "connection") or "").lower() != "close"
+
+    @property
+    def ok(self):
+        """same meaning as requests.Response.ok"""
+        return self.status < 400
+
+    async def iter_body(self, read_size, read_timeout):
+        """yields the body in chunks as they arrive"""
+        if not self.has_body:
+            return
+        if (_get_header(self.headers, "transfer-encoding") or "").lower() == "chunked":
+            async for chunk in _iter_chunked(self.reader, read_timeout):
+                yield chunk
+            self.complete = True
+            return
+        length = _get_header(self.headers, "content-length")
+        remaining = int(length) if length is not None else -1
+        while remaining != 0:
+            chunk = await asyncio.wait_for(self.reader.read(read_size if remaining < 0 else min(read_size, remaining)), read_timeout)
+            if not chunk:
+                return
+            if remaining > 0:
+                remaining -= len(chunk)
+            yield chunk
+        self.complete = True
+
+    def close(self):
+        """gives the connection back to the pool if the body was fully read, else closes it"""
+        if self._release is not None and self.complete and self.keep_alive:
+            self._release(self.reader, self.writer)
+        else:
+            self.writer.close()
+        self._release = None
+
+
+class AsyncProxyServer:  # pylint: disable=too-many-instance-attributes
+    """
+    asyncio based proxy server
+    """
+
+    def __init__(
+        self,
+        server_queue,
+        authorized_users,
+        jwt_key=None,
+        deactivate_security=False,
+        access_log=None,
+        timeout=(5, 120),
+        read_size=DEFAULT_BUFFER_SIZE,
+        pool_size=10,
+        pool_idle_timeout=60.0,
+        coalesce_ms=0.0,
+        token_cache=None,
+        metrics=None,
+        spool_threshold=DEFAULT_SPOOL_THRESHOLD,
+        cluster=None,
+        response_cache=None,
+        embedding_cache=None,
+        embed_batch_wait=0.0,
+        embed_batch_size=64,
+        user_weights=None,
+        tenant_claim="tenant",
+        rate_limiter=None,
+        retry_budget=None,
+    ):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        """
+        server_queue:           the ollama_queues queue used for scheduling
+        authorized_users:       dict of user -> key
+        jwt_key:                key for jwt tokens
+        deactivate_security:    skip authentication
+        access_log:             callable taking the access log fields as keyword arguments
+        timeout:                (connect, read) timeout towards the backends in seconds
+        read_size:              max bytes read from upstream per read
+        pool_size:              max idle keep-alive connections kept per backend server
+        pool_idle_timeout:      seconds an idle backend connection is kept
+        coalesce_ms:            default window for merging streamed ndjson lines, clients can override with X-Proxy-Coalesce-Ms
+        token_cache:            optional auth.TokenCache of verified tokens
+        metrics:                optional metrics.ProxyMetrics to record the requests in
+        spool_threshold:        request bodies larger than this many bytes are kept in a temp file
+        cluster:                cluster.ClusterView answering /api/tags, /api/ps and choosing servers for other endpoints
+        response_cache:         optional response_cache.ResponseCache for deterministic requests
+        embedding_cache:        optional embedding_cache.EmbeddingCache for /api/embed and /api/embeddings
+        embed_batch_wait:       seconds /api/embed requests wait to be sent together, 0 disables batching
+        embed_batch_size:       max inputs of a batched /api/embed request
+        user_weights:           dict of user or tenant -> weight in the fair order of the waiting requests
+        tenant_claim:           jwt claim naming the tenant of a user
+        rate_limiter:           rate_limit.RateLimiter with the limits of the users, checked before a request is queued
+        retry_budget:           failover.RetryBudget of the requests sent to another server when theirs fails before answering
+        """
+        self._queue = server_queue
+        self._authorized_users = authorized_users
+        self._jwt_key = jwt_key
+        self._deactivate_security = deactivate_security
+        self._access_log = access_log
+        self._connect_timeout, self._read_timeout = timeout
+        self._read_size = read_size
+        self._coalesce_ms = coalesce_ms
+        self._token_cache = token_cache
+        self._metrics = metrics
+        self._spool_threshold = spool_threshold
+        self._response_cache = response_cache
+        self._embedding_cache = embedding_cache
+        self._user_weights = user_weights or {}
+        self._tenant_claim = tenant_claim
+        self._rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self._retry_budget = retry_budget if retry_budget is not None else RetryBudget()
+        self._embed_batcher = AsyncEmbedBatcher(self._send_embed_batch, embed_batch_size, embed_batch_wait) if embed_batch_wait > 0 else None
+        self._cluster = cluster if cluster is not None else ClusterView(server_queue)
+        self._pool_size = pool_size
+        self._pool_idle_timeout = pool_idle_timeout
+        self._idle_connections = {}
+        self._pool_stats = {}
+        self._next_eviction = time.monotonic() + pool_idle_timeout / 2
+        self._server = None
+        self._log = get_logger(__name__, "INFO")
+
+    @property
+    def authorized_users(self):
+        """dict of user -> key"""
+        return self._authorized_users
+
+    @authorized_users.setter
+    def authorized_users(self, users):
+        # swapped as a whole so a request sees either the old or the new table
+        self._authorized_users = users
+
+    @property
+    def port(self):
+        """the port we are listening on"""
+        return self._server.sockets[0].getsockname()[1] if self._server else None
+
+    async def start(self, host="", port=8000):
+        """starts listening, returns the asyncio server"""
+        self._server = await asyncio.start_server(self._handle_client, host or None, port)
+        return self._server
+
+    def serve_forever(self, host="", port=8000):
+        """runs the event loop until interrupted"""
+
+        async def _run():
+            server = await self.start(host, port)
+            async with server:
+                await server.serve_forever()
+
+        asyncio.run(_run())
+
+    def _log_access(self, rid, client_ip, user, event="rejected", access="Denied", server=None, error=""):  # pylint: disable=too-many-positional-arguments
+        if self._access_log is None:
+            return
+        try:
+            self._access_log(
+                rid=rid,
+                event=event,
+                user_name=user,
+                ip_address=client_ip,
+                access=access,
+                server=server[0] if server else "None",
+                nb_queued_requests_on_server=self._queue.get_length(server[0]) if server else -1,
+                error=error,
+            )
+        except Exception:  # noqa: BLE001 a broken access log must not fail the request
+            self._log.exception("could not write access log")
+
+    async def _read_request(self, reader):
+        """reads the request line, headers and body from the client"""
+        line = await reader.readline()
+        if not line:
+            return None
+        method, target, _ = line.decode("latin-1").rstrip("\r\n").split(" ", 2)
+        headers = await _read_headers(reader)
+        body = RequestBody(self._spool_threshold)
+        try:
+            if (_get_header(headers, "transfer-encoding") or "").lower() == "chunked":
+                async for chunk in _iter_chunked(reader, self._read_timeout):
+                    await self._spool(body, chunk)
+            elif _get_header(headers, "content-length"):
+                remaining = int(_get_header(headers, "content-length"))
+                while remaining > 0:
+                    data = await asyncio.wait_for(reader.read(min(remaining, BLOCK_SIZE)), self._read_timeout)
+                    if not data:
+                        raise asyncio.IncompleteReadError(b"", remaining)
+                    await self._spool(body, data)
+                    remaining -= len(data)
+        except BaseException:
+            body.close()
+            raise
+        return method, target, headers, body
+
+    async def _spool(self, body, data):
+        """appends data to body, the writes to its temp file are done in a thread"""
+        if body.spooled or len(body) + len(data) > self._spool_threshold:
+            await asyncio.to_thread(body.write, data)
+        else:
+            body.write(data)
+
+    @staticmethod
+    async def _send_error(writer, code, message, retry_after=None):
+        body = message.encode("utf-8")
+        retry = f"Retry-After: {retry_after_header(retry_after)}\r\n" if retry_after is not None else ""
+        head = f"HTTP/1.1 {code} {HTTPStatus(code).phrase}\r\nContent-Type: text/plain; charset=utf-8\r\nContent-Length: {len(body)}\r\n{retry}Connection: close\r\n\r\n"
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+
+    def pool_stats(self):
+        """
+        connection counters per server, same format as UpstreamPool.stats
+        """
+        # a copy first, the metrics thread reads it while the loop adds servers
+        return {name: dict(stats) for name, stats in list(self._pool_stats.items())}
+
+    def _evict_idle(self, now):
+        self._next_eviction = now + self._pool_idle_timeout / 2
+        for name, idle in self._idle_connections.items():
+            keep = [conn for conn in idle if now - conn[2] <= self._pool_idle_timeout]
+            for _, writer, _ in (conn for conn in idle if now - conn[2] > self._pool_idle_timeout):
+                writer.close()
+            self._idle_connections[name] = keep
+
+    async def _connect(self, server_name, url):
+        """gets an idle keep-alive connection to the server or opens a new one, returns (reader, writer, reused)"""
+        now = time.monotonic()
+        if now >= self._next_eviction:
+            self._evict_idle(now)
+        stats = self._pool_stats.setdefault(server_name, {"connections": 0, "requests": 0, "reused": 0})
+        stats["requests"] += 1
+        idle = self._idle_connections.get(server_name)
+        while idle:
+            reader, writer, since = idle.pop()
+            if now - since <= self._pool_idle_timeout and not reader.at_eof() and not writer.is_closing():
+                stats["reused"] += 1
+                return reader, writer, True
+            writer.close()
+        https = url.scheme == "https"
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(url.hostname, url.port or (443 if https else 80), ssl=ssl.create_default_context() if https else None),
+            self._connect_timeout,
+        )
+        stats["connections"] += 1
+        return reader, writer, False
+
+    def _release(self, server_name, reader, writer):
+        idle = self._idle_connections.setdefault(server_name, [])
+        if len(idle) >= self._pool_size:
+            writer.close()
+        else:
+            idle.append((reader, writer, time.monotonic()))
+
+    async def _request_upstream(self, server, method, target, body):
+        """sends the request to a backend and reads the status and headers"""
+        url = urlsplit(server[1]["url"])
+        connect_time = 0.0
+        while True:
+            start = time.monotonic()
+            reader, writer, reused = await self._connect(server[0], url)
+            if not reused:
+                connect_time += time.monotonic() - start
+            try:
+                head = f"{method} {url.path.rstrip('/')}{target} HTTP/1.1\r\nHost: {url.netloc}\r\nAccept-Encoding: identity\r\n"
+                if len(body) or method == "POST":
+                    head += f"Content-Length: {len(body)}\r\n"
+                writer.write(head.encode("latin-1") + b"\r\n")
+                async for block in _iter_request_body(body):
+                    writer.write(block)
+                    await writer.drain()
+                await writer.drain()
+
+                line = await asyncio.wait_for(reader.readline(), self._read_timeout)
+                if not line and reused:
+                    # the server closed the idle connection, try again on a new one
+                    raise ConnectionResetError("stale keep-alive connection")
+                parts = line.decode("latin-1").rstrip("\r\n").split(" ", 2)
+                if len(parts) < 2 or not parts[1].isdigit():
+                    raise UpstreamError(f"bad status line {line!r}")
+                status = int(parts[1])
+                headers = await asyncio.wait_for(_read_headers(reader), self._read_timeout)
+            except ConnectionError:
+                writer.close()
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            has_body = method != "HEAD" and status not in (204, 304) and status >= 200
+            response = UpstreamResponse(
+                reader,
+                writer,
+                status,
+                parts[2] if len(parts) > 2 else "",
+                headers,
+                has_body,
+                release=lambda r, w, name=server[0]: self._release(name, r, w),
+            )
+            response.connect_time = connect_time
+            return response
+
+    async def _failover(self, server, tried, queue_filter, log):
+        """
+        moves a request whose server failed before answering to a server it has not tried, if the retry budget allows it
+
+        returns the new server, the slot of the failed one is released, or None to send the error to the client
+        """
+        if not self._retry_budget.allow(len(tried)):
+            return None
+        try:
+            other = await self._queue.enqueue_async(dict(queue_filter, exclude=tried | {server[0]}), RETRY_WAIT)
+        except (asyncio.TimeoutError, TimeoutError):
+            return None
+        if other is None:
+            return None
+        log(event="gen_retry", server=server)
+        self._queue.dequeue(server[0], False)
+        tried.add(server[0])
+        return other
+
+    async def _request_with_failover(self, server, model, method, target, body, log=None):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        """
+        sends a request that does not take a slot, when its server can not be reached or answers with a 5xx it is
+        sent to another server that can take model, as long as the retry budget allows it
+
+        returns (server, response) of the server that answered last
+        """
+        tried = set()
+        self._retry_budget.request()
+        while True:
+            try:
+                response = await self._request_upstream(server, method, target, body)
+            except (OSError, asyncio.TimeoutError):
+                # refused, unreachable or timed out before the headers, asyncio.TimeoutError is no OSError before python 3.11
+                other = await asyncio.to_thread(self._cluster.failover, server, tried, model, self._retry_budget)
+                if other is None:
+                    raise
+            else:
+                if not retryable_status(response.status):
+                    return server, response
+                other = await asyncio.to_thread(self._cluster.failover, server, tried, model, self._retry_budget, response.status)
+                if other is None:
+                    return server, response
+                response.close()
+            if log is not None:
+                log(event="retry", server=server)
+            server = other
+
+    async def _send_response(self, writer, response, stream=True, window=0.0, timer=None, recorder=None):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        head = [f"HTTP/1.1 {response.status} {response.reason}"]
+        head.extend(f"{key}: {value}" for key, value in response.headers if key.lower() not in _SKIP_HEADERS)
+        head.append("Connection: close")
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+        await writer.drain()
+        coalescer = NdjsonCoalescer(window if stream else 0.0)
+        chunks = response.iter_body(self._read_size, self._read_timeout)
+        if coalescer.window > 0:
+            chunks = _with_deadline(chunks, coalescer)
+        async for chunk in chunks:
+            out = coalescer.feed(chunk)
+            if out:
+                await self._write_body(writer, out, timer, recorder)
+        out = coalescer.flush()
+        if out:
+            await self._write_body(writer, out, timer, recorder)
+
+    @staticmethod
+    async def _write_body(writer, out, timer, recorder):
+        if timer is not None:
+            timer.mark_first_byte()
+        writer.write(out)
+        await writer.drain()
+        if recorder is not None:
+            recorder.write(out)
+
+    @staticmethod
+    async def _send_cached(writer, cached):
+        head = "HTTP/1.1 200 OK\r\n"
+        if cached.content_type:
+            head += f"Content-Type: {cached.content_type}\r\n"
+        writer.write((head + "Connection: close\r\n\r\n").encode("latin-1"))
+        # chunk by chunk like the original response
+        for chunk in cached.chunks:
+            writer.write(chunk)
+            await writer.drain()
+
+    async def _handle_client(self, reader, writer):
+        try:
+            request = await self._read_request(reader)
+            if request is not None:
+                try:
+                    await self._proxy(writer, *request)
+                finally:
+                    request[3].close()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            self._log.debug("client went away")
+        except Exception:  # noqa: BLE001 one broken connection must not stop the server
+            self._log.exception("unhandled error in client handler")
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _send_bytes(writer, body, content_type, send_body=True, status=200):
+        head = f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n"
+        writer.write(head.encode("latin-1") + (body if send_body else b""))
+        await writer.drain()
+
+    async def _send_json(self, writer, data, send_body=True):
+        await self._send_bytes(writer, json.dumps(data).encode("utf-8"), "application/json; charset=utf-8", send_body)
+
+    async def _send_embeddings(self, writer, lookup, response):
+        """sends the cached vectors with the ones the server computed, returns the tokens the server counted"""
+        data = b"".join([chunk async for chunk in response.iter_body(self._read_size, self._read_timeout)])
+        try:
+            # the cache file is locked and written, not on the event loop
+            merged = await asyncio.to_thread(lookup.merge, json.loads(data))
+        except ValueError:
+            self._log.warning("could not merge the embeddings from the server")
+            await self._send_bytes(writer, data, _get_header(response.headers, "content-type", "application/json"))
+            return 0
+        await self._send_json(writer, merged)
+        return count_tokens(data)
+
+    async def _send_embed_batch(self, request):
+        """sends one batch of embed requests to a server that has the model"""
+        server = await asyncio.to_thread(self._cluster.server_for, request["model"])
+        if server is None:
+            raise UpstreamError("no server available")
+        body = RequestBody()
+        body.write(json.dumps(request).encode("utf-8"))
+        response = None
+        try:
+            _, response = await self._request_with_failover(server, request["model"], "POST", BATCH_PATH, body)
+            data = b"".join([chunk async for chunk in response.iter_body(self._read_size, self._read_timeout)])
+            return response.status, _get_header(response.headers, "content-type", "application/json"), data
+        finally:
+            if response is not None:
+                response.close()
+            body.close()
+
+    async def _proxy_embed_batch(self, writer, request, lookup, log_access):
+        """sends an /api/embed request together with the ones arriving at the same time, returns its share of the tokens"""
+        log_access(event="embed_batch")
+        try:
+            status, content_type, data = await self._embed_batcher.submit(request)
+        except Exception as ex:  # noqa: BLE001 the client gets an error whatever the batch raised
+            self._log.exception("embed batch failed")
+            log_access(event="request_error", error=ex)
+            await self._send_error(writer, 502, "the remote server could not be reached")
+            return 0
+        if status != 200:
+            await self._send_bytes(writer, data, content_type, status=status)
+            return 0
+        # the share of the batch counted by the server
+        tokens = data.get("prompt_eval_count") or 0
+        try:
+            data = await asyncio.to_thread(lookup.merge, data) if lookup is not None else data
+        except ValueError as ex:
+            log_access(event="request_error", error=ex)
+            await self._send_error(writer, 502, "the remote server did not answer with embeddings")
+            return 0
+        await self._send_json(writer, data)
+        return tokens
+
+    async def _proxy_other(self, writer, method, target, path, body, log_access, tenant=None, jwt_payload=None):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        """
+        endpoints that are not scheduled, /api/tags and /api/ps are merged from all servers
+        the others are mirrored to one server, the ones about a model to a server that has it
+
+            tenant:         user or tenant the rate limits of the endpoints running a model apply to
+        """
+        # the cluster view asks the servers with blocking requests
+        if path in AGGREGATED_PATHS and method in ("GET", "HEAD"):
+            try:
+                data = await asyncio.to_thread(self._cluster.get, path)
+            except Exception as ex:  # noqa: BLE001 the client gets an error whatever the servers answered
+                self._log.exception("cluster request failed")
+                log_access(event="internal_error", error=ex)
+                await self._send_error(writer, 500, "internal error please contact proxy admin")
+                return
+            log_access(event="cluster_request")
+            await self._send_json(writer, data, method != "HEAD")
+            return
+
+        model = None
+        lookup = None
+        fields = None
+        if path in MODEL_PATHS and len(body):
+            try:
+                if (self._embedding_cache is not None and path in EMBED_PATHS) or (self._embed_batcher is not None and path == BATCH_PATH):
+                    fields = await _off_loop(body, _decode, body)
+                    # only the inputs not cached are sent to the server
+                    lookup = await asyncio.to_thread(self._embedding_cache.lookup, path, fields) if self._embedding_cache is not None else None
+                else:
+                    fields = await _off_loop(body, body.peek, ("model", "name"))
+                model = fields.get("model") or fields.get("name")
+            except (ValueError, AttributeError):
+                # let the server answer
+                pass
+        if lookup is not None and not lookup.missing:
+            log_access(event="cache_hit")
+            await self._send_json(writer, await asyncio.to_thread(lookup.merge, None))
+            return
+        # the endpoints running a model take a ticket like the queued ones
+        ticket = None
+        if path in LIMITED_PATHS:
+            try:
+                ticket = self._rate_limiter.acquire(tenant, jwt_payload)
+            except RateLimited as ex:
+                log_access(event="rate_limited", error=ex)
+                await self._send_error(writer, 429, str(ex), ex.retry_after)
+                return
+        tokens = 0
+        try:
+            tokens = await self._mirror(writer, method, target, path, body, model, fields, lookup, log_access, ticket is not None and bool(ticket.limits.tokens))
+        finally:
+            if ticket is not None:
+                ticket.release(tokens)
+
+    async def _mirror(self, writer, method, target, path, body, model, fields, lookup, log_access, metered=False):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        """
+        sends a request that is not queued to one server, the ones about a model to a server that has it
+
+            metered:    count the tokens of a streamed response too
+
+        returns the prompt and generated tokens of the response, 0 if they were not counted
+        """
+        if self._embed_batcher is not None and path == BATCH_PATH:
+            request = lookup.upstream_request() if lookup is not None else fields
+            if batch_key(request) is not None:
+                return await self._proxy_embed_batch(writer, request, lookup, log_access)
+        model = model if isinstance(model, str) else None
+        server = await asyncio.to_thread(self._cluster.server_for, model)
+        if server is None:
+            log_access(event="internal_error", error="no server")
+            await self._send_error(writer, 502, "no server available")
+            return 0
+        log_access(event="request", server=server)
+        if lookup is not None:
+            body = RequestBody()
+            body.write(lookup.upstream_body())
+        response = None
+        response_sent = False
+        try:
+            server, response = await self._request_with_failover(server, model, method, target, body, log_access)
+            response_sent = True
+            if lookup is not None and response.status == 200:
+                return await self._send_embeddings(writer, lookup, response)
+            meter = UsageMeter() if metered and response.ok else None
+            await self._send_response(writer, response, recorder=meter)
+            return meter.tokens() if meter is not None else 0
+        except Exception as ex:  # noqa: BLE001 the client gets an error whatever the server answered
+            self._log.exception("request to %s failed", server[0])
+            log_access(event="request_error", server=server, error=ex)
+            if not response_sent:
+                await self._send_error(writer, 502, "the remote server could not be reached")
+            return 0
+        finally:
+            if response is not None:
+                response.close()
+            if lookup is not None:
+                body.close()
+
+    async def _proxy(self, writer, method, target, headers, body):  # pylint: disable=too-many-positional-arguments,too-many-return-statements
+        """
+        Main proxy function that handles all requests
+        """
+        rid = uuid.uuid4()
+        timer = RequestTimer()
+        client_ip = (writer.get_extra_info("peername") or ("unknown",))[0]
+        user = "unknown"
+        jwt_payload = None
+
+        if not self._deactivate_security:
+            valid = None
+            try:
+                valid = validate_auth_header(_get_header(headers, "authorization"), self._authorized_users, self._jwt_key, self._token_cache)
+            except Exception:  # noqa: BLE001 a token that can not be checked is rejected
+                self._log.exception("validate user exception")
+            if valid is None:
+                self._log.warning("User is not authorized")
+                self._log_access(rid, client_ip, user, error="Authentication failed")
+                await self._send_error(writer, 403, "Forbidden")
+                return
+            user, jwt_payload = valid
+
+        path = urlsplit(target).path
+        if path not in QUEUED_PATHS:
+            log_access = functools.partial(self._log_access, rid, client_ip, user, access="Authorized")
+            tenant, _ = request_tenant(user, jwt_payload, self._user_weights, self._tenant_claim)
+            await self._proxy_other(writer, method, target, path, body, log_access, tenant, jwt_payload)
+            return
+
+        server = None
+        key = None
+        cache = self._response_cache
+        # admission by the rate limiter, released when the request is done
+        ticket = None
+        # what the request was queued with, to queue it again on another server
+        queue_filter = None
+        try:
+            # only model and stream, and options for the cache, are needed, large image payloads are not decoded
+            post_data_dict = await _off_loop(body, body.peek, CACHE_FIELDS if cache is not None else ROUTING_FIELDS) if method == "POST" else {}
+            # deterministic requests are answered from the cache without taking a server
+            if cache is not None and is_deterministic(post_data_dict) and "no-cache" not in (_get_header(headers, "cache-control") or ""):
+                key = await _off_loop(body, lambda: cache_key(path, _decode(body)))
+                cached = cache.get(key) if key else None
+                if cached is not None:
+                    self._log_access(rid, client_ip, user, event="cache_hit", access="Authorized")
+                    await self._send_cached(writer, cached)
+                    return
+            # waiting requests are served fairly between users
+            tenant, weight = request_tenant(user, jwt_payload, self._user_weights, self._tenant_claim)
+            ticket = self._rate_limiter.acquire(tenant, jwt_payload)
+            timeout = parse_timeout(_get_header(headers, TIMEOUT_HEADER))
+            queue_filter = dict(post_data_dict, user=tenant, weight=weight)
+            server = await self._queue.enqueue_async(queue_filter, timeout)
+            timer.mark_queued()
+        except RateLimited as ex:
+            self._log_access(rid, client_ip, user, event="rate_limited", access="Authorized", error=ex)
+            await self._send_error(writer, 429, str(ex), ex.retry_after)
+            return
+        except Overloaded as ex:
+            if ticket is not None:
+                ticket.release()
+            self._log_access(rid, client_ip, user, event="overloaded", access="Authorized", error=ex)
+            await self._send_error(writer, 503, str(ex), ex.retry_after)
+            return
+        except asyncio.CancelledError:
+            # the client went away while waiting
+            if ticket is not None:
+                ticket.release()
+            raise
+        except (json.JSONDecodeError, UnicodeDecodeError) as ex:
+            self._log.exception(rid)
+            self._log_access(rid, client_ip, user, event="request_error", access="Authorized", error=ex)
+            await self._send_error(writer, 400, "bad request could not decode")
+            return
+        except Exception as ex:  # noqa: BLE001 the client gets an error whatever went wrong
+            if ticket is not None:
+                ticket.release()
+            self._log.exception(rid)
+            self._log_access(rid, client_ip, user, event="internal_error", access="Authorized", error=ex)
+            await self._send_error(writer, 500, "internal error please contact proxy admin")
+            return
+        if server is None:
+            if ticket is not None:
+                ticket.release()
+            self._log_access(rid, client_ip, user, event="internal_error", access="Authorized", error="no server")
+            await self._send_error(writer, 503, "no healthy server available please try again")
+            return
+
+        self._log.debug("sending request to server %s", server[0])
+        self._log_access(rid, client_ip, user, event="gen_request", access="Authorized", server=server)
+        response = None
+        response_sent = False
+        status = 500
+        # None until the server answered or failed, stays None when the client went away first
+        healthy = None
+        # counts the tokens of the response for the token quota
+        meter = None
+        try:
+            # servers that failed before answering
+            tried = set()
+            log = functools.partial(self._log_access, rid, client_ip, user, access="Authorized")
+            self._retry_budget.request()
+            while True:
+                try:
+                    response = await self._request_upstream(server, method, target, body)
+                except (OSError, asyncio.TimeoutError):
+                    # refused, unreachable or timed out before the headers, asyncio.TimeoutError is no OSError before python 3.11
+                    other = await self._failover(server, tried, queue_filter, log)
+                    if other is None:
+                        raise
+                    server = other
+                    continue
+                if not retryable_status(response.status):
+                    break
+                other = await self._failover(server, tried, queue_filter, log)
+                if other is None:
+                    break
+                response.close()
+                response = None
+                server = other
+            timer.connect = response.connect_time
+            status = response.status
+            healthy = status < 500
+            response_sent = True
+            # ollama streams by default, the openai compatible endpoints do not
+            stream = bool(post_data_dict.get("stream", not path.startswith("/v1/")))
+            recorder = cache.recorder(key, _get_header(response.headers, "content-type")) if key and status == 200 else None
+            out = recorder
+            if ticket is not None and ticket.limits.tokens and response.ok:
+                out = meter = UsageMeter(recorder)
+            await self._send_response(writer, response, stream, coalesce_window(_get_header(headers, "x-proxy-coalesce-ms"), self._coalesce_ms), timer, out)
+            if recorder is not None:
+                recorder.commit()
+        except (asyncio.TimeoutError, TimeoutError) as ex:
+            healthy = False
+            self._log.exception(rid)
+            self._log_access(rid, client_ip, user, event="gen_error", access="Authorized", server=server, error=ex)
+            if not response_sent:
+                status = 408
+                await self._send_error(writer, 408, "the remote server timeout please try again")
+        except ConnectionError as ex:
+            # client or server went away
+            if response is None:
+                healthy = False
+            self._log_access(rid, client_ip, user, event="gen_error", access="Authorized", server=server, error=ex)
+            if not response_sent:
+                await self._send_error(writer, 500, "internal error during proxy please contact proxy admin")
+        except Exception as ex:  # noqa: BLE001 the client gets an error whatever went wrong
+            if response is None:
+                healthy = False
+            self._log.exception(rid)
+            self._log_access(rid, client_ip, user, event="gen_error", access="Authorized", server=server, error=ex)
+            if not response_sent:
+                await self._send_error(writer, 500, "internal error during proxy please contact proxy admin")
+        finally:
+            if response is not None:
+                response.close()
+            self._queue.dequeue(server[0], healthy, timer.server_latency() if response is not None and response.ok else None)
+            if ticket is not None:
+                ticket.release(meter.tokens() if meter is not None else 0)
+            self._log_access(rid, client_ip, user, event="gen_done", access="Authorized", server=server)
+            if self._metrics is not None:
+                self._metrics.observe(timer, server[0], post_data_dict.get("model"), path, status)
@@ -0,0 +1,160 @@
+"""
+authentication helpers shared by the proxy engines
+"""
+
+import collections
+import threading
+import time
+
+import jwt
+
+
+def jwt_decode(key, encoded):
+    """decode jwt data with key"""
+    return jwt.decode(encoded, key, audience="urn:ollama_proxy", algorithms="HS256")
+
+
+class TokenCache:  # pylint: disable=too-many-instance-attributes
+    """
+    bounded lru cache of tokens that have been verified
+
+    a jwt token is kept until its exp claim, any token at most max_age seconds,
+    everything is forgotten when the jwt key or the users table is replaced
+
+        max_size:   max number of tokens kept
+        max_age:    seconds a token is trusted without verifying it again
+    """
+
+    def __init__(self, max_size=4096, max_age=300.0):
+        self._max_size = max_size
+        self._max_age = max_age
+        # token -> (user, jwt_payload, expires)
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._jwt_key = None
+        self._users = None
+        self.hits = 0
+        self.misses = 0
+
+    def _check_generation(self, authorized_users, jwt_key):
+        """clears the cache if the keys changed, must hold the lock"""
+        if jwt_key != self._jwt_key or authorized_users is not self._users:
+            self._entries.clear()
+            self._jwt_key = jwt_key
+            self._users = authorized_users
+
+    def get(self, token, authorized_users, jwt_key, now=None):
+        """(user, jwt_payload) of a verified token, None if it has to be verified"""
+        now = time.time() if now is None else now
+        with self._lock:
+            self._check_generation(authorized_users, jwt_key)
+            entry = self._entries.get(token)
+            if entry is not None:
+                if entry[2] > now:
+                    self._entries.move_to_end(token)
+                    self.hits += 1
+                    return entry[0], entry[1]
+                del self._entries[token]
+            self.misses += 1
+            return None
+
+    def put(self, token, authorized_users, jwt_key, user, jwt_payload, now=None):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        """remembers a verified token"""
+        now = time.time() if now is None else now
+        expires = now + self._max_age
+        if jwt_payload and "exp" in jwt_payload:
+            expires = min(expires, float(jwt_payload["exp"]))
+        with self._lock:
+            # a put with keys replaced since is only cached until the next get with the new keys
+            self._check_generation(authorized_users, jwt_key)
+            self._entries[token] = (user, jwt_payload, expires)
+            self._entries.move_to_end(token)
+            if len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """forgets all tokens"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """hit and miss counters"""
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+
+def validate_auth_header(auth_header, authorized_users, jwt_key=None, cache=None):
+    """
+    validates a bearer Authorization header
+
+        auth_header:        the value of the Authorization header
+        authorized_users:   dict of user -> key
+        jwt_key:            key used to verify jwt tokens, None disables jwt
+        cache:              optional TokenCache of verified tokens
+
+    returns
+        (user, jwt_payload) if valid, jwt_payload is None for user:key tokens
+        None if not valid
+
+    raises on broken jwt tokens
+    """
+    if not auth_header or not auth_header.startswith("Bearer "):
+        return None
+    token = auth_header.split(" ")[1]
+    if cache is None:
+        return _validate_token(token, authorized_users, jwt_key)
+    valid = cache.get(token, authorized_users, jwt_key)
+    if valid is None:
+        valid = _validate_token(token, authorized_users, jwt_key)
+        if valid is not None:
+            cache.put(token, authorized_users, jwt_key, *valid)
+    return valid
+
+
+def _validate_token(token, authorized_users, jwt_key):
+    """verifies a token, see validate_auth_header"""
+    try:
+        user, key = token.split(":")
+    except ValueError:
+        # try to jwt decode
+        if jwt_key:
+            payload = jwt_decode(jwt_key, token)
+            return payload["user"], payload
+        # raise or return False
+        raise
+    # Check if the user and key are in the list of authorized users
+    if authorized_users.get(user) == key:
+        return user, None
+    return None
+
+
+def request_tenant(user, jwt_payload=None, weights=None, claim="tenant"):
+    """
+    the tenant a request is queued as and its weight in the fair order
+
+        user:           the authenticated user
+        jwt_payload:    the decoded jwt of the user, None for user:key tokens
+        weights:        dict of tenant -> weight from the command line
+        claim:          jwt claim naming the tenant, users without it are their own tenant
+
+    the weight is the weight claim of the jwt, else the configured one, else 1
+    """
+    tenant = user
+    weight = None
+    if jwt_payload:
+        if isinstance(jwt_payload.get(claim), str) and jwt_payload[claim]:
+            tenant = jwt_payload[claim]
+        weight = jwt_payload.get("weight")
+    if not isinstance(weight, (int, float)) or isinstance(weight, bool) or weight <= 0:
+        weight = (weights or {}).get(tenant, 1.0)
+    return tenant, float(weight)
+
+
+def parse_weights(values):
+    """dict of name -> weight from a list of name=weight strings, raises ValueError on a broken entry"""
+    weights = {}
+    for value in values or []:
+        name, sep, weight = value.rpartition("=")
+        if not sep or not name or float(weight) <= 0:
+            raise ValueError(f"expected name=weight with a positive weight, got {value!r}")
+        weights[name] = float(weight)
+    return weights
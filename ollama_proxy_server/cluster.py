@@ -0,0 +1,180 @@
+"""
+cluster wide answers for the endpoints that are not scheduled
+
+/api/tags and /api/ps are asked from every server in parallel and merged, the result is cached for a few seconds
+so clients polling them do not hit every backend each time. requests about one model go to a server that has it,
+found with the latest /api/tags, an expired one is used while it is refreshed in the background so a hung server
+does not hold up these requests. servers taken out by the health monitor are not asked
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from ollama_proxy_server.failover import unhealthy_status
+from ollama_proxy_server.ollama_logger import get_logger
+from ollama_proxy_server.ollama_queues.residency import normalize_model
+from ollama_proxy_server.upstream_pool import UpstreamPool
+
+# endpoints answered with the merged result of all servers
+AGGREGATED_PATHS = ("/api/tags", "/api/ps")
+# endpoints about one model, sent to a server that has it
+MODEL_PATHS = ("/api/show", "/api/embed", "/api/embeddings", "/v1/embeddings")
+
+
+def _model_name(entry):
+    return normalize_model(entry.get("model") or entry.get("name") or "")
+
+
+def merge_tags(results):
+    """merges /api/tags responses, a model on several servers is listed once"""
+    models = {}
+    for result in results:
+        for entry in result.get("models") or []:
+            models.setdefault(_model_name(entry), entry)
+    return {"models": sorted(models.values(), key=_model_name)}
+
+
+def merge_ps(results):
+    """merges /api/ps responses, a model loaded on several servers is listed once with the latest expiry"""
+    models = {}
+    for result in results:
+        for entry in result.get("models") or []:
+            name = _model_name(entry)
+            if name not in models or entry.get("expires_at", "") > models[name].get("expires_at", ""):
+                models[name] = entry
+    return {"models": sorted(models.values(), key=_model_name)}
+
+
+_MERGE = {"/api/tags": merge_tags, "/api/ps": merge_ps}
+
+
+class ClusterView:  # pylint: disable=too-many-instance-attributes
+    """
+    merged view of all servers
+
+        server_queue:   the queue, the servers are taken from it so reloads are seen
+        pool:           UpstreamPool used to ask the servers, a private one if None
+        ttl:            seconds a merged answer is reused
+        timeout:        timeout of one request to a server
+    """
+
+    def __init__(self, server_queue, pool=None, ttl=5.0, timeout=5.0):
+        self._queue = server_queue
+        self._pool = pool if pool is not None else UpstreamPool()
+        self._ttl = ttl
+        self._timeout = timeout
+        # path -> (expires, merged answer)
+        self._cache = {}
+        # server name -> set of models from its last /api/tags
+        self._server_models = {}
+        self._refresh_locks = {path: threading.Lock() for path in _MERGE}
+        self._log = get_logger(__name__, "INFO")
+
+    def _get_json(self, server, path):
+        try:
+            res = self._pool.request(server[0], "GET", server[1]["url"] + path, timeout=self._timeout)
+            res.raise_for_status()
+            return server[0], res.json()
+        except (requests.RequestException, ValueError) as ex:
+            self._log.warning("could not get %s from %s: %s", path, server[0], ex)
+            return server[0], None
+
+    def _fan_out(self, path):
+        """asks every schedulable server in parallel, returns dict of server name -> json of those that answered"""
+        servers = self._queue.schedulable()
+        if not servers:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(16, len(servers)), thread_name_prefix="ollama-cluster") as pool:
+            return {name: result for name, result in pool.map(lambda server: self._get_json(server, path), servers) if result is not None}
+
+    def get(self, path, now=None):
+        """the merged answer for one of AGGREGATED_PATHS"""
+        now = time.monotonic() if now is None else now
+        cached = self._cache.get(path)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+        # only one request thread asks the servers, the others wait and use its answer
+        with self._refresh_locks[path]:
+            cached = self._cache.get(path)
+            if cached is not None and cached[0] > time.monotonic():
+                return cached[1]
+            return self._refresh(path)
+
+    def _refresh(self, path):
+        """asks the servers and caches the merged answer, the refresh lock of path must be held"""
+        results = self._fan_out(path)
+        if path == "/api/tags":
+            self._server_models = {name: {_model_name(entry) for entry in result.get("models") or []} for name, result in results.items()}
+        merged = _MERGE[path](results.values())
+        self._cache[path] = (time.monotonic() + self._ttl, merged)
+        return merged
+
+    def _refresh_in_background(self, path):
+        """refreshes path in a thread unless a refresh is running already"""
+        lock = self._refresh_locks[path]
+        if not lock.acquire(blocking=False):
+            return
+
+        def run():
+            try:
+                self._refresh(path)
+            finally:
+                lock.release()
+
+        threading.Thread(target=run, name="ollama-cluster-refresh", daemon=True).start()
+
+    def servers_with_model(self, model):
+        """
+        names of the servers that listed model in /api/tags
+        only the first call waits for the servers, later ones use the latest list and refresh it in the background
+        """
+        cached = self._cache.get("/api/tags")
+        if cached is None:
+            self.get("/api/tags")
+        elif cached[0] <= time.monotonic():
+            self._refresh_in_background("/api/tags")
+        model = normalize_model(model)
+        return {name for name, models in self._server_models.items() if model in models}
+
+    def server_for(self, model=None, exclude=None):
+        """
+        the server to send a request about model to, None if no server can take it
+        the least busy of the servers the queue can schedule the model on that has the model, or of all of them if
+        none has it. servers taken out by the health monitor, not allowed the model or in exclude are not used
+        """
+        filter_ = {"exclude": exclude}
+        if model:
+            filter_["model"] = model
+        servers = self._queue.schedulable(filter_)
+        if not servers:
+            return None
+        if model:
+            names = self.servers_with_model(model)
+            with_model = [server for server in servers if server[0] in names]
+            servers = with_model or servers
+        return min(servers, key=lambda server: self._queue.get_length(server[0]))
+
+    def failover(self, server, tried, model=None, retry_budget=None, status=None):  # pylint: disable=too-many-positional-arguments
+        """
+        the server to send a request about model to after server failed, None to give up
+        a connection error, a timeout or a 502, 503 or 504 counts in the health of server like a failed probe, the
+        request does not hold a slot
+
+            tried:          names of the servers the request failed on, server is added
+            retry_budget:   RetryBudget the retry is taken from, None never retries
+            status:         the status server answered with, None if it did not answer
+        """
+        if status is None or unhealthy_status(status):
+            self._queue.report_probe(server[0], False)
+        attempt = len(tried)
+        tried.add(server[0])
+        if retry_budget is None or not retry_budget.allow(attempt):
+            return None
+        return self.server_for(model, exclude=tried)
+
+    def invalidate(self):
+        """forgets the cached answers"""
+        self._cache = {}
@@ -0,0 +1,200 @@
+"""
+micro batching of /api/embed requests
+
+indexing workers send many small embed requests at the same time, each one is a round trip to a server that could
+have computed all of them in one pass. requests for the same model and parameters arriving within a short window
+are sent as one request with all their inputs, the vectors are split back to the callers in order.
+
+the first request of a batch waits up to max_wait for others and sends the batch, the ones joining it wait for the
+result. a batch is sent right away once it has max_batch inputs
+"""
+
+import asyncio
+import json
+import threading
+
+from ollama_proxy_server.ollama_queues.residency import normalize_model
+
+BATCH_PATH = "/api/embed"
+
+
+def batch_key(request):
+    """requests with the same key can be sent together, None if the request can not be batched"""
+    if not isinstance(request, dict) or not isinstance(request.get("model"), str):
+        return None
+    texts = request.get("input")
+    if isinstance(texts, str):
+        texts = [texts]
+    if not texts or not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+        return None
+    params = {key: value for key, value in request.items() if key not in ("model", "input")}
+    return normalize_model(request["model"]) + "\0" + json.dumps(params, sort_keys=True)
+
+
+class _Batch:  # pylint: disable=too-many-instance-attributes
+    """inputs of several requests sent as one"""
+
+    def __init__(self, request, event):
+        self.request = request
+        self.texts = []
+        self.full = event()
+        self.done = event()
+        # (status, content type, body) of the server
+        self.result = None
+        self.error = None
+        self._split = None
+
+    def add(self, texts):
+        """adds the inputs of a request, returns where they start"""
+        start = len(self.texts)
+        self.texts.extend(texts)
+        return start
+
+    def upstream_request(self):
+        """the request sent to the server"""
+        request = dict(self.request)
+        request["input"] = self.texts
+        return request
+
+    def _decode(self):
+        """the decoded response if it has one vector per input, None if it has to be sent as is"""
+        status, _, body = self.result
+        if status != 200:
+            return None
+        try:
+            data = json.loads(body)
+            if isinstance(data, dict) and isinstance(data.get("embeddings"), list) and len(data["embeddings"]) == len(self.texts):
+                return data
+        except ValueError:
+            pass
+        return None
+
+    def split(self, start, count):
+        """
+        the answer for the request whose inputs are at start
+        (200, content type, decoded response) or the (status, content type, body) of the server if it failed
+        """
+        if self.error is not None:
+            raise self.error
+        if self._split is None:
+            self._split = self._decode() or False
+        if self._split is False:
+            status, content_type, body = self.result
+            return (502 if status == 200 else status), content_type, body
+        data = dict(self._split)
+        data["embeddings"] = data["embeddings"][start : start + count]
+        if isinstance(data.get("prompt_eval_count"), int):
+            # the server counts the whole batch, each caller gets its share
+            data["prompt_eval_count"] = round(data["prompt_eval_count"] * count / len(self.texts))
+        return 200, self.result[1], data
+
+
+class EmbedBatcher:
+    """
+    collects concurrent /api/embed requests into batches, for request threads
+
+        send:       callable(request dict) -> (status, content type, body bytes), sends one batch to a server
+        max_batch:  max inputs sent in one request
+        max_wait:   seconds the first request of a batch waits for more
+    """
+
+    def __init__(self, send, max_batch=64, max_wait=0.005):
+        self._send = send
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        # batch key -> batch still accepting requests
+        self._open = {}
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.requests = 0
+
+    def _join(self, key, request, texts, event):
+        """adds the request to the open batch of its key, returns (batch, start, leader)"""
+        with self._lock:
+            self.requests += 1
+            batch = self._open.get(key)
+            leader = batch is None or len(batch.texts) + len(texts) > self.max_batch
+            if leader:
+                if batch is not None:
+                    batch.full.set()
+                batch = self._open[key] = _Batch(request, event)
+                self.batches += 1
+            start = batch.add(texts)
+            if len(batch.texts) >= self.max_batch:
+                batch.full.set()
+                del self._open[key]
+            return batch, start, leader
+
+    def _close(self, key, batch):
+        with self._lock:
+            if self._open.get(key) is batch:
+                del self._open[key]
+
+    @staticmethod
+    def _texts(request):
+        texts = request["input"]
+        return [texts] if isinstance(texts, str) else texts
+
+    def submit(self, request):
+        """
+        sends the request with the others arriving at the same time, blocks until the answer is there
+
+            request:    the decoded /api/embed request, batch_key must not be None
+
+        returns (200, content type, decoded response) or (status, content type, body bytes) when the server failed
+        raises what send raised
+        """
+        key = batch_key(request)
+        texts = self._texts(request)
+        batch, start, leader = self._join(key, request, texts, threading.Event)
+        if leader:
+            batch.full.wait(self.max_wait)
+            self._close(key, batch)
+            try:
+                batch.result = self._send(batch.upstream_request())
+            except BaseException as ex:
+                batch.error = ex if isinstance(ex, Exception) else ConnectionError("the batch was not sent")
+                raise
+            finally:
+                batch.done.set()
+        else:
+            batch.done.wait()
+        return batch.split(start, len(texts))
+
+    def stats(self):
+        """requests received and batches sent"""
+        return {"requests": self.requests, "batches": self.batches}
+
+
+class AsyncEmbedBatcher(EmbedBatcher):
+    """
+    same as EmbedBatcher for the event loop
+
+        send:   coroutine function(request dict) -> (status, content type, body bytes)
+    """
+
+    async def submit(self, request):  # pylint: disable=invalid-overridden-method
+        """see EmbedBatcher.submit"""
+        key = batch_key(request)
+        texts = self._texts(request)
+        batch, start, leader = self._join(key, request, texts, asyncio.Event)
+        if leader:
+            try:
+                try:
+                    await asyncio.wait_for(batch.full.wait(), self.max_wait)
+                except (asyncio.TimeoutError, TimeoutError):
+                    # asyncio.TimeoutError is not the builtin before python 3.11
+                    pass
+                self._close(key, batch)
+                batch.result = await self._send(batch.upstream_request())
+            except BaseException as ex:
+                # cancelled when the client went away, while waiting or sending, the others get an error
+                batch.error = ex if isinstance(ex, Exception) else ConnectionError("the batch was cancelled")
+                raise
+            finally:
+                # later requests start a new batch
+                self._close(key, batch)
+                batch.done.set()
+        else:
+            await batch.done.wait()
+        return batch.split(start, len(texts))
@@ -0,0 +1,278 @@
+"""
+persistent cache of embeddings for /api/embed and /api/embeddings
+
+the vectors are kept in a memory mapped file so they survive restarts and every proxy process using the same file
+shares them. the file is a fixed size hash table of slots pointing into an append only region of float64 values,
+float64 so a cached vector is sent back with the exact numbers the server sent
+
+    header      magic, number of slots, size of the data region, end of the data written, entries
+    slots       key (16 bytes of sha256), offset in the data region, dimension (0 for an empty slot)
+    data        the vectors
+
+the data region is not reclaimed, when it is full the whole cache is emptied and starts over.
+other processes are kept out with flock, threads of this process with a lock
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+from array import array
+
+try:
+    import fcntl
+except ImportError:  # windows, the file can only be used by one process at a time
+    fcntl = None
+
+from ollama_proxy_server.ollama_logger import get_logger
+from ollama_proxy_server.ollama_queues.residency import normalize_model
+
+EMBED_PATHS = ("/api/embed", "/api/embeddings")
+# request fields that change the vectors
+_KEY_FIELDS = ("options", "truncate", "dimensions")
+
+_MAGIC = b"OPXEMB01"
+_HEADER = struct.Struct("<8sQQQQ")
+_HEADER_SIZE = 64
+_SLOT = struct.Struct("<16sQI4x")
+# slots probed after the one a key hashes to
+_PROBES = 16
+_VALUE_SIZE = 8
+
+
+class _FileLock:
+    """flock on the cache file, does nothing where there is no fcntl"""
+
+    def __init__(self, fileno, exclusive):
+        self._fileno = fileno
+        self._exclusive = exclusive
+
+    def __enter__(self):
+        if fcntl is not None:
+            fcntl.flock(self._fileno, fcntl.LOCK_EX if self._exclusive else fcntl.LOCK_SH)
+
+    def __exit__(self, *exc):
+        if fcntl is not None:
+            fcntl.flock(self._fileno, fcntl.LOCK_UN)
+
+
+class EmbeddingCache:  # pylint: disable=too-many-instance-attributes
+    """
+    memory mapped store of embedding vectors
+
+        path:       the cache file, created if missing, an existing file keeps its own sizes
+        max_bytes:  size of the data region of a new file
+        slots:      number of slots of a new file, max_bytes / 4096 if None
+    """
+
+    def __init__(self, path, max_bytes=256 * 1024 * 1024, slots=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._log = get_logger(__name__, "INFO")
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self._file = open(path, "a+b")  # noqa: SIM115 pylint: disable=consider-using-with
+        try:
+            with _FileLock(self._file.fileno(), True):
+                self._open(max_bytes - max_bytes % _VALUE_SIZE, slots or max(1024, max_bytes // 4096))
+        except BaseException:
+            self._file.close()
+            raise
+
+    def _open(self, data_size, slots):
+        """maps the file, initializes it if it is new or not a cache file, must hold the file lock"""
+        self._file.seek(0)
+        header = self._file.read(_HEADER_SIZE)
+        if len(header) == _HEADER_SIZE and header[:8] == _MAGIC:
+            _, slots, data_size, _, _ = _HEADER.unpack_from(header)
+            fresh = False
+        else:
+            if header:
+                self._log.warning("%s is not an embedding cache, starting a new one", self.path)
+            fresh = True
+        self._slots = slots
+        self._data_start = _HEADER_SIZE + slots * _SLOT.size
+        self._data_start += -self._data_start % _VALUE_SIZE
+        self._data_size = data_size
+        size = self._data_start + data_size
+        if fresh:
+            self._file.truncate(0)
+        if os.fstat(self._file.fileno()).st_size < size:
+            # sparse, pages are only used once written
+            self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+        self._values = memoryview(self._map)[self._data_start :].cast("d")
+        if fresh:
+            _HEADER.pack_into(self._map, 0, _MAGIC, slots, data_size, 0, 0)
+
+    @staticmethod
+    def key(model, text, params=""):
+        """cache key of one input text, params are the other request fields that change the vector"""
+        return hashlib.sha256(f"{normalize_model(model)}\0{params}\0{text}".encode()).digest()[:16]
+
+    def _find(self, key):
+        """(position of the slot, offset, dim) of key, or of the slot to put it in with offset None"""
+        start = int.from_bytes(key[:8], "little") % self._slots
+        for probe in range(_PROBES):
+            slot = _HEADER_SIZE + (start + probe) % self._slots * _SLOT.size
+            slot_key, offset, dim = _SLOT.unpack_from(self._map, slot)
+            if dim == 0:
+                return slot, None, 0
+            if slot_key == key:
+                return slot, offset, dim
+        # all taken, the first one is replaced
+        return _HEADER_SIZE + start * _SLOT.size, None, 0
+
+    def get_many(self, keys):
+        """list of the vectors of keys, None for the ones not cached"""
+        found = []
+        with self._lock, _FileLock(self._file.fileno(), False):
+            for key in keys:
+                _, offset, dim = self._find(key)
+                found.append(self._values[offset : offset + dim].tolist() if offset is not None else None)
+        return found
+
+    def put_many(self, items):
+        """stores (key, vector) pairs, the vectors are sequences of floats"""
+        with self._lock, _FileLock(self._file.fileno(), True):
+            _, _, _, end, entries = _HEADER.unpack_from(self._map, 0)
+            for key, vector in items:
+                if not vector or len(vector) * _VALUE_SIZE > self._data_size:
+                    continue
+                if (end + len(vector)) * _VALUE_SIZE > self._data_size:
+                    self._log.info("embedding cache %s is full, emptying it", self.path)
+                    self._clear()
+                    end = entries = 0
+                slot, offset, _ = self._find(key)
+                if offset is None and _SLOT.unpack_from(self._map, slot)[2] == 0:
+                    entries += 1
+                self._values[end : end + len(vector)] = array("d", vector)
+                # the key last so a slot is never seen with a half written vector
+                _SLOT.pack_into(self._map, slot, bytes(16), end, len(vector))
+                self._map[slot : slot + 16] = key
+                end += len(vector)
+            _HEADER.pack_into(self._map, 0, _MAGIC, self._slots, self._data_size, end, entries)
+
+    def _clear(self):
+        """empties the slots, must hold both locks"""
+        block = bytes(min(1024 * 1024, self._data_start - _HEADER_SIZE))
+        for pos in range(_HEADER_SIZE, self._data_start, len(block)):
+            end = min(pos + len(block), self._data_start)
+            self._map[pos:end] = block[: end - pos]
+
+    def clear(self):
+        """forgets all vectors"""
+        with self._lock, _FileLock(self._file.fileno(), True):
+            self._clear()
+            _HEADER.pack_into(self._map, 0, _MAGIC, self._slots, self._data_size, 0, 0)
+
+    def lookup(self, path, body):
+        """
+        splits an embedding request in cached and missing inputs
+
+            path:   /api/embed or /api/embeddings
+            body:   the decoded request body
+
+        returns an EmbedLookup, None if the request can not be cached
+        """
+        if path not in EMBED_PATHS or not isinstance(body, dict) or not isinstance(body.get("model"), str):
+            return None
+        field = "input" if path == "/api/embed" else "prompt"
+        texts = body.get(field)
+        texts = [texts] if isinstance(texts, str) else texts
+        if not texts or not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+            return None
+        # /api/embed normalizes the vectors, /api/embeddings does not
+        params = json.dumps([path] + [body.get(name) for name in _KEY_FIELDS], sort_keys=True)
+        keys = [self.key(body["model"], text, params) for text in texts]
+        return EmbedLookup(self, path, body, field, texts, keys, self.get_many(keys))
+
+    def count(self, hits, misses, bytes_saved):
+        """adds to the counters reported by stats"""
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+            self.bytes_saved += bytes_saved
+
+    def stats(self):
+        """hit rate and bytes saved in this process, entries and bytes used in the file"""
+        _, _, _, end, entries = _HEADER.unpack_from(self._map, 0)
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "bytes_saved": self.bytes_saved,
+            "entries": entries,
+            "bytes": end * _VALUE_SIZE,
+        }
+
+    def close(self):
+        """unmaps the file"""
+        self._values.release()
+        self._map.close()
+        self._file.close()
+
+
+class EmbedLookup:  # pylint: disable=too-many-instance-attributes
+    """
+    one embedding request split in the inputs found in the cache and the ones the server has to compute
+
+    missing is the list of the indexes of the inputs not cached, if it is empty merge(None) is the whole response
+    """
+
+    def __init__(self, cache, path, body, field, texts, keys, vectors):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self._cache = cache
+        self._path = path
+        self._body = body
+        self._field = field
+        self._texts = texts
+        self._keys = keys
+        self._vectors = vectors
+        self.missing = [i for i, vector in enumerate(vectors) if vector is None]
+
+    def upstream_request(self):
+        """the decoded request asking only for the missing inputs"""
+        body = dict(self._body)
+        texts = [self._texts[i] for i in self.missing]
+        body[self._field] = texts if self._field == "input" else texts[0]
+        return body
+
+    def upstream_body(self):
+        """the request body asking only for the missing inputs"""
+        return json.dumps(self.upstream_request()).encode("utf-8")
+
+    def merge(self, upstream):
+        """
+        the response with the vectors in the order of the request, the new vectors are cached
+
+            upstream:   decoded response of the server to upstream_body, None when nothing is missing
+
+        raises ValueError if the server answered something else than the vectors asked for
+        """
+        out = {}
+        if upstream is not None:
+            new = upstream.get("embeddings") if self._path == "/api/embed" else [upstream.get("embedding")]
+            if not isinstance(new, list) or len(new) != len(self.missing) or not all(isinstance(vector, list) and vector for vector in new):
+                raise ValueError("the server did not answer with one vector per input")
+            try:
+                values = [array("d", vector) for vector in new]
+            except TypeError as ex:
+                raise ValueError("the server answered vectors that are not numbers") from ex
+            self._cache.put_many(zip((self._keys[i] for i in self.missing), values))
+            for i, vector in zip(self.missing, new):
+                self._vectors[i] = vector
+            out = dict(upstream)
+        missing = set(self.missing)
+        # the text not sent to the server and the vector not sent back
+        saved = sum(len(text.encode("utf-8")) + len(self._vectors[i]) * _VALUE_SIZE for i, text in enumerate(self._texts) if i not in missing)
+        self._cache.count(len(self._texts) - len(missing), len(missing), saved)
+        if self._path == "/api/embed":
+            out.setdefault("model", self._body["model"])
+            out["embeddings"] = self._vectors
+        else:
+            out["embedding"] = self._vectors[0]
+        return out
@@ -0,0 +1,84 @@
+"""
+failover of generation requests to another server
+
+a request whose server can not be reached or answers with a 5xx is sent to another server that can take it, as long
+as nothing has been sent to the client yet. the failed server gets the failure in its health and the request moves
+to a slot on a server it has not tried.
+
+retries add load exactly when the cluster is struggling, the retry budget keeps them to a fraction of the requests:
+every request adds ratio to the budget, min_per_second is added every second so a quiet proxy can still fail over,
+and every retry takes one. once the budget is spent the error of the server goes to the client
+"""
+
+import threading
+import time
+
+# seconds a retry waits for a slot on another server before the error goes to the client
+RETRY_WAIT = 5.0
+
+
+def retryable_status(status):
+    """if a request answered with status can be sent to another server"""
+    return status >= 500
+
+
+def unhealthy_status(status):
+    """if status says the server is in trouble, a 500 can be the fault of the request"""
+    return status in (502, 503, 504)
+
+
+class RetryBudget:  # pylint: disable=too-many-instance-attributes
+    """
+    how many failed requests are sent to another server
+
+        max_retries:    other servers tried per request, 0 disables failover
+        ratio:          retries per request the budget grows by
+        min_per_second: retries the budget grows by every second
+        burst:          max retries saved in the budget
+    """
+
+    def __init__(self, max_retries=1, ratio=0.2, min_per_second=1.0, burst=10.0):
+        self.max_retries = max_retries
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.burst = burst
+        self._level = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.denied = 0
+
+    def _refill(self, now):
+        self._level = min(self.burst, self._level + (now - self._updated) * self.min_per_second)
+        self._updated = now
+
+    def request(self, now=None):
+        """a request was sent, it adds ratio to the budget"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self.requests += 1
+            self._refill(now)
+            self._level = min(self.burst, self._level + self.ratio)
+
+    def allow(self, attempt, now=None):
+        """
+        if the attempt-th retry of a request can be sent, it is taken from the budget
+
+            attempt:    retries of the request so far
+        """
+        if attempt >= self.max_retries:
+            return False
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._refill(now)
+            if self._level < 1:
+                self.denied += 1
+                return False
+            self._level -= 1
+            self.retries += 1
+            return True
+
+    def stats(self):
+        """requests sent, retries sent and retries over the budget"""
+        return {"requests": self.requests, "retries": self.retries, "denied": self.denied}
@@ -0,0 +1,142 @@
+"""
+reads a few top level fields of a json object without decoding the rest
+
+the proxy only needs model and stream to route a request, multimodal requests carry megabytes of base64 images
+that json.loads would turn into python strings for nothing. the values we do not need are skipped with bytes.find
+and a regex, only the wanted values are decoded. anything unexpected falls back to json.loads
+
+skipping costs a python loop iteration per string or bracket, so small bodies and bodies made of many small values,
+like long chat histories, are cheaper to give to json.loads
+"""
+
+import json
+import re
+
+ROUTING_FIELDS = ("model", "stream")
+# smaller bodies go straight to json.loads
+PEEK_MIN_SIZE = 16 * 1024
+# strings and brackets skipped per byte of body before giving up
+_TOKENS_PER_BYTE = 1 / 256
+
+_NOT_WS = re.compile(rb"[^ \t\n\r]")
+_STRUCTURE = re.compile(rb'["\[\]{}]')
+_SCALAR_END = re.compile(rb"[ \t\n\r,}\]]")
+_CLOSING = {ord("{"): ord("}"), ord("["): ord("]")}
+
+
+class PeekError(ValueError):
+    """the body is not something the fast path understands"""
+
+
+def _skip_ws(buf, pos):
+    match = _NOT_WS.search(buf, pos)
+    if match is None:
+        raise PeekError("unexpected end")
+    return match.start()
+
+
+def _skip_string(buf, pos):
+    """pos is on the opening quote, returns the position after the closing quote"""
+    end = pos + 1
+    while True:
+        end = buf.find(b'"', end)
+        if end < 0:
+            raise PeekError("unterminated string")
+        backslash = end - 1
+        while buf[backslash] == 0x5C:
+            backslash -= 1
+        if (end - 1 - backslash) % 2 == 0:
+            return end + 1
+        end += 1
+
+
+def _skip_value(buf, pos, budget):
+    """
+    pos is on the first byte of a value, returns the position after it and what is left of budget
+    budget is the number of strings and brackets we are still willing to skip
+    """
+    first = buf[pos]
+    if first == 0x22:
+        return _skip_string(buf, pos), budget
+    if first in _CLOSING:
+        expected = [_CLOSING[first]]
+        pos += 1
+        while expected:
+            match = _STRUCTURE.search(buf, pos)
+            if match is None:
+                raise PeekError("unterminated container")
+            pos = match.start()
+            budget -= 1
+            if budget < 0:
+                raise PeekError("too many values to skip")
+            char = buf[pos]
+            if char == 0x22:
+                pos = _skip_string(buf, pos)
+                continue
+            if char in _CLOSING:
+                expected.append(_CLOSING[char])
+            elif char != expected.pop():
+                raise PeekError("mismatched brackets")
+            pos += 1
+        return pos, budget
+    match = _SCALAR_END.search(buf, pos)
+    if match is None:
+        raise PeekError("unexpected end")
+    return match.start(), budget
+
+
+def _peek(buf, fields, limit_skips=True):
+    found = {}
+    budget = int(len(buf) * _TOKENS_PER_BYTE) + 16 if limit_skips else len(buf)
+    pos = _skip_ws(buf, 0)
+    if buf[pos] != 0x7B:
+        raise PeekError("not an object")
+    pos = _skip_ws(buf, pos + 1)
+    if buf[pos] == 0x7D:
+        return found, pos + 1
+    while True:
+        if buf[pos] != 0x22:
+            raise PeekError("expected a key")
+        end = _skip_string(buf, pos)
+        key = json.loads(buf[pos:end])
+        pos = _skip_ws(buf, end)
+        if buf[pos] != 0x3A:
+            raise PeekError("expected a colon")
+        pos = _skip_ws(buf, pos + 1)
+        end, budget = _skip_value(buf, pos, budget)
+        if key in fields:
+            if key in found:
+                # json.loads keeps the last one, let it decide
+                raise PeekError(f"duplicate key {key}")
+            found[key] = json.loads(buf[pos:end])
+        pos = _skip_ws(buf, end)
+        if buf[pos] == 0x2C:
+            pos = _skip_ws(buf, pos + 1)
+        elif buf[pos] == 0x7D:
+            return found, pos + 1
+        else:
+            raise PeekError("expected a comma")
+
+
+def peek_json(body, fields=ROUTING_FIELDS, limit_skips=True):
+    """
+    the top level fields of a json object that are in fields
+
+        body:           the request body as bytes or a memory map
+        fields:         the keys to extract
+        limit_skips:    give up and use json.loads when there are many values to skip
+
+    returns a dict with the keys found
+    raises json.JSONDecodeError or ValueError like json.loads when the body is not a json object
+    """
+    if len(body) >= PEEK_MIN_SIZE:
+        try:
+            found, end = _peek(body, fields, limit_skips)
+            if _NOT_WS.search(body, end) is None:
+                return found
+        except (PeekError, IndexError, ValueError):
+            pass
+    data = json.loads(body if isinstance(body, (bytes, bytearray)) else body[:])
+    if not isinstance(data, dict):
+        raise ValueError("the body is not a json object")  # noqa: TRY004
+    return {key: data[key] for key in fields if key in data}
@@ -9,19 +9,15 @@ and routes the requests to the right server in order to minimize the charge of t
 import configparser
 import argparse
 import json
-import datetime
 import uuid
 
 # import queue
-import csv
 import logging
 
-from pathlib import Path
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from socketserver import ThreadingMixIn
 from urllib.parse import urlparse, parse_qs
 
-import jwt
 import requests
 
 # logging.basicConfig(
@@ -30,7 +26,23 @@ import requests
 #        level=logging.INFO)
 
 from ollama_proxy_server import ollama_queues
+from ollama_proxy_server.access_log import AccessLog
+from ollama_proxy_server.async_server import AsyncProxyServer
+from ollama_proxy_server.auth import TokenCache, parse_weights, request_tenant, validate_auth_header
+from ollama_proxy_server.cluster import AGGREGATED_PATHS, MODEL_PATHS, ClusterView
+from ollama_proxy_server.embed_batcher import BATCH_PATH, EmbedBatcher, batch_key
+from ollama_proxy_server.embedding_cache import EMBED_PATHS, EmbeddingCache
+from ollama_proxy_server.failover import RETRY_WAIT, RetryBudget, retryable_status
+from ollama_proxy_server.json_peek import ROUTING_FIELDS
+from ollama_proxy_server.metrics import MetricsServer, ProxyMetrics, RequestTimer
+from ollama_proxy_server.ollama_queues.admission import TIMEOUT_HEADER, Overloaded, parse_bounds, parse_timeout
 from ollama_proxy_server.ollama_logger import get_logger
+from ollama_proxy_server.rate_limit import LIMITED_PATHS, RateLimited, RateLimiter, UsageMeter, count_tokens, get_limits, retry_after_header
+from ollama_proxy_server.reload import ConfigReloader
+from ollama_proxy_server.relay import DEFAULT_BUFFER_SIZE, coalesce_window, relay_response
+from ollama_proxy_server.request_body import DEFAULT_SPOOL_THRESHOLD, RequestBody
+from ollama_proxy_server.response_cache import CACHE_FIELDS, ResponseCache, cache_key, is_deterministic
+from ollama_proxy_server.upstream_pool import UpstreamPool
 from ollama_proxy_server.envdefault import EnvDefault
 
 logging.basicConfig(
@@ -45,7 +57,7 @@ def get_config(filename, readf="read"):
     """
     Read config from config file and parse it
     """
-    config = configparser.ConfigParser({"model_white_list": "[]", "model_black_list": "[]"})
+    config = configparser.ConfigParser({"model_white_list": "[]", "model_black_list": "[]", "max_concurrency": "0", "weight": "1"})
     getattr(config, readf)(filename)
     return [
         (
@@ -56,6 +68,10 @@ def get_config(filename, readf="read"):
                 # "last_model": (None, datetime.datetime.now()),
                 "model_wl": json.loads(config.get(name, "model_white_list")) or None,
                 "model_bl": json.loads(config.get(name, "model_black_list")) or None,
+                # concurrent requests sent to the server, --max_concurrency if 0
+                "max_concurrency": config.getint(name, "max_concurrency") or None,
+                # relative capacity, a server with weight 2 gets twice the requests in flight of one with 1
+                "weight": config.getfloat(name, "weight"),
                 # add last seen so we pause servers that are offline
             },
         )
@@ -63,11 +79,6 @@ def get_config(filename, readf="read"):
     ]
 
 
-def jwt_decode(key, encoded):
-    """decode jwt data with key"""
-    return jwt.decode(encoded, key, audience="urn:ollama_proxy", algorithms="HS256")
-
-
 # Read the authorized users and their keys from a file
 def get_authorized_users(filename):
     """
@@ -87,7 +98,7 @@ def get_authorized_users(filename):
     return authorized_users
 
 
-def main():
+def main():  # pylint: disable=too-many-statements
     """
     Main function for proxy
     """
@@ -105,22 +116,268 @@ def main():
     )
     parser.add_argument("--config", default="config.ini", help="Path to the authorized users list")
     parser.add_argument("--log_path", default="access_log.txt", help="Path to the access log file")
+    parser.add_argument("--log_queue_size", type=int, default=10000, help="Access log records kept in memory before new ones are dropped")
+    parser.add_argument("--log_max_bytes", type=int, default=0, help="Rotate the access log when it grows past this many bytes, 0 never")
+    parser.add_argument("--log_rotate_daily", action="store_true", help="Rotate the access log every day")
+    parser.add_argument("--log_backup_count", type=int, default=5, help="Number of access logs kept when rotating by size")
+    parser.add_argument("--token_cache_size", type=int, default=4096, help="Number of verified auth tokens remembered, 0 verifies every request")
     parser.add_argument("--users_list", default="authorized_users.txt", help="Path to the config file")
     parser.add_argument("--port", type=int, default=8000, help="Port number for the server")
     parser.add_argument("-d", "--deactivate_security", action="store_true", help="Deactivates security")
+    parser.add_argument(
+        "--engine",
+        choices=["threaded", "asyncio"],
+        default="threaded",
+        help="Serve with one thread per request (threaded) or all requests on one event loop (asyncio)",
+    )
+    parser.add_argument("--pool_size", type=int, default=10, help="Max idle keep-alive connections kept per backend server")
+    parser.add_argument("--ps_interval", type=float, default=10.0, help="Seconds between polls of /api/ps on the servers to see loaded models, 0 disables")
+    parser.add_argument(
+        "--health_interval",
+        type=float,
+        default=10.0,
+        help="Seconds between health probes of the servers, unhealthy servers are not scheduled, 0 disables health checks",
+    )
+    parser.add_argument("--health_failures", type=int, default=5, help="Consecutive failed requests or probes that take a server out")
+    parser.add_argument("--health_cooldown", type=float, default=30.0, help="Seconds before a server taken out is probed back in")
+    parser.add_argument(
+        "--outlier_factor",
+        type=float,
+        default=0.0,
+        help="Take out a server whose average time to first byte is this many times the median of the others, 0 disables",
+    )
+    parser.add_argument("--relay_buffer_size", type=int, default=DEFAULT_BUFFER_SIZE, help="Size in bytes of the buffer used to relay responses")
+    parser.add_argument(
+        "--coalesce_ms",
+        type=float,
+        default=0.0,
+        help="Merge streamed ndjson lines arriving within this many ms into one write, 0 writes every token at once (clients can override with X-Proxy-Coalesce-Ms)",
+    )
+    parser.add_argument(
+        "--reload_interval",
+        type=float,
+        default=0.0,
+        help="Seconds between checks if the config or users file changed, 0 only reloads them on SIGHUP",
+    )
+    parser.add_argument("--metrics_port", type=int, default=0, help="Port of the admin server with prometheus metrics on /metrics, 0 disables it")
+    parser.add_argument(
+        "--spool_threshold",
+        type=int,
+        default=DEFAULT_SPOOL_THRESHOLD,
+        help="Request bodies larger than this many bytes are kept in a temp file instead of memory",
+    )
+    parser.add_argument("--cluster_cache_ttl", type=float, default=5.0, help="Seconds the merged /api/tags and /api/ps of all servers are cached")
+    parser.add_argument(
+        "--response_cache_mb",
+        type=int,
+        default=0,
+        help="Memory in MB for caching responses to requests with temperature 0 and a seed, 0 disables the cache",
+    )
+    parser.add_argument("--response_cache_ttl", type=float, default=3600.0, help="Seconds a cached response is replayed")
+    parser.add_argument("--embedding_cache", default=None, help="Path of a file caching the vectors of /api/embed and /api/embeddings, shared by proxies using it")
+    parser.add_argument("--embedding_cache_mb", type=int, default=256, help="Size in MB of the vectors kept in a new embedding cache file")
+    parser.add_argument(
+        "--embed_batch_ms",
+        type=float,
+        default=0.0,
+        help="Send the /api/embed requests for the same model arriving within this many ms as one request, 0 disables batching",
+    )
+    parser.add_argument("--embed_batch_size", type=int, default=64, help="Max inputs sent to a server in one batched /api/embed request")
+    parser.add_argument("--pool_idle_timeout", type=float, default=60.0, help="Seconds a backend can be unused before its connections are closed")
+    parser.add_argument("--max_concurrency", type=int, default=1, help="Requests sent to a server at the same time when its config has no max_concurrency")
+    parser.add_argument(
+        "--adaptive_concurrency",
+        action="store_true",
+        help="Lower the concurrency of a server when its time to first byte goes up and raise it again up to its max_concurrency",
+    )
+    parser.add_argument(
+        "--user_weight",
+        action="append",
+        default=[],
+        metavar="NAME=WEIGHT",
+        help="Share of the servers a user or tenant gets when requests are waiting, 1 by default, can be given several times",
+    )
+    parser.add_argument("--tenant_claim", default="tenant", help="JWT claim naming the tenant a user's requests are queued as, users without it are their own tenant")
+    parser.add_argument(
+        "--limits",
+        default=None,
+        help="Path of a file with the requests per second, concurrency and token quota of users and tenants, JWT claims override it",
+    )
+    parser.add_argument("--max_waiting", type=int, default=0, help="Requests waiting for a server at the same time before new ones get a 503, 0 no limit")
+    parser.add_argument("--max_wait", type=float, default=0.0, help="Seconds a request waits for a server before it gets a 503, 0 no limit")
+    parser.add_argument(
+        "--model_queue",
+        action="append",
+        default=[],
+        metavar="MODEL=MAX_WAITING:MAX_WAIT",
+        help="Requests waiting for a model and seconds they wait, either can be left out, can be given several times",
+    )
+    parser.add_argument("--max_retries", type=int, default=1, help="Other servers a request is sent to when its server fails before answering, 0 disables failover")
+    parser.add_argument("--retry_budget", type=float, default=0.2, help="Retries allowed per request sent, so failover does not overload the servers left")
     args = parser.parse_args()
     _LOG.debug(args)
+    try:
+        user_weights = parse_weights(args.user_weight)
+        rate_limiter = RateLimiter(*get_limits(args.limits)) if args.limits else RateLimiter()
+        admission = ollama_queues.AdmissionControl(args.max_waiting, args.max_wait, parse_bounds(args.model_queue))
+        retry_budget = RetryBudget(args.max_retries, args.retry_budget)
+    except (ValueError, configparser.Error) as ex:
+        parser.error(str(ex))
     servers = get_config(args.config)
     _LOG.debug(servers)
 
-    server_queue = ollama_queues.ModelLoadedQueue(servers)
+    residency = ollama_queues.ModelResidency(servers, interval=args.ps_interval).start() if args.ps_interval > 0 else None
+    health = None
+    if args.health_interval > 0:
+        health = ollama_queues.HealthMonitor(failures=args.health_failures, cooldown=args.health_cooldown, outlier_factor=args.outlier_factor)
+    server_queue = ollama_queues.ModelLoadedQueue(
+        servers,
+        max_queue_size=args.max_concurrency,
+        residency=residency,
+        adaptive=args.adaptive_concurrency,
+        health=health,
+        admission=admission,
+    )
+    prober = ollama_queues.HealthProber(server_queue, interval=args.health_interval).start() if health is not None else None
+    upstream_pool = UpstreamPool(pool_size=args.pool_size, idle_timeout=args.pool_idle_timeout)
+    access_log = AccessLog(
+        args.log_path,
+        max_queue=args.log_queue_size,
+        max_bytes=args.log_max_bytes,
+        daily=args.log_rotate_daily,
+        backup_count=args.log_backup_count,
+    ).start()
+    response_cache = ResponseCache(args.response_cache_mb * 1024 * 1024, args.response_cache_ttl) if args.response_cache_mb > 0 else None
+    embedding_cache = EmbeddingCache(args.embedding_cache, args.embedding_cache_mb * 1024 * 1024) if args.embedding_cache else None
+    cluster = ClusterView(server_queue, upstream_pool, ttl=args.cluster_cache_ttl)
+
+    def request_with_failover(server, model, method, path, log_access=None, **kwargs):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        """
+        sends a request that does not take a slot, when its server can not be reached or answers with a 5xx it is
+        sent to another server that can take model, as long as the retry budget allows it
+
+        returns (server, response) of the server that answered last
+        """
+        tried = set()
+        retry_budget.request()
+        while True:
+            try:
+                response = upstream_pool.request(server[0], method, server[1]["url"] + path, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                other = cluster.failover(server, tried, model, retry_budget)
+                if other is None:
+                    raise
+            else:
+                if not retryable_status(response.status_code):
+                    return server, response
+                other = cluster.failover(server, tried, model, retry_budget, response.status_code)
+                if other is None:
+                    return server, response
+                response.close()
+            if log_access is not None:
+                log_access(event="retry", access="Authorized", server=server)
+            server = other
+
+    def send_embed_batch(request):
+        """sends one batch of embed requests to a server that has the model"""
+        server = cluster.server_for(request["model"])
+        if server is None:
+            raise ConnectionError("no server available")
+        _, response = request_with_failover(server, request["model"], "POST", BATCH_PATH, data=json.dumps(request).encode("utf-8"), timeout=(5, 120))
+        with response:
+            return response.status_code, response.headers.get("Content-Type", "application/json"), response.content
+
+    embed_batcher = EmbedBatcher(send_embed_batch, args.embed_batch_size, args.embed_batch_ms / 1000) if args.embed_batch_ms > 0 else None
+
+    metrics = None
+    metrics_server = None
+    if args.metrics_port > 0:
+        metrics = ProxyMetrics(server_queue)
+        if response_cache is not None:
+            metrics.add_stats("response_cache", "Counters of the response cache", response_cache.stats)
+        if embedding_cache is not None:
+            metrics.add_stats("embedding_cache", "Counters of the embedding cache", embedding_cache.stats)
+        if embed_batcher is not None:
+            metrics.add_stats("embed_batching", "Embed requests received and batches sent", embed_batcher.stats)
+        metrics.add_stats("rate_limit", "Requests admitted and rejected by the per user limits", rate_limiter.stats)
+        metrics.add_stats("admission", "Requests let in to wait for a server, turned away, timed out and waiting", admission.stats)
+        metrics.add_stats("failover", "Requests sent, retries on another server and retries over the budget", retry_budget.stats)
+        metrics.add_stats("access_log", "Access log records queued, written and dropped because the disk did not keep up", access_log.stats)
+        metrics.add_server_stats("upstream_pool", "Connections opened, requests sent and requests sent on a reused connection per server", upstream_pool.stats)
+        metrics_server = MetricsServer(metrics.registry, port=args.metrics_port).start()
+        _LOG.info("Serving metrics on port %s", args.metrics_port)
 
     authorized_users = get_authorized_users(args.users_list)
     deactivate_security = args.deactivate_security
     jwt_key = args.jwt_key
+    token_cache = TokenCache(args.token_cache_size) if args.token_cache_size > 0 else None
+    if metrics is not None and token_cache is not None:
+        metrics.add_stats("token_cache", "Hits, misses and size of the cache of checked tokens", token_cache.stats)
+    proxy = None
+
+    def set_authorized_users(users):
+        """swaps the user table, requests already authenticated are not affected"""
+        nonlocal authorized_users
+        authorized_users = users
+        if proxy is not None:
+            proxy.authorized_users = users
+
+    reloader = ConfigReloader(
+        args.config,
+        args.users_list,
+        server_queue,
+        servers,
+        get_config,
+        get_authorized_users,
+        on_users=set_authorized_users,
+        on_server_removed=residency.forget if residency is not None else None,
+        interval=args.reload_interval,
+    ).start(authorized_users)
     _LOG.info("Ollama Proxy server")
     _LOG.info("Author: ParisNeo")
 
+    if args.engine == "asyncio":
+        proxy = AsyncProxyServer(
+            server_queue,
+            authorized_users,
+            jwt_key=jwt_key,
+            deactivate_security=deactivate_security,
+            access_log=access_log,
+            read_size=args.relay_buffer_size,
+            pool_size=args.pool_size,
+            pool_idle_timeout=args.pool_idle_timeout,
+            coalesce_ms=args.coalesce_ms,
+            token_cache=token_cache,
+            user_weights=user_weights,
+            tenant_claim=args.tenant_claim,
+            metrics=metrics,
+            spool_threshold=args.spool_threshold,
+            cluster=cluster,
+            response_cache=response_cache,
+            embedding_cache=embedding_cache,
+            embed_batch_wait=args.embed_batch_ms / 1000,
+            embed_batch_size=args.embed_batch_size,
+            rate_limiter=rate_limiter,
+            retry_budget=retry_budget,
+        )
+        if metrics is not None:
+            metrics.add_server_stats("async_pool", "Connections opened, requests sent and requests sent on a reused connection per server by the asyncio engine", proxy.pool_stats)
+        _LOG.info("Running asyncio server on port %s", args.port)
+        try:
+            proxy.serve_forever("", args.port)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            reloader.stop()
+            if prober is not None:
+                prober.stop()
+            if metrics_server is not None:
+                metrics_server.stop()
+            if embedding_cache is not None:
+                embedding_cache.close()
+            access_log.close()
+        return
+
     class RequestHandler(BaseHTTPRequestHandler):
         """
         Request handler for the proxy server
@@ -130,6 +387,7 @@ def main():
         _response_sent = False
         _user = "unknown"
         _jwt_payload = None
+        _body = None
 
         # def __init__(self, request, client_address, server):
         #     super().__init__(request, client_address, server)
@@ -147,40 +405,22 @@ def main():
             """
             Logs acccess to file with extra info
             """
-            log_file_path = Path(args.log_path)
-            fieldnames = [
-                "time_stamp",
-                "request_id",
-                "event",
-                "user_name",
-                "ip_address",
-                "access",
-                "server",
-                "nb_queued_requests_on_server",
-                "error",
-            ]
-
-            if not log_file_path.exists():
-                with open(log_file_path, mode="w", newline="", encoding="utf-8") as csvfile:
-                    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                    writer.writeheader()
-
-            with open(log_file_path, mode="a", newline="", encoding="utf-8") as csvfile:
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                row = {
-                    "time_stamp": str(datetime.datetime.now()),
-                    "request_id": rid,
-                    "event": event,
-                    "user_name": self._user,
-                    "ip_address": ip_address,
-                    "access": access,
-                    "server": server,
-                    "nb_queued_requests_on_server": nb_queued_requests_on_server,
-                    "error": error,
-                }
-                writer.writerow(row)
-
-        def _send_response(self, response):
+            access_log.log(
+                rid=rid,
+                event=event,
+                user_name=self._user,
+                ip_address=ip_address,
+                access=access,
+                server=server,
+                nb_queued_requests_on_server=nb_queued_requests_on_server,
+                error=error,
+            )
+
+        def _coalesce_window(self):
+            """coalescing window in seconds, clients can set it with the X-Proxy-Coalesce-Ms header"""
+            return coalesce_window(self.headers.get("X-Proxy-Coalesce-Ms"), args.coalesce_ms)
+
+        def _send_response(self, response, stream=True, window=0.0, on_first_write=None, wfile=None):  # pylint: disable=too-many-arguments,too-many-positional-arguments
             self.send_response(response.status_code)
             self._response_sent = True
             for key, value in response.headers.items():
@@ -194,13 +434,149 @@ def main():
             self.end_headers()
 
             try:
-                for chunk in response.iter_content(chunk_size=1024):
-                    if chunk:
-                        self.wfile.write(chunk)
-                        self.wfile.flush()
+                relay_response(response, wfile or self.wfile, stream=stream, window=window, buffer_size=args.relay_buffer_size, on_first_write=on_first_write)
+            except BrokenPipeError:
+                _LOG.exception("issue while writing response")
+
+        def _send_retry_after(self, status, message, retry_after):
+            """an error telling the client when to try again"""
+            body = message.encode("utf-8")
+            self.send_response(status)
+            self._response_sent = True
+            self.send_header("Retry-After", retry_after_header(retry_after))
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _failover(self, server, tried, queue_filter, log_access):
+            """
+            moves a request whose server failed before answering to a server it has not tried, if the retry budget allows it
+
+            returns the new server, the slot of the failed one is released, or None to send the error to the client
+            """
+            if self._response_sent or queue_filter is None or not retry_budget.allow(len(tried)):
+                return None
+            try:
+                other = server_queue.enqueue(dict(queue_filter, exclude=tried | {server[0]}), RETRY_WAIT)
+            except TimeoutError:
+                return None
+            if other is None:
+                return None
+            log_access(event="gen_retry", access="Authorized", server=server)
+            server_queue.dequeue(server[0], False)
+            tried.add(server[0])
+            return other
+
+        def _send_bytes(self, data, content_type, status=200):
+            self.send_response(status)
+            self._response_sent = True
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            if self.command != "HEAD":
+                self.wfile.write(data)
+
+        def _send_json(self, obj):
+            self._send_bytes(json.dumps(obj).encode("utf-8"), "application/json; charset=utf-8")
+
+        def _send_cached(self, cached):
+            self.send_response(200)
+            self._response_sent = True
+            if cached.content_type:
+                self.send_header("Content-Type", cached.content_type)
+            self.end_headers()
+            try:
+                # chunk by chunk like the original response
+                for chunk in cached.chunks:
+                    self.wfile.write(chunk)
+                    self.wfile.flush()
             except BrokenPipeError:
                 _LOG.exception("issue while writing response")
 
+        def _send_embeddings(self, lookup, response):
+            """sends the cached vectors with the ones the server computed, returns the tokens the server counted"""
+            try:
+                merged = lookup.merge(response.json())
+            except ValueError:
+                _LOG.warning("could not merge the embeddings of %s", self.path)
+                self._send_bytes(response.content, response.headers.get("Content-Type", "application/json"))
+                return 0
+            self._send_json(merged)
+            return count_tokens(response.content)
+
+        def _send_embed_batch(self, request, lookup, log_access):
+            """sends an /api/embed request together with the ones arriving at the same time, returns its share of the tokens"""
+            log_access(event="embed_batch", access="Authorized")
+            try:
+                status, content_type, data = embed_batcher.submit(request)
+            except Exception as ex:  # noqa: BLE001 the client gets an error whatever the batch raised
+                _LOG.exception("embed batch failed")
+                log_access(event="request_error", access="Authorized", error=ex)
+                self.send_error(502, "the remote server could not be reached")
+                return 0
+            if status != 200:
+                self._send_bytes(data, content_type, status)
+                return 0
+            try:
+                self._send_json(lookup.merge(data) if lookup is not None else data)
+            except ValueError as ex:
+                log_access(event="request_error", access="Authorized", error=ex)
+                self.send_error(502, "the remote server did not answer with embeddings")
+                return 0
+            # the share of the batch counted by the server
+            return data.get("prompt_eval_count") or 0
+
+        def _mirror(self, path, get_params, post_params, model, fields, lookup, log_access, metered=False):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+            """
+            sends a request that is not queued to one server, the ones about a model to a server that has it
+
+                metered:    count the tokens of a streamed response too
+
+            returns the prompt and generated tokens of the response, 0 if they were not counted
+            """
+            if embed_batcher is not None and path == BATCH_PATH:
+                request = lookup.upstream_request() if lookup is not None else fields
+                if batch_key(request) is not None:
+                    return self._send_embed_batch(request, lookup, log_access)
+            model = model if isinstance(model, str) else None
+            server = cluster.server_for(model)
+            if server is None:
+                log_access(event="internal_error", access="Authorized", error="no server")
+                self.send_error(502, "no server available")
+                return 0
+            log_access(event="request", access="Authorized", server=server)
+            if lookup is not None:
+                post_params = lookup.upstream_body()
+            response = None
+            try:
+                self._response_sent = False
+                server, response = request_with_failover(
+                    server,
+                    model,
+                    self.command,
+                    path,
+                    log_access,
+                    params=get_params,
+                    data=post_params,
+                    stream=True,
+                    timeout=(5, 120),
+                )
+                if lookup is not None and response.status_code == 200:
+                    return self._send_embeddings(lookup, response)
+                meter = UsageMeter(self.wfile) if metered and response.ok else None
+                self._send_response(response, wfile=meter)
+                return meter.tokens() if meter is not None else 0
+            except Exception as ex:  # noqa: BLE001 the client gets an error whatever the server answered
+                _LOG.exception("request to %s failed", server[0])
+                log_access(event="request_error", access="Authorized", server=server, error=ex)
+                if not self._response_sent:
+                    self.send_error(502, "the remote server could not be reached")
+                return 0
+            finally:
+                if response is not None:
+                    response.close()
+
         def do_HEAD(self):  # pylint: disable=invalid-name
             """
             HEAD requests is callbacked here
@@ -220,41 +596,31 @@ def main():
             POST requests is callbacked here
             """
             self.log_request()
-            self.proxy()
+            try:
+                self.proxy()
+            finally:
+                if self._body is not None:
+                    self._body.close()
 
         def _validate_user_and_key(self):
             try:
-                # Extract the bearer token from the headers
-                auth_header = self.headers.get("Authorization")
-                if not auth_header or not auth_header.startswith("Bearer "):
+                valid = validate_auth_header(self.headers.get("Authorization"), authorized_users, jwt_key, token_cache)
+                if valid is None:
+                    # is this needed ?
+                    # self._user = "unknown"
                     return False
-                token = auth_header.split(" ")[1]
-                try:
-                    user, key = token.split(":")
-                except ValueError as e:
-                    # try to jwt decode
-                    if jwt_key:
-                        self._jwt_payload = jwt_decode(jwt_key, token)
-                        self._user = self._jwt_payload["user"]
-                        return True
-                    # raise or return False
-                    raise e
-                # Check if the user and key are in the list of authorized users
-                if authorized_users.get(user) == key:
-                    self._user = user
-                    return True
-                # is this needed ?
-                # self._user = "unknown"
-                return False
+                self._user, self._jwt_payload = valid
+                return True
             except Exception:
                 _LOG.exception("validate user exception")
                 return False
 
-        def proxy(self):
+        def proxy(self):  # pylint: disable=too-many-return-statements,too-many-branches
             """
             Main proxy function that handles all requests
             """
             rid = uuid.uuid4()
+            timer = RequestTimer()
             client_ip, _ = self.client_address
 
             def log_access(event="rejected", access="Denied", server=None, error=""):
@@ -289,24 +655,63 @@ def main():
             path = url.path
             get_params = parse_qs(url.query) or {}
 
+            post_params = None
             if self.command == "POST":
-                content_length = int(self.headers["Content-Length"])
-                post_data = self.rfile.read(content_length)
-                post_params = post_data  # parse_qs(post_data.decode('utf-8'))
-            else:
-                post_params = {}
+                try:
+                    # spooled to disk when large, sent upstream block by block
+                    self._body = RequestBody.read_from(self.rfile, self.headers, args.spool_threshold)
+                except ValueError as ex:
+                    # BodyError or a broken Content-Length
+                    log_access(event="request_error", access="Authorized", error=ex)
+                    self.send_error(400, "bad request could not read the body")
+                    return
+                post_params = self._body if len(self._body) else None
 
             # Apply the queuing mechanism only for a specific endpoint.
             if path in ("/api/generate", "/api/chat", "/v1/chat/completions"):
+                key = None
+                min_queued_server = None
+                # what the request was queued with, to queue it again on another server
+                queue_filter = None
+                # admission by the rate limiter, released when the request is done
+                ticket = None
                 try:
                     post_data_dict = {}
-                    if isinstance(post_data, bytes):
-                        post_data_str = post_data.decode("utf-8")
-                        post_data_dict = json.loads(post_data_str)
-
-                        min_queued_server = server_queue.enqueue(post_data_dict)
+                    if self._body is not None:
+                        # only model and stream, and options for the cache, are needed, large image payloads are not decoded
+                        post_data_dict = self._body.peek(CACHE_FIELDS if response_cache is not None else ROUTING_FIELDS)
+
+                        # deterministic requests are answered from the cache without taking a server
+                        if response_cache is not None and is_deterministic(post_data_dict) and "no-cache" not in (self.headers.get("Cache-Control") or ""):
+                            key = cache_key(path, json.loads(self._body.view()[:]))
+                            cached = response_cache.get(key) if key else None
+                            if cached is not None:
+                                log_access(event="cache_hit", access="Authorized")
+                                self._send_cached(cached)
+                                return
+
+                        # waiting requests are served fairly between users
+                        tenant, weight = request_tenant(self._user, self._jwt_payload, user_weights, args.tenant_claim)
+                        if rate_limiter is not None:
+                            ticket = rate_limiter.acquire(tenant, self._jwt_payload)
+                        timeout = parse_timeout(self.headers.get(TIMEOUT_HEADER))
+                        queue_filter = dict(post_data_dict, user=tenant, weight=weight)
+                        min_queued_server = server_queue.enqueue(queue_filter, timeout)
+                        timer.mark_queued()
                         _LOG.debug("sending request to server %s", min_queued_server[0] if min_queued_server else None)
 
+                except RateLimited as ex:
+                    log_access(event="rate_limited", access="Authorized", error=ex)
+                    self._send_retry_after(429, str(ex), ex.retry_after)
+                    return
+
+                except Overloaded as ex:
+                    if ticket is not None:
+                        ticket.release()
+                    log_access(event="overloaded", access="Authorized", error=ex)
+                    self._send_retry_after(503, str(ex), ex.retry_after)
+                    return
+
                 except (json.JSONDecodeError, json.decoder.JSONDecodeError) as ex:
                     _LOG.exception(rid)
                     log_access(
@@ -317,6 +722,8 @@ def main():
                     self.send_error(400, "bad request could not decode")
                     return
                 except Exception as ex:
+                    if ticket is not None:
+                        ticket.release()
                     _LOG.exception(rid)
                     log_access(
                         event="internal_error",
@@ -327,31 +734,78 @@ def main():
                     self.send_error(500, "internal error please contact proxy admin")
                     return
 
+                if min_queued_server is None:
+                    if ticket is not None:
+                        ticket.release()
+                    log_access(event="internal_error", access="Authorized", error="no server")
+                    self.send_error(503, "no healthy server available please try again")
+                    return
+
                 log_access(
                     event="gen_request",
                     access="Authorized",
                     server=min_queued_server,
                 )
                 response = None
+                status = 500
+                # None until the server answered or failed
+                healthy = None
+                # counts the tokens of the response for the token quota
+                meter = None
                 try:
                     self._response_sent = False
-                    # connect and request timeout
-                    response = requests.request(
-                        self.command,
-                        min_queued_server[1]["url"] + path,
-                        params=get_params,
-                        data=post_params,
-                        stream=post_data_dict.get("stream", False),
-                        timeout=(5, 120),
-                    )
+                    # servers that failed before answering
+                    tried = set()
+                    retry_budget.request()
+                    while True:
+                        try:
+                            # connect and request timeout
+                            response = upstream_pool.request(
+                                min_queued_server[0],
+                                self.command,
+                                min_queued_server[1]["url"] + path,
+                                params=get_params,
+                                data=post_params,
+                                stream=True,
+                                timeout=(5, 120),
+                            )
+                        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                            # the headers did not arrive, the body is streamed after the request returns
+                            other = self._failover(min_queued_server, tried, queue_filter, log_access)
+                            if other is None:
+                                raise
+                            min_queued_server = other
+                            continue
+                        if not retryable_status(response.status_code):
+                            break
+                        other = self._failover(min_queued_server, tried, queue_filter, log_access)
+                        if other is None:
+                            break
+                        response.close()
+                        response = None
+                        min_queued_server = other
+                    timer.connect = upstream_pool.connect_time()
+                    status = response.status_code
+                    healthy = status < 500
                     # set last model used
                     #                    if response.ok:
                     #                        min_queued_server[1]["last_model"] = (
                     #                            model,
                     #                            datetime.datetime.now(),
                     #                        )
-                    self._send_response(response)
+                    # ollama streams by default, the openai compatible endpoints do not
+                    stream = bool(post_data_dict.get("stream", not path.startswith("/v1/")))
+                    out = None
+                    recorder = None
+                    if key and response.status_code == 200:
+                        out = recorder = response_cache.recorder(key, response.headers.get("Content-Type"), self.wfile)
+                    if ticket is not None and ticket.limits.tokens and response.ok:
+                        out = meter = UsageMeter(out or self.wfile)
+                    self._send_response(response, stream=stream, window=self._coalesce_window() if stream else 0.0, on_first_write=timer.mark_first_byte, wfile=out)
+                    if recorder is not None:
+                        recorder.commit()
                 except requests.exceptions.Timeout as ex:
+                    healthy = False
                     _LOG.exception(rid)
                     log_access(
                         event="gen_error",
@@ -360,8 +814,12 @@ def main():
                         error=ex,
                     )
                     if not self._response_sent:
+                        status = 408
                         self.send_error(408, "the remote server timeout please try again")
                 except Exception as ex:
+                    if response is None:
+                        # could not reach the server
+                        healthy = False
                     _LOG.exception(rid)
                     log_access(
                         event="gen_error",
@@ -375,19 +833,62 @@ def main():
                             "internal error during proxy please contact proxy admin",
                         )
                 finally:
-                    if min_queued_server:
-                        server_queue.dequeue(min_queued_server[0], response and response.ok)
+                    if response is not None:
+                        response.close()
+                    server_queue.dequeue(min_queued_server[0], healthy, timer.server_latency() if response is not None and response.ok else None)
+                    if ticket is not None:
+                        ticket.release(meter.tokens() if meter is not None else 0)
                     log_access(event="gen_done", access="Authorized", server=min_queued_server)
+                    if metrics is not None:
+                        metrics.observe(timer, min_queued_server[0] if min_queued_server else None, post_data_dict.get("model"), path, status)
+            elif path in AGGREGATED_PATHS and self.command in ("GET", "HEAD"):
+                # merged from all servers and cached for a few seconds
+                try:
+                    data = cluster.get(path)
+                except Exception as ex:  # noqa: BLE001 the client gets an error whatever the servers answered
+                    _LOG.exception(rid)
+                    log_access(event="internal_error", access="Authorized", error=ex)
+                    self.send_error(500, "internal error please contact proxy admin")
+                    return
+                log_access(event="cluster_request", access="Authorized")
+                self._send_json(data)
             else:
-                # For other endpoints, just mirror the request.
-                response = requests.request(
-                    self.command,
-                    min_queued_server[1]["url"] + path,
-                    params=get_params,
-                    data=post_params,
-                    timeout=(5, 120),
-                )
-                self._send_response(response)
+                # For other endpoints, just mirror the request, the ones about a model go to a server that has it.
+                model = None
+                lookup = None
+                fields = None
+                if path in MODEL_PATHS and post_params is not None:
+                    try:
+                        if (embedding_cache is not None and path in EMBED_PATHS) or (embed_batcher is not None and path == BATCH_PATH):
+                            fields = json.loads(self._body.view()[:])
+                            # only the inputs not cached are sent to the server
+                            lookup = embedding_cache.lookup(path, fields) if embedding_cache is not None else None
+                        else:
+                            fields = self._body.peek(("model", "name"))
+                        model = fields.get("model") or fields.get("name")
+                    except (ValueError, AttributeError):
+                        # let the server answer
+                        pass
+                if lookup is not None and not lookup.missing:
+                    log_access(event="cache_hit", access="Authorized")
+                    self._send_json(lookup.merge(None))
+                    return
+                # the endpoints running a model take a ticket like the queued ones
+                ticket = None
+                if path in LIMITED_PATHS and rate_limiter is not None:
+                    try:
+                        tenant, _ = request_tenant(self._user, self._jwt_payload, user_weights, args.tenant_claim)
+                        ticket = rate_limiter.acquire(tenant, self._jwt_payload)
+                    except RateLimited as ex:
+                        log_access(event="rate_limited", access="Authorized", error=ex)
+                        self._send_retry_after(429, str(ex), ex.retry_after)
+                        return
+                tokens = 0
+                try:
+                    tokens = self._mirror(path, get_params, post_params, model, fields, lookup, log_access, ticket is not None and bool(ticket.limits.tokens))
+                finally:
+                    if ticket is not None:
+                        ticket.release(tokens)
 
     class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
         """
@@ -402,6 +903,15 @@ def main():
         server.serve_forever()
     except KeyboardInterrupt:
         pass
+    finally:
+        reloader.stop()
+        if prober is not None:
+            prober.stop()
+        if metrics_server is not None:
+            metrics_server.stop()
+        if embedding_cache is not None:
+            embedding_cache.close()
+        access_log.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,316 @@
+"""
+prometheus style metrics of the proxy, served on a separate admin port
+
+histograms are split in stripes picked by the thread id, each with its own lock,
+so request threads recording at the same time do not wait on each other
+"""
+
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# label value used once a metric has too many label combinations, the model name comes from the client
+OVERFLOW = "other"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Stripe:  # pylint: disable=too-few-public-methods
+    """part of a histogram written by a subset of the threads"""
+
+    __slots__ = ("lock", "series")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # label values -> [bucket counts..., sum]
+        self.series = {}
+
+
+class Histogram:  # pylint: disable=too-many-instance-attributes
+    """
+    histogram with labels
+
+        name:           metric name
+        help_:          description
+        labelnames:     names of the labels
+        buckets:        upper bounds of the buckets, +Inf is added
+        max_series:     label combinations kept, more are counted with all labels set to OVERFLOW
+        stripes:        number of independently locked parts
+    """
+
+    def __init__(self, name, help_, labelnames=(), buckets=DEFAULT_BUCKETS, max_series=1000, stripes=16):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self.name = name
+        self.help = help_
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(float(bound) for bound in buckets))
+        self._max_series = max_series
+        self._stripes = [_Stripe() for _ in range(stripes)]
+        self._known = set()
+        self._known_lock = threading.Lock()
+        self._overflow = (OVERFLOW,) * len(self.labelnames)
+
+    def _series_key(self, labels):
+        if labels in self._known:
+            return labels
+        with self._known_lock:
+            if labels not in self._known:
+                if len(self._known) >= self._max_series:
+                    return self._overflow
+                self._known.add(labels)
+        return labels
+
+    def observe(self, value, *labels):
+        """records one value for the label values, given in the order of labelnames"""
+        labels = self._series_key(labels)
+        stripe = self._stripes[threading.get_native_id() % len(self._stripes)]
+        index = bisect.bisect_left(self.buckets, value)
+        with stripe.lock:
+            counts = stripe.series.get(labels)
+            if counts is None:
+                counts = stripe.series[labels] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def collect(self):
+        """merged series, dict of label values -> (cumulative bucket counts, sum, count)"""
+        merged = {}
+        for stripe in self._stripes:
+            with stripe.lock:
+                items = [(labels, list(counts)) for labels, counts in stripe.series.items()]
+            for labels, counts in items:
+                total = merged.get(labels)
+                if total is None:
+                    merged[labels] = counts
+                else:
+                    for i, count in enumerate(counts):
+                        total[i] += count
+        result = {}
+        for labels, counts in merged.items():
+            cumulative = []
+            running = 0
+            for count in counts[:-1]:
+                running += count
+                cumulative.append(running)
+            result[labels] = (cumulative, counts[-1], running)
+        return result
+
+    def render(self):
+        """lines in the prometheus text format"""
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (cumulative, total, count) in sorted(self.collect().items()):
+            for bound, value in zip((*self.buckets, float("inf")), cumulative):
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {value}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+class Gauge:
+    """
+    gauge read when the metrics are scraped
+
+        func:   returns an iterable of (label values, value)
+    """
+
+    def __init__(self, name, help_, labelnames, func):
+        self.name = name
+        self.help = help_
+        self.labelnames = tuple(labelnames)
+        self._func = func
+
+    def render(self):
+        """lines in the prometheus text format"""
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for labels, value in self._func():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Registry:
+    """the metrics served on /metrics"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def histogram(self, name, help_, labelnames=(), **kwargs):
+        """creates and registers a histogram"""
+        metric = Histogram(name, help_, labelnames, **kwargs)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help_, labelnames, func):
+        """registers a gauge computed by func on every scrape"""
+        metric = Gauge(name, help_, labelnames, func)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """all metrics in the prometheus text format"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class RequestTimer:
+    """timestamps of the phases of one proxied request"""
+
+    __slots__ = ("connect", "first_byte", "queued", "start")
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.queued = None
+        self.connect = None
+        self.first_byte = None
+
+    def mark_queued(self):
+        """a server has been picked"""
+        self.queued = time.monotonic()
+
+    def mark_first_byte(self):
+        """the first byte of the body is sent to the client"""
+        if self.first_byte is None:
+            self.first_byte = time.monotonic()
+
+    def server_latency(self):
+        """seconds from picking the server to the first byte, None if there was no answer"""
+        if self.queued is None or self.first_byte is None:
+            return None
+        return self.first_byte - self.queued
+
+
+class ProxyMetrics:
+    """
+    the metrics of the proxy
+
+        server_queue:   the queue the in flight and waiting gauges are read from
+    """
+
+    LABELS = ("server", "model", "endpoint", "status")
+
+    def __init__(self, server_queue):
+        self.registry = Registry()
+        self.queue_wait = self.registry.histogram("ollama_proxy_queue_wait_seconds", "Time waiting for a free server", self.LABELS)
+        self.upstream_connect = self.registry.histogram("ollama_proxy_upstream_connect_seconds", "Time opening the connection to the server, 0 when reused", self.LABELS)
+        self.first_byte = self.registry.histogram("ollama_proxy_time_to_first_byte_seconds", "Time from the request until the first byte of the response body", self.LABELS)
+        self.duration = self.registry.histogram("ollama_proxy_request_duration_seconds", "Total time of the request", self.LABELS)
+        self.registry.gauge(
+            "ollama_proxy_in_flight_requests",
+            "Requests running on a server",
+            ("server",),
+            lambda: (((name,), count) for name, count in server_queue.in_flight().items()),
+        )
+        self.registry.gauge("ollama_proxy_waiting_requests", "Requests waiting for a free server", (), lambda: [((), server_queue.waiting())])
+        self.registry.gauge(
+            "ollama_proxy_concurrency_limit",
+            "Requests a server may run at the same time",
+            ("server",),
+            lambda: (((name,), limit) for name, limit in server_queue.limits().items()),
+        )
+        self.registry.gauge(
+            "ollama_proxy_server_health",
+            "1 for the state of the circuit breaker of a server: closed, half_open or open",
+            ("server", "state"),
+            lambda: (((name, state), 1) for name, state in server_queue.health().items()),
+        )
+
+    def add_stats(self, name, help_, stats):
+        """a gauge of the counters returned by stats(), one series per counter"""
+        self.registry.gauge(f"ollama_proxy_{name}", help_, ("stat",), lambda: [((key,), value) for key, value in stats().items()])
+
+    def add_server_stats(self, name, help_, stats):
+        """a gauge of the counters per server returned by stats(), one series per server and counter"""
+        self.registry.gauge(
+            f"ollama_proxy_{name}",
+            help_,
+            ("server", "stat"),
+            lambda: [((server, key), value) for server, counters in stats().items() for key, value in counters.items()],
+        )
+
+    def observe(self, timer, server, model, endpoint, status):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        """records a finished request"""
+        now = time.monotonic()
+        labels = (server or "None", model or "", endpoint, str(status))
+        if timer.queued is not None:
+            self.queue_wait.observe(timer.queued - timer.start, *labels)
+        if timer.connect is not None:
+            self.upstream_connect.observe(timer.connect, *labels)
+        if timer.first_byte is not None:
+            self.first_byte.observe(timer.first_byte - timer.start, *labels)
+        self.duration.observe(now - timer.start, *labels)
+
+
+class _ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MetricsServer:
+    """
+    serves the registry on /metrics in a background thread
+
+        registry:   the Registry to serve
+        host:       address to listen on
+        port:       port to listen on, 0 picks a free one
+    """
+
+    def __init__(self, registry, host="", port=9100):
+        registry_ = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            """answers /metrics"""
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                """GET requests is callbacked here"""
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry_.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+                """scrapes are not logged"""
+
+        self._server = _ThreadedHTTPServer((host, port), Handler)
+        self._thread = None
+
+    @property
+    def port(self):
+        """the port we are listening on"""
+        return self._server.server_address[1]
+
+    def start(self):
+        """starts serving in a background thread"""
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics-server", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """stops serving"""
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread:
+            self._thread.join()
@@ -4,3 +4,6 @@ module for queues
 
 from .simple_queue import SimpleQueue  # as SimpleQueue  # noqa: F401
 from .model_queue import ModelLoadedQueue  # as ModelLoadedQueue  # noqa: F401
+from .residency import ModelResidency  # as ModelResidency  # noqa: F401
+from .health import HealthMonitor, HealthProber  # as HealthMonitor  # noqa: F401
+from .admission import AdmissionControl, Overloaded  # as AdmissionControl  # noqa: F401
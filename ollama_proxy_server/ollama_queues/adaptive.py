@@ -0,0 +1,53 @@
+"""
+adaptive concurrency limits
+
+a server gets as many concurrent requests as it answers quickly. the limit grows by one slot per limit requests
+answered below the latency threshold, and is cut by a factor when the latency goes above it (AIMD)
+"""
+
+import time
+
+
+class AimdLimit:  # pylint: disable=too-many-instance-attributes
+    """
+    concurrency limit of one server
+
+        max_limit:  the limit never goes above this, the configured max_concurrency
+        min_limit:  the limit never goes below this
+        tolerance:  latencies above tolerance times the baseline latency count as overload
+        backoff:    factor the limit is multiplied with on overload
+        drift:      factor the baseline latency may grow by per request, so it follows slower models
+
+    the baseline is the lowest latency seen, the latency is the time to the first byte of the response
+    """
+
+    def __init__(self, max_limit, min_limit=1, tolerance=2.0, backoff=0.75, drift=1.01):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self.max_limit = max_limit
+        self.min_limit = min(min_limit, max_limit)
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.drift = drift
+        self._limit = float(max_limit)
+        self.baseline = None
+        self._last_decrease = float("-inf")
+
+    @property
+    def limit(self):
+        """the current number of slots"""
+        return int(self._limit)
+
+    def update(self, latency, now=None):
+        """records the latency of a request, returns the new limit"""
+        now = time.monotonic() if now is None else now
+        if self.baseline is None or latency < self.baseline:
+            self.baseline = latency
+        else:
+            self.baseline = min(latency, self.baseline * self.drift)
+        if latency > self.baseline * self.tolerance:
+            # the requests running when the server got slow all report it, only back off once per round trip
+            if now - self._last_decrease > self.baseline * self.tolerance:
+                self._limit = max(float(self.min_limit), self._limit * self.backoff)
+                self._last_decrease = now
+        else:
+            self._limit = min(float(self.max_limit), self._limit + 1 / self._limit)
+        return self.limit
@@ -0,0 +1,174 @@
+"""
+admission of requests into the waiting line
+
+without bounds every request waits for a slot as long as it takes, under overload the waiting requests pile up
+until the proxy runs out of threads or memory. the admission control bounds the requests waiting and how long they
+wait, globally and per model, and turns the requests over a bound away right away with an estimate of when to retry
+based on the rate the servers take requests at. a request whose estimated wait is longer than it may wait is turned
+away before it waits for nothing
+"""
+
+import collections
+import math
+import time
+
+from .residency import normalize_model
+
+# header with the seconds a client is willing to wait for a server
+TIMEOUT_HEADER = "X-Request-Timeout"
+
+
+class Overloaded(TimeoutError):
+    """a request turned away or waiting too long, retry_after is the seconds until it could be served"""
+
+    def __init__(self, retry_after, reason):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+
+def parse_timeout(value):
+    """the seconds of a timeout header, 0 if it is missing or not a positive number"""
+    try:
+        timeout = float(value) if value else 0.0
+    except ValueError:
+        return 0.0
+    return timeout if timeout > 0 and math.isfinite(timeout) else 0.0
+
+
+def parse_bounds(values):
+    """
+    dict of model -> (max_waiting, max_wait) from a list of model=max_waiting:max_wait strings
+    a missing part is None, raises ValueError on a broken entry
+    """
+    bounds = {}
+    for value in values or []:
+        model, sep, numbers = value.rpartition("=")
+        max_waiting, _, max_wait = numbers.partition(":")
+        if not sep or not model or not (max_waiting or max_wait):
+            raise ValueError(f"expected model=max_waiting:max_wait, got {value!r}")
+        bounds[normalize_model(model)] = (int(max_waiting) if max_waiting else None, float(max_wait) if max_wait else None)
+    return bounds
+
+
+class _Rate:
+    """requests served per second over the last horizon seconds"""
+
+    __slots__ = ("horizon", "times")
+
+    def __init__(self, horizon):
+        self.horizon = horizon
+        self.times = collections.deque(maxlen=1024)
+
+    def add(self, now):
+        """a request was served"""
+        self.times.append(now)
+
+    def get(self, now):
+        """requests per second, None while nothing was served in the horizon"""
+        times = self.times
+        while times and times[0] < now - self.horizon:
+            times.popleft()
+        if not times:
+            return None
+        return len(times) / max(now - times[0], 1.0)
+
+
+class AdmissionControl:  # pylint: disable=too-many-instance-attributes
+    """
+    bounds on the requests waiting for a slot, not thread safe, the queue calls it with its lock held
+
+        max_waiting:    requests waiting at the same time, 0 no limit
+        max_wait:       seconds a request waits for a slot, 0 no limit
+        models:         dict of model -> (max_waiting, max_wait) bounding the requests of a model, None keeps the global one
+        horizon:        seconds of served requests the rate is measured over
+    """
+
+    def __init__(self, max_waiting=0, max_wait=0.0, models=None, horizon=30.0):
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        self.models = {normalize_model(model): bounds for model, bounds in (models or {}).items()}
+        self._waiting = 0
+        self._rate = _Rate(horizon)
+        # the models with bounds of their own
+        self._model_waiting = dict.fromkeys(self.models, 0)
+        self._model_rate = {model: _Rate(horizon) for model in self.models}
+        self.admitted = 0
+        self.shed = 0
+        self.timed_out = 0
+
+    @staticmethod
+    def _model(filter_):
+        model = filter_.get("model") if filter_ else None
+        return normalize_model(model) if isinstance(model, str) else None
+
+    def _scope(self, model):
+        """(requests waiting, rate) the wait of a request for model depends on"""
+        if model in self._model_rate:
+            return self._model_waiting[model], self._model_rate[model]
+        return self._waiting, self._rate
+
+    def timeout(self, filter_, timeout=0.0):
+        """the seconds a request may wait, the shortest of its own timeout and the bound of its model, 0 no limit"""
+        max_wait = self.models.get(self._model(filter_), (None, None))[1]
+        if max_wait is None:
+            max_wait = self.max_wait
+        return min(t for t in (timeout, max_wait) if t > 0) if timeout > 0 or max_wait > 0 else 0.0
+
+    def retry_after(self, filter_, now=None):
+        """estimated seconds until a request could get a slot, 1 if there is no rate yet"""
+        now = time.monotonic() if now is None else now
+        waiting, rate = self._scope(self._model(filter_))
+        per_second = rate.get(now)
+        return (waiting + 1) / per_second if per_second else 1.0
+
+    def admit(self, filter_, timeout=0.0, now=None):
+        """
+        lets a request wait for a slot
+
+            timeout:    seconds it may wait, see timeout
+
+        raises Overloaded if too many requests wait or it would wait longer than timeout
+        """
+        now = time.monotonic() if now is None else now
+        model = self._model(filter_)
+        max_waiting = self.models.get(model, (None, None))[0]
+        reason = None
+        if self.max_waiting and self._waiting >= self.max_waiting:
+            reason = f"{self._waiting} requests waiting"
+        elif max_waiting and self._model_waiting[model] >= max_waiting:
+            reason = f"{max_waiting} requests waiting for {model}"
+        elif timeout > 0:
+            estimate = self.retry_after(filter_, now)
+            if estimate > timeout and self._scope(model)[1].get(now):
+                reason = f"estimated wait {estimate:.1f}s is longer than {timeout:g}s"
+        if reason is not None:
+            self.shed += 1
+            raise Overloaded(self.retry_after(filter_, now), f"overloaded, {reason}")
+        self.admitted += 1
+        self._waiting += 1
+        if model in self._model_waiting:
+            self._model_waiting[model] += 1
+
+    def leave(self, filter_):
+        """an admitted request stopped waiting, it got a slot or gave up"""
+        self._waiting -= 1
+        model = self._model(filter_)
+        if model in self._model_waiting:
+            self._model_waiting[model] -= 1
+
+    def served(self, filter_, now=None):
+        """a request got a slot"""
+        now = time.monotonic() if now is None else now
+        self._rate.add(now)
+        model = self._model(filter_)
+        if model in self._model_rate:
+            self._model_rate[model].add(now)
+
+    def expired(self, filter_, now=None):
+        """an admitted request waited too long, returns the Overloaded to raise"""
+        self.timed_out += 1
+        return Overloaded(self.retry_after(filter_, now), "overloaded, no server available in time")
+
+    def stats(self):
+        """requests admitted, shed and timed out, requests waiting"""
+        return {"admitted": self.admitted, "shed": self.shed, "timed_out": self.timed_out, "waiting": self._waiting}
@@ -2,6 +2,8 @@
 Base class for different queue implementation's
 """
 
+import asyncio
+
 from ollama_proxy_server.ollama_logger import get_logger
 
 
@@ -16,7 +18,6 @@ class BaseQueue:
         """
         Init for base class
         """
-        self._queues = {}
         self._servers = servers
         self._servers_dict = {}
         self._max_queue_size = max_queue_size
@@ -27,16 +28,34 @@ class BaseQueue:
 
     def add_server(self, server):
         """
-        add server to be scheduled
+        add server to be scheduled, replaces the server with the same name
         """
-        # make sure we dont update
-        self._servers[server[0]] = server
+        old = self._servers_dict.get(server[0])
+        if old is not None:
+            self._servers[self._servers.index(old)] = server
+        else:
+            self._servers.append(server)
+        self._servers_dict[server[0]] = server
 
     def delete_server(self, server_name):
         """
         remove server from scheduling
         """
-        del self._servers[server_name]
+        server = self._servers_dict.pop(server_name)
+        self._servers.remove(server)
+
+    def get_servers(self):
+        """
+        a copy of the list of servers being scheduled
+        """
+        return list(self._servers)
+
+    def schedulable(self, filter_=None):
+        """
+        the servers a request could be sent to now, filter_ as in enqueue
+        """
+        exclude = filter_.get("exclude") if filter_ else None
+        return [server for server in self._servers if not exclude or server[0] not in exclude]
 
     def enqueue(self, filter_=None, timeout=0):
         """
@@ -45,6 +64,7 @@ class BaseQueue:
         filter:     a dict that can include
             model:  the model requested
             user:   the user doing the request
+            exclude: names of servers not to use
         timeout:    timeout float in seconds to block until giving up, raises TimeoutError
 
         returns
@@ -53,6 +73,13 @@ class BaseQueue:
         """
         raise NotImplementedError("Function not implemented")
 
+    async def enqueue_async(self, filter_=None, timeout=0):
+        """
+        same as enqueue but for use on an event loop
+        the default runs the blocking enqueue in a thread, override it with something that does not block
+        """
+        return await asyncio.to_thread(self.enqueue, filter_, timeout)
+
     def get_length(self, server_name):
         """
         Gets the queue length of server
@@ -61,12 +88,48 @@ class BaseQueue:
         """
         raise NotImplementedError("Function not implemented")
 
-    def dequeue(self, server_name, ok=False):
+    def in_flight(self):
+        """
+        requests running per server, dict of server name -> count
+        """
+        return {server[0]: self.get_length(server[0]) for server in list(self._servers)}
+
+    def waiting(self):
+        """
+        number of requests waiting for a free server
+        """
+        return 0
+
+    def retry_after(self, filter_=None):  # pylint: disable=unused-argument
+        """
+        estimated seconds until a request could get a slot
+        """
+        return 1.0
+
+    def limits(self):
+        """
+        slots per server, dict of server name -> count
+        """
+        return {server[0]: self._max_queue_size for server in list(self._servers)}
+
+    def health(self):
+        """
+        state of the servers, dict of server name -> closed, half_open or open
+        """
+        return {server[0]: "closed" for server in list(self._servers)}
+
+    def report_probe(self, server_name, ok):
+        """
+        the result of an active health probe, ignored by queues without health tracking
+        """
+
+    def dequeue(self, server_name, ok=None, latency=None):
         """
         removes us from the queue
 
             server_name:    the server name to dequeue
-            ok:             if the request was a succcess or not
+            ok:             if the server answered or not, None if the request was never sent
+            latency:        seconds until the server started answering, None if unknown
 
         """
         raise NotImplementedError("Function not implemented")
@@ -0,0 +1,228 @@
+"""
+health of the servers
+
+every server has a circuit breaker. it opens after consecutive failed requests or probes, or when the latency of the
+server is an outlier compared to the others, and the server is not scheduled any more. once the cooldown is over a
+successful probe puts it half open: it gets one slot, one more per successful request, and the breaker closes after
+enough successes. a failure while half open opens it again
+"""
+
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from ollama_proxy_server.ollama_logger import get_logger
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:  # pylint: disable=too-few-public-methods
+    """state of one server"""
+
+    __slots__ = ("failures", "latency", "opened_at", "samples", "state", "successes")
+
+    def __init__(self):
+        self.state = CLOSED
+        # consecutive failures while closed
+        self.failures = 0
+        # successes while half open
+        self.successes = 0
+        self.opened_at = 0.0
+        # moving average of the latency while closed
+        self.latency = None
+        self.samples = 0
+
+
+class HealthMonitor:  # pylint: disable=too-many-instance-attributes
+    """
+    circuit breakers of the servers, not thread safe, the queue calls it with its lock held
+
+        failures:       consecutive failed requests or probes that open the breaker
+        cooldown:       seconds a breaker stays open before a successful probe lets the server back in
+        recovery:       successful requests while half open that close the breaker
+        outlier_factor: open the breaker of a server whose average latency is this many times the median of the others, 0 disables it
+        min_samples:    latencies a server needs before it can be an outlier
+        max_ejected:    fraction of the servers that may be out at the same time for being slow
+    """
+
+    # weight of a new latency in the moving average
+    _ALPHA = 0.2
+
+    def __init__(self, failures=5, cooldown=30.0, recovery=3, outlier_factor=0.0, min_samples=20, max_ejected=0.5):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self.failures = failures
+        self.cooldown = cooldown
+        self.recovery = recovery
+        self.outlier_factor = outlier_factor
+        self.min_samples = min_samples
+        self.max_ejected = max_ejected
+        self._breakers = {}
+        self._log = get_logger(__name__, "INFO")
+
+    def _breaker(self, name):
+        breaker = self._breakers.get(name)
+        if breaker is None:
+            breaker = self._breakers[name] = CircuitBreaker()
+        return breaker
+
+    def state(self, name):
+        """closed, half_open or open"""
+        breaker = self._breakers.get(name)
+        return breaker.state if breaker is not None else CLOSED
+
+    def available(self, name):
+        """if the server can be scheduled"""
+        return self.state(name) != OPEN
+
+    def capacity(self, name, slots):
+        """the slots the server gets out of the slots it is configured with"""
+        breaker = self._breakers.get(name)
+        if breaker is None or breaker.state == CLOSED:
+            return slots
+        if breaker.state == OPEN:
+            return 0
+        return min(slots, 1 + breaker.successes)
+
+    def _open(self, name, breaker, now, reason):
+        breaker.state = OPEN
+        breaker.opened_at = now
+        breaker.failures = breaker.successes = breaker.samples = 0
+        breaker.latency = None
+        self._log.warning("server %s is unhealthy (%s), not scheduled for at least %.0fs", name, reason, self.cooldown)
+
+    def _is_outlier(self, name, breaker):
+        """if the average latency of the server is far above the one of the others"""
+        if not self.outlier_factor or breaker.samples < self.min_samples:
+            return False
+        others = [other.latency for other_name, other in self._breakers.items() if other_name != name and other.state == CLOSED and other.samples >= self.min_samples]
+        if len(others) < 2:
+            return False
+        ejected = sum(other.state != CLOSED for other in self._breakers.values())
+        if ejected + 1 > self.max_ejected * len(self._breakers):
+            return False
+        return breaker.latency > self.outlier_factor * statistics.median(others)
+
+    def record(self, name, ok, latency=None, now=None):
+        """
+        the outcome of a request
+
+            ok:         if the server answered
+            latency:    seconds until it started answering, None if unknown
+
+        returns True if the slots or the availability of the server changed
+        """
+        now = time.monotonic() if now is None else now
+        breaker = self._breaker(name)
+        if breaker.state == OPEN:
+            # sent before the breaker opened
+            return False
+        if not ok:
+            if breaker.state == HALF_OPEN or breaker.failures + 1 >= self.failures:
+                self._open(name, breaker, now, "failed requests")
+                return True
+            breaker.failures += 1
+            return False
+        breaker.failures = 0
+        if breaker.state == HALF_OPEN:
+            breaker.successes += 1
+            if breaker.successes >= self.recovery:
+                breaker.state = CLOSED
+                breaker.successes = 0
+                self._log.info("server %s recovered", name)
+            return True
+        if latency is not None:
+            breaker.latency = latency if breaker.latency is None else breaker.latency + self._ALPHA * (latency - breaker.latency)
+            breaker.samples += 1
+            if self._is_outlier(name, breaker):
+                self._open(name, breaker, now, f"average latency {breaker.latency:.3f}s")
+                return True
+        return False
+
+    def probe(self, name, ok, now=None):
+        """
+        the outcome of an active probe, a failed probe counts as a failed request
+
+        returns True if the slots or the availability of the server changed
+        """
+        now = time.monotonic() if now is None else now
+        breaker = self._breaker(name)
+        if breaker.state != OPEN:
+            return False if ok else self.record(name, False, now=now)
+        if ok and now - breaker.opened_at >= self.cooldown:
+            breaker.state = HALF_OPEN
+            breaker.successes = 0
+            self._log.info("server %s answers again, letting requests in", name)
+            return True
+        return False
+
+    def forget(self, name):
+        """drops the breaker of a removed server"""
+        self._breakers.pop(name, None)
+
+    def states(self):
+        """dict of server name -> state of the servers that had requests or probes"""
+        return {name: breaker.state for name, breaker in self._breakers.items()}
+
+
+class HealthProber:  # pylint: disable=too-many-instance-attributes
+    """
+    background thread probing every server of a queue
+
+        server_queue:   the queue, its report_probe gets the results
+        interval:       seconds between probes
+        timeout:        timeout of one probe, a hung server fails it
+        path:           path requested on every server, any answer below 500 is healthy
+    """
+
+    def __init__(self, server_queue, interval=10.0, timeout=2.0, path="/api/version"):
+        self._queue = server_queue
+        self._interval = interval
+        self._timeout = timeout
+        self._path = path
+        self._session = requests.Session()
+        self._stop = threading.Event()
+        self._thread = None
+        self._log = get_logger(__name__, "INFO")
+
+    def _probe(self, server):
+        try:
+            res = self._session.get(server[1]["url"] + self._path, timeout=self._timeout)
+            ok = res.status_code < 500
+            res.close()
+        except requests.RequestException as ex:
+            self._log.debug("probe of %s failed: %s", server[0], ex)
+            ok = False
+        self._queue.report_probe(server[0], ok)
+
+    def probe_once(self):
+        """probes every server once"""
+        servers = self._queue.get_servers()
+        if not servers:
+            return
+        with ThreadPoolExecutor(max_workers=min(16, len(servers)), thread_name_prefix="ollama-health") as pool:
+            list(pool.map(self._probe, servers))
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.probe_once()
+            except Exception:  # noqa: BLE001 the prober thread keeps running
+                self._log.exception("health probes failed")
+            self._stop.wait(self._interval)
+
+    def start(self):
+        """starts probing in a background thread"""
+        self._thread = threading.Thread(target=self._run, name="ollama-health-prober", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """stops probing, waits for the probes running"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._session.close()
@@ -0,0 +1,123 @@
+"""
+index of the servers ordered by load, kept up to date on every enqueue and dequeue
+so picking the least loaded server does not scan the whole fleet
+"""
+
+import bisect
+
+
+class ServerGroup(tuple):
+    """
+    immutable group of servers with a set of their names for fast membership tests
+    """
+
+    def __new__(cls, servers=()):
+        group = super().__new__(cls, servers)
+        group.names = frozenset(server[0] for server in group)
+        return group
+
+
+class LoadIndex:
+    """
+    servers ordered by (requests in flight / weight, config order)
+    servers without a free slot are left out of the order
+    """
+
+    # below this ratio of candidates to free servers the candidates are checked directly
+    _DIRECT_RATIO = 4
+
+    def __init__(self):
+        # sorted (load, rank, name) of servers with a free slot
+        self._order = []
+        # name -> [count, rank, capacity, weight]
+        self._state = {}
+
+    def __len__(self):
+        return len(self._state)
+
+    def __contains__(self, name):
+        return name in self._state
+
+    @staticmethod
+    def _load(state):
+        # a server with twice the weight is as loaded with twice the requests
+        return state[0] / state[3]
+
+    def _unlink(self, name, state):
+        if state[0] < state[2]:
+            entry = (self._load(state), state[1], name)
+            del self._order[bisect.bisect_left(self._order, entry)]
+
+    def _link(self, name, state):
+        if state[0] < state[2]:
+            bisect.insort(self._order, (self._load(state), state[1], name))
+
+    def add(self, name, rank, capacity=1, weight=1.0):  # pylint: disable=too-many-positional-arguments
+        """adds a server, rank breaks ties between equally loaded servers"""
+        if name in self._state:
+            self.remove(name)
+        state = self._state[name] = [0, rank, capacity, weight]
+        self._link(name, state)
+
+    def remove(self, name):
+        """removes a server"""
+        state = self._state.pop(name)
+        self._unlink(name, state)
+
+    def count(self, name):
+        """requests in flight on a server, 0 for unknown servers"""
+        state = self._state.get(name)
+        return state[0] if state else 0
+
+    def has_free_slot(self, name):
+        """if the server can take one more request"""
+        state = self._state.get(name)
+        return bool(state) and state[0] < state[2]
+
+    def capacity(self, name):
+        """number of slots of a server"""
+        return self._state[name][2]
+
+    def set_capacity(self, name, capacity):
+        """changes the number of slots of a server"""
+        state = self._state[name]
+        self._unlink(name, state)
+        state[2] = capacity
+        self._link(name, state)
+
+    def set_weight(self, name, weight):
+        """changes the relative capacity of a server"""
+        state = self._state[name]
+        self._unlink(name, state)
+        state[3] = weight
+        self._link(name, state)
+
+    def incr(self, name, delta=1):
+        """changes the requests in flight on a server, returns the new count"""
+        state = self._state[name]
+        self._unlink(name, state)
+        state[0] += delta
+        self._link(name, state)
+        return state[0]
+
+    def best(self, names=None):
+        """
+        the least loaded server with a free slot, None if there is none
+
+            names:  set of server names to choose from, None for all
+        """
+        if names is None:
+            return self._order[0][2] if self._order else None
+        if len(names) * self._DIRECT_RATIO < len(self._order):
+            best = None
+            best_key = None
+            for name in names:
+                state = self._state.get(name)
+                if state and state[0] < state[2] and (best is None or (self._load(state), state[1]) < best_key):
+                    best = name
+                    best_key = (self._load(state), state[1])
+            return best
+        for _, _, name in self._order:
+            if name in names:
+                return name
+        return None
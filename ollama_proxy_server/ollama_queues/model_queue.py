@@ -3,12 +3,39 @@ model queue it sends request primary to nodes that already have the model loaded
 """
 
 import datetime
-# from ollama_proxy_server.ollama_logger import get_logger
+import fnmatch
+import functools
+import re
 
+# from ollama_proxy_server.ollama_logger import get_logger
+from .load_index import ServerGroup
 from .simple_queue import SimpleQueue
 
 # _log = get_logger(__name__)
 
+_PATTERN_CHARS = re.compile(r"[*?\[]")
+
+
+class ModelRules:
+    """
+    a model white or black list compiled once
+    plain names are looked up in a set, entries like llama3.* or qwen2.5:* are glob patterns
+    """
+
+    __slots__ = ("exact", "pattern")
+
+    def __init__(self, models=None):
+        models = models or []
+        self.exact = frozenset(m for m in models if not _PATTERN_CHARS.search(m))
+        patterns = [fnmatch.translate(m) for m in models if _PATTERN_CHARS.search(m)]
+        self.pattern = re.compile("|".join(patterns)) if patterns else None
+
+    def __bool__(self):
+        return bool(self.exact) or self.pattern is not None
+
+    def __contains__(self, model):
+        return model in self.exact or (self.pattern is not None and self.pattern.match(model) is not None)
+
 
 class ModelLoadedQueue(SimpleQueue):
     """
@@ -17,55 +44,118 @@ class ModelLoadedQueue(SimpleQueue):
 
     _name = __name__
 
-    def enqueue(self, filter_=None, timeout=0):
-        """gets the server that can serve the request"""
+    # how long a model is assumed loaded after a request when there is no residency information
+    _last_model_keep_alive = datetime.timedelta(minutes=4, seconds=30)
+    # max models in the eligibility table, the model name comes from the client
+    _eligible_cache_size = 4096
+
+    def __init__(self, servers, max_queue_size=1, residency=None, adaptive=False, health=None, admission=None):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        """
+        residency:  optional ModelResidency with what the servers report as loaded
+        adaptive:   see SimpleQueue
+        health:     see SimpleQueue
+        admission:  see SimpleQueue
+        """
+        self._residency = residency
+        self._rules = {}
+        # model -> ServerGroup of the servers allowed to serve it
+        self._eligible = {}
+        super().__init__(servers, max_queue_size, adaptive, health, admission)
+        self._build_rules()
+
+    def _build_rules(self):
+        """compiles the white and black lists of all servers"""
+        self._rules = {server[0]: (ModelRules(server[1].get("model_wl")), ModelRules(server[1].get("model_bl"))) for server in self._servers}
+        self._eligible = {}
+
+    def _servers_changed(self):
+        """the server set changed, the eligibility table is rebuilt lazily"""
+        self._build_rules()
+        super()._servers_changed()
+
+    def _eligible_servers(self, model):
+        """memoized servers that can handle model, the same ServerGroup is returned every time"""
+        if not model:
+            return self._all_servers
+        eligible = self._eligible
+        servers = eligible.get(model)
+        if servers is None:
+            servers = ServerGroup(self._get_servers_with_model(self._servers, model))
+            if len(eligible) >= self._eligible_cache_size:
+                eligible.clear()
+            eligible[model] = servers
+        return servers
+
+    def _candidates(self, filter_=None):
+        """the servers that can handle the model, the ones with it loaded first"""
         model = None
         if filter_ and "model" in filter_:
             model = filter_["model"]
-        servers = self._get_servers_with_model(self._servers, model)
-        servers = self._get_servers_with_loaded_model(servers, model)
-        server = self._wait_for_server(servers, self._get_shortes_queue, timeout=timeout)
+        servers = self._exclude(self._eligible_servers(model), filter_)
+        loaded = self._get_servers_with_loaded_model(servers, model)
+        if not loaded:
+            return servers, self._get_shortes_queue
+        return servers, functools.partial(self._get_preferred_queue, loaded)
+
+    def _get_preferred_queue(self, preferred, servers):
+        """the least loaded preferred server with a free slot, else the least loaded of servers"""
+        return self._get_least_loaded(preferred) or self._get_shortes_queue(servers)
+
+    def _on_scheduled(self, server, filter_=None):
+        """remember the model sent to the server"""
         self._log.debug("enqueue on server %s", server[0] if server else None)
         if server:
-            server[1]["last_model"] = (model, server[1]["last_model"][1])
-        return server
+            model = filter_.get("model") if filter_ else None
+            server[1]["last_model"] = (model, server[1].get("last_model", (None, datetime.datetime.min))[1])
+            if self._residency is not None:
+                self._residency.mark_loaded(server[0], model)
 
     def _get_servers_with_loaded_model(self, servers, model):
-        """get all servers with the loaded model"""
-        # TODO: implemet keep_alive like mentioned here  # pylint: disable=fixme
-        # https://github.com/ollama/ollama/issues/1600
-        lservers = []
+        """get the names of the servers in servers with the loaded model"""
+        if not model:
+            return frozenset()
+        if self._residency is not None:
+            return self._residency.servers_with(model) & servers.names
+        # no residency information, guess from the last model sent to the server
+        now = datetime.datetime.now()
+        lservers = set()
         for server in servers:
             cs = server[1]
             if "last_model" not in cs:
-                cs["last_model"] = (None, datetime.datetime.now() - datetime.timedelta(weeks=-(5 * 52)))
+                cs["last_model"] = (None, datetime.datetime.min)
             lm = cs["last_model"]
-            if model == lm[0] and datetime.datetime.now() > (lm[1] + datetime.timedelta(minutes=4, seconds=30)):
-                lservers.append(server)
+            if model == lm[0] and now < lm[1] + self._last_model_keep_alive:
+                lservers.add(server[0])
 
-        # TODO: reove dupo and make this better
-        # prio loaded models
-        return lservers + servers
+        return lservers
 
     def _get_servers_with_model(self, servers, model=None):
-        """gets the servers that can handle a specific model"""
+        """gets the healthy servers that can handle a specific model"""
+        servers = self._schedulable(servers)
         if model:
             lservers = []
             for server in servers:
-                cs = server[1]
+                rules = self._rules.get(server[0])
+                if rules is None:
+                    # added while we were looking
+                    rules = (ModelRules(server[1].get("model_wl")), ModelRules(server[1].get("model_bl")))
+                wl, bl = rules
                 # white list trumph blacklist
-                if cs["model_wl"] and model in cs["model_wl"]:
-                    lservers.append(server)
-                elif cs["model_bl"] is None or (cs["model_bl"] and model not in cs["model_bl"]):
+                if (wl and model in wl) or not bl or model not in bl:
                     lservers.append(server)
             return lservers
-        return self._servers
+        return servers
+
+    def add_server(self, server):
+        """see SimpleQueue.add_server, a replaced server keeps the model it ran last"""
+        old = self._servers_dict.get(server[0])
+        if old is not None and "last_model" in old[1]:
+            server[1].setdefault("last_model", old[1]["last_model"])
+        super().add_server(server)
 
-    def dequeue(self, server_name, ok=False):
+    def dequeue(self, server_name, ok=None, latency=None):
         """removed the server from queue"""
-        if ok:
-            self._servers_dict[server_name][1]["last_model"] = (
-                self._servers_dict[server_name][1]["last_model"][0],
-                datetime.datetime.now(),
-            )
-        super().dequeue(server_name, ok)
+        if ok and server_name in self._servers_dict:
+            settings = self._servers_dict[server_name][1]
+            settings["last_model"] = (settings.get("last_model", (None,))[0], datetime.datetime.now())
+        super().dequeue(server_name, ok, latency)
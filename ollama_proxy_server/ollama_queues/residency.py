@@ -0,0 +1,168 @@
+"""
+tracks which models are loaded on which server by polling the backends /api/ps
+"""
+
+import datetime
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from ollama_proxy_server.ollama_logger import get_logger
+
+# ollama sends nanoseconds, python only parses up to microseconds
+_FRACTION = re.compile(r"(\.\d{6})\d+")
+
+
+def normalize_model(model):
+    """ollama treats a model without tag as the latest tag"""
+    return model if ":" in model else f"{model}:latest"
+
+
+def parse_expires_at(value):
+    """parses the expires_at timestamp from /api/ps into epoch seconds"""
+    value = _FRACTION.sub(r"\1", value.replace("Z", "+00:00"))
+    return datetime.datetime.fromisoformat(value).timestamp()
+
+
+class LoadedModel:
+    """a model resident on a server"""
+
+    __slots__ = ("expires_at", "size_vram")
+
+    def __init__(self, expires_at, size_vram=0):
+        self.expires_at = expires_at
+        self.size_vram = size_vram
+
+    def __repr__(self):
+        return f"LoadedModel(expires_at={self.expires_at}, size_vram={self.size_vram})"
+
+
+class ModelResidency:  # pylint: disable=too-many-instance-attributes
+    """
+    background poller of /api/ps on every server
+
+        servers:    the server list from get_config, changes to the list are picked up on the next poll
+        interval:   seconds between polls
+        timeout:    timeout of one /api/ps request
+        keep_alive: seconds a model is assumed loaded after we sent a request for it, until the next poll
+    """
+
+    def __init__(self, servers, interval=10.0, timeout=2.0, keep_alive=300.0):
+        self._servers = servers
+        self._interval = interval
+        self._timeout = timeout
+        self._keep_alive = keep_alive
+        # server name -> model -> LoadedModel, replaced as a whole on every poll
+        self._loaded = {}
+        # model -> server name -> LoadedModel
+        self._by_model = {}
+        self._lock = threading.Lock()
+        self._session = requests.Session()
+        self._stop = threading.Event()
+        self._thread = None
+        self._log = get_logger(__name__, "INFO")
+
+    def update(self, server_name, ps, now=None):
+        """replaces what is loaded on a server with a /api/ps response"""
+        now = time.time() if now is None else now
+        loaded = {}
+        for entry in ps.get("models") or []:
+            name = entry.get("model") or entry.get("name")
+            if not name:
+                continue
+            try:
+                expires_at = parse_expires_at(entry["expires_at"])
+            except (KeyError, ValueError):
+                expires_at = now + self._keep_alive
+            loaded[normalize_model(name)] = LoadedModel(expires_at, entry.get("size_vram", 0))
+        self._set(server_name, loaded)
+
+    def _set(self, server_name, loaded):
+        """replaces the models of a server and keeps the model index in sync"""
+        with self._lock:
+            for model in self._loaded.get(server_name, {}):
+                if model not in loaded:
+                    by_server = self._by_model.get(model, {})
+                    by_server.pop(server_name, None)
+                    if not by_server:
+                        self._by_model.pop(model, None)
+            for model, lm in loaded.items():
+                self._by_model.setdefault(model, {})[server_name] = lm
+            if loaded:
+                self._loaded[server_name] = loaded
+            else:
+                self._loaded.pop(server_name, None)
+
+    def mark_loaded(self, server_name, model, now=None):
+        """a request for model was sent to the server so it will be loaded there"""
+        if not model:
+            return
+        now = time.time() if now is None else now
+        loaded = dict(self._loaded.get(server_name, {}))
+        current = loaded.get(normalize_model(model))
+        loaded[normalize_model(model)] = LoadedModel(now + self._keep_alive, current.size_vram if current else 0)
+        self._set(server_name, loaded)
+
+    def forget(self, server_name):
+        """drops all knowledge about a server"""
+        self._set(server_name, {})
+
+    def servers_with(self, model, now=None):
+        """names of the servers that have model loaded"""
+        now = time.time() if now is None else now
+        by_server = self._by_model.get(normalize_model(model))
+        if not by_server:
+            return frozenset()
+        return frozenset(name for name, lm in list(by_server.items()) if lm.expires_at > now)
+
+    def loaded(self, server_name, now=None):
+        """models that have not expired on a server, dict of model -> LoadedModel"""
+        now = time.time() if now is None else now
+        return {model: lm for model, lm in self._loaded.get(server_name, {}).items() if lm.expires_at > now}
+
+    def is_loaded(self, server_name, model, now=None):
+        """if model is loaded on the server"""
+        lm = self._loaded.get(server_name, {}).get(normalize_model(model))
+        return lm is not None and lm.expires_at > (time.time() if now is None else now)
+
+    def _poll_server(self, server):
+        try:
+            res = self._session.get(server[1]["url"] + "/api/ps", timeout=self._timeout)
+            res.raise_for_status()
+            self.update(server[0], res.json())
+        except (requests.RequestException, ValueError) as ex:
+            self._log.debug("could not poll %s: %s", server[0], ex)
+            # we do not know any more, dont prefer it
+            self.forget(server[0])
+
+    def poll_once(self):
+        """polls every server once"""
+        servers = list(self._servers)
+        if not servers:
+            return
+        with ThreadPoolExecutor(max_workers=min(16, len(servers)), thread_name_prefix="ollama-ps") as pool:
+            list(pool.map(self._poll_server, servers))
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.poll_once()
+            except Exception:  # noqa: BLE001 the poller thread keeps running
+                self._log.exception("poll of /api/ps failed")
+            self._stop.wait(self._interval)
+
+    def start(self):
+        """starts polling in a background thread"""
+        self._thread = threading.Thread(target=self._run, name="ollama-ps-poller", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """stops polling"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self._session.close()
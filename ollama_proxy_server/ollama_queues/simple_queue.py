@@ -1,91 +1,452 @@
 """
 simple queue
 shedules the server with the shortest queue
+
+waiting requests are served in start time fair queuing order: every user gets a virtual clock that advances by
+1 / weight per request, and the request with the lowest start time is served first. a user with hundreds of
+requests waiting only gets its share, a user sending one request now and then is served next
+
+the waiting requests are kept in one line per set of servers they can use. when the first request of a line can
+not get a slot none of the others can, so a released slot only looks at the first request of every line
 """
 
-import time
-import queue
+import asyncio
+import bisect
 import datetime
+import heapq
+import itertools
+import threading
 
 # from ollama_proxy_server.ollama_logger import get_logger
+from .adaptive import AimdLimit
+from .admission import Overloaded
 from .base_queue import BaseQueue
+from .load_index import LoadIndex, ServerGroup
 
 # _log = get_logger(__name__)
 
 
-class SimpleQueue(BaseQueue):
+class _Reservation:  # pylint: disable=too-many-instance-attributes
+    """
+    a request waiting for a slot, woken by dequeue when a slot it can use is released
+    either blocks a thread on an event or resolves a future on an event loop
+    """
+
+    __slots__ = ("entry", "event", "filter_", "func", "future", "loop", "server", "servers")
+
+    def __init__(self, filter_, servers, func, loop=None):  # pylint: disable=too-many-positional-arguments
+        self.filter_ = filter_
+        self.servers = servers
+        self.func = func
+        self.server = None
+        # (start tag, arrival, self) in the waiting list
+        self.entry = None
+        self.loop = loop
+        self.event = None if loop else threading.Event()
+        self.future = loop.create_future() if loop else None
+
+    def wake(self):
+        """called with the queue lock held when self.server has been granted"""
+        if self.future is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(self.server)
+
+
+class SimpleQueue(BaseQueue):  # pylint: disable=too-many-instance-attributes
     """
     class for simple queue
     """
 
     _name = __name__
 
+    def __init__(self, servers, max_queue_size=1, adaptive=False, health=None, admission=None):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        """
+        max_queue_size:     slots of the servers without a max_concurrency
+        adaptive:           lower and raise the slots of each server with its latency, up to its max_concurrency
+        health:             optional HealthMonitor, servers it takes out are not scheduled
+        admission:          optional AdmissionControl bounding the requests waiting and their wait
+        """
+        super().__init__(servers, max_queue_size)
+        self._lock = threading.Lock()
+        self._index = LoadIndex()
+        # server name -> AimdLimit when adaptive
+        self._limits = {} if adaptive else None
+        self._health = health
+        self._admission = admission
+        for rank, server in enumerate(self._servers):
+            self._index.add(server[0], rank, self._slots(server), self._weight(server))
+        self._next_rank = len(self._servers)
+        # deleted servers that still have requests in flight
+        self._draining = set()
+        self._all_servers = ServerGroup(self._schedulable(self._servers))
+        # names of the servers they can use -> (start tag, arrival, reservation) of the waiting requests in fair order
+        self._lines = {}
+        self._waiting = 0
+        self._arrivals = itertools.count()
+        # start tag of the latest request given a slot
+        self._virtual_time = 0.0
+        # user -> finish tag of its latest request
+        self._finish = {}
+
+    def _capacity(self, server):
+        """the slots of a server, its current adaptive limit if there is one"""
+        max_concurrency = server[1].get("max_concurrency") or self._max_queue_size
+        if self._limits is None:
+            return max_concurrency
+        limit = self._limits.get(server[0])
+        if limit is None or limit.max_limit != max_concurrency:
+            limit = self._limits[server[0]] = AimdLimit(max_concurrency)
+        return limit.limit
+
+    def _slots(self, server):
+        """the slots of a server, none while it is unhealthy"""
+        if self._health is None:
+            return self._capacity(server)
+        return self._health.capacity(server[0], self._capacity(server))
+
+    def _schedulable(self, servers):
+        """the servers the health monitor has not taken out"""
+        if self._health is None:
+            return servers
+        return [server for server in servers if self._health.available(server[0])]
+
+    @staticmethod
+    def _weight(server):
+        """the relative capacity of a server"""
+        return server[1].get("weight") or 1.0
+
+    def add_server(self, server):
+        """add a server, or replace the settings of a server with the same name"""
+        with self._lock:
+            super().add_server(server)
+            self._draining.discard(server[0])
+            if server[0] in self._index:
+                self._index.set_capacity(server[0], self._slots(server))
+                self._index.set_weight(server[0], self._weight(server))
+            else:
+                self._index.add(server[0], self._next_rank, self._slots(server), self._weight(server))
+                self._next_rank += 1
+            self._servers_changed()
+            self._grant(all_slots=True)
+
+    def delete_server(self, server_name):
+        """
+        remove a server from scheduling
+        requests already running on it finish, it is forgotten when the last one is dequeued
+        """
+        with self._lock:
+            super().delete_server(server_name)
+            if self._index.count(server_name) > 0:
+                self._index.set_capacity(server_name, 0)
+                self._draining.add(server_name)
+            else:
+                self._index.remove(server_name)
+            if self._limits is not None:
+                self._limits.pop(server_name, None)
+            if self._health is not None:
+                self._health.forget(server_name)
+            self._servers_changed()
+
+    def _servers_changed(self):
+        """
+        called with the lock held when servers are added or removed
+        recomputes the candidates of the waiting requests
+        """
+        self._all_servers = ServerGroup(self._schedulable(self._servers))
+        entries = [entry for line in self._lines.values() for entry in line]
+        self._lines = {}
+        for entry in entries:
+            reservation = entry[2]
+            reservation.servers, reservation.func = self._candidates(reservation.filter_)
+            bisect.insort(self._lines.setdefault(self._line_key(reservation.servers), []), entry)
+
+    def _candidates(self, filter_=None):
+        """
+        the servers that can handle the request and the function picking one of them
+        """
+        return self._exclude(self._all_servers, filter_), self._get_shortes_queue
+
+    @staticmethod
+    def _exclude(servers, filter_):
+        """servers without the ones in the exclude set of filter_, the servers a failed request already tried"""
+        exclude = filter_.get("exclude") if filter_ else None
+        if not exclude:
+            return servers
+        return ServerGroup(server for server in servers if server[0] not in exclude)
+
+    def schedulable(self, filter_=None):
+        """the servers that are healthy, can take the model of filter_ and are not excluded, full or not"""
+        with self._lock:
+            return list(self._candidates(filter_)[0])
+
+    def _on_scheduled(self, server, filter_=None):
+        """called after a server has been reserved for the request"""
+
     def enqueue(self, filter_=None, timeout=0):
-        """gets the server that can serve the request"""
-        return self._wait_for_server(self._servers, self._get_shortes_queue, timeout=timeout)
+        """
+        gets the server that can serve the request
+        raises Overloaded, a TimeoutError, when the admission control turns it away or it waited too long
+        """
+        servers, func = self._candidates(filter_)
+        server = self._wait_for_server(servers, func, timeout=self._timeout(filter_, timeout), filter_=filter_)
+        self._on_scheduled(server, filter_)
+        return server
+
+    async def enqueue_async(self, filter_=None, timeout=0):
+        """gets the server that can serve the request without blocking the event loop"""
+        servers, func = self._candidates(filter_)
+        server = await self._wait_for_server_async(servers, func, timeout=self._timeout(filter_, timeout), filter_=filter_)
+        self._on_scheduled(server, filter_)
+        return server
+
+    def _timeout(self, filter_, timeout):
+        """the seconds the request may wait"""
+        return self._admission.timeout(filter_, timeout) if self._admission is not None else timeout
+
+    def _timed_out(self, filter_, timeout):
+        """the error of a request that waited longer than timeout"""
+        if self._admission is None:
+            return Overloaded(1.0, f"No avalibe server within {timeout}s")
+        with self._lock:
+            return self._admission.expired(filter_)
 
     def get_length(self, server_name):
         """retruns the length of the queue for a server"""
-        return self._queues[server_name].qsize()
+        return self._index.count(server_name)
+
+    def _take(self, server):
+        """reserves a slot on server, must hold the lock"""
+        self._index.incr(server[0])
+
+    def _reserve_or_wait(self, servers, func, filter_=None, loop=None, timeout=0):  # pylint: disable=too-many-positional-arguments
+        """
+        reserves a slot right away if one is free, else puts a reservation last in line
+
+        returns (server, None) or (None, reservation)
+        raises Overloaded if the admission control does not let it wait
+        """
+        with self._lock:
+            server = func(servers)
+            if server is None and self._admission is not None:
+                self._admission.admit(filter_, timeout)
+            tag = self._start_tag(filter_)
+            if server is not None:
+                self._take(server)
+                self._virtual_time = max(self._virtual_time, tag)
+                if self._admission is not None:
+                    self._admission.served(filter_)
+                return server, None
+            reservation = _Reservation(filter_, servers, func, loop)
+            reservation.entry = (tag, next(self._arrivals), reservation)
+            bisect.insort(self._lines.setdefault(self._line_key(servers), []), reservation.entry)
+            self._waiting += 1
+            self._log.debug("no free slot, %d waiting", self._waiting)
+            return None, reservation
+
+    @staticmethod
+    def _line_key(servers):
+        """the line of the requests that can use servers"""
+        names = getattr(servers, "names", None)
+        return names if names is not None else frozenset(server[0] for server in servers)
+
+    def _remove_waiter(self, reservation):
+        """takes a reservation out of its line, must hold the lock"""
+        key = self._line_key(reservation.servers)
+        line = self._lines[key]
+        del line[bisect.bisect_left(line, reservation.entry)]
+        if not line:
+            del self._lines[key]
+        self._waiting -= 1
+
+    def _start_tag(self, filter_):
+        """
+        the place of a request in the fair order, must hold the lock
+
+        filter_ can have the user sending the request and its weight, a user with weight 2 gets twice the slots
+        of a user with weight 1 when both have requests waiting
+        """
+        user = filter_.get("user") if filter_ else None
+        weight = filter_.get("weight") if filter_ else None
+        if not isinstance(weight, (int, float)) or weight <= 0:
+            weight = 1.0
+        start = max(self._virtual_time, self._finish.get(user, 0.0))
+        self._finish[user] = start + 1.0 / weight
+        if len(self._finish) > 2 * self._waiting + 64:
+            # users whose clock is behind start at the virtual time anyway
+            self._finish = {name: finish for name, finish in self._finish.items() if finish > self._virtual_time}
+        return start
+
+    def _cancel(self, reservation):
+        """
+        gives up a reservation that timed out
 
-    def _wait_for_server(self, servers, func, timeout=0):
+        returns the server if it was granted before we got the lock
+        """
+        with self._lock:
+            if reservation.server is None:
+                self._remove_waiter(reservation)
+                if self._admission is not None:
+                    self._admission.leave(reservation.filter_)
+            return reservation.server
+
+    def _wait_for_server(self, servers, func, timeout=0, filter_=None):
         """waits untill a server can handle the request sent"""
-        old_server = None
-        server = None
-        start = time.time()
+        # We have not servers to schedule on
+        if len(servers) == 0:
+            # raise ValueError exception instead ?
+            return None
+        server, reservation = self._reserve_or_wait(servers, func, filter_, timeout=timeout)
+        if reservation is None:
+            return server
+        if reservation.event.wait(timeout if timeout > 0 else None):
+            return reservation.server
+        server = self._cancel(reservation)
+        if server is None:
+            raise self._timed_out(filter_, timeout)
+        return server
 
-        while True:
-            que, server = func(servers)
-            # We have not servers to schedule on
+    async def _wait_for_server_async(self, servers, func, timeout=0, filter_=None):
+        """same as _wait_for_server but waits on a future"""
+        if len(servers) == 0:
+            return None
+        server, reservation = self._reserve_or_wait(servers, func, filter_, asyncio.get_running_loop(), timeout)
+        if reservation is None:
+            return server
+        try:
+            # wait_for raises asyncio.TimeoutError, not the builtin TimeoutError, before python 3.11
+            return await asyncio.wait_for(asyncio.shield(reservation.future), timeout if timeout > 0 else None)
+        except (asyncio.TimeoutError, TimeoutError, asyncio.CancelledError) as exc:
+            server = self._cancel(reservation)
+            if server is not None:
+                if isinstance(exc, asyncio.CancelledError):
+                    # nobody will use the slot
+                    self.dequeue(server[0])
+                    raise
+                return server
+            if isinstance(exc, asyncio.CancelledError):
+                raise
+            raise self._timed_out(filter_, timeout) from exc
+
+    def _grant(self, all_slots=False):
+        """
+        hands free slots to the waiters in fair order, must hold the lock
+
+        a waiter only gets passed over when none of its servers has a free slot,
+        so waiters of the same user competing for the same servers are served first come first served
+
+            all_slots:  more than one slot may have been freed, keep granting until nobody can be served
+        """
+        granted = []
+        # the first waiter of every line, in fair order
+        heads = [(line[0], 0, line) for line in self._lines.values()]
+        heapq.heapify(heads)
+        while heads:
+            (tag, _, reservation), index, line = heapq.heappop(heads)
+            server = reservation.func(reservation.servers)
             if server is None:
-                # raise ValueError exception instead ?
-                return None
-            if server[0] != old_server:
-                self._log.debug("changing server to %s", server[0])
-            try:
-                if timeout > 0:
-                    put_timeout = min(0.5, max(0.0001, (time.time() - start) - timeout))
-                else:
-                    put_timeout = 0.5
-                que.put(1, timeout=put_timeout)
+                # the waiters after it in its line wait for the same servers
+                continue
+            self._take(server)
+            self._virtual_time = max(self._virtual_time, tag)
+            reservation.server = server
+            granted.append(reservation)
+            # one released slot can only be granted once
+            if not all_slots:
                 break
-            except queue.Full as exc:
-                if timeout > 0 and (time.time() - start - timeout) <= 0:  # pylint: disable=chained-comparison
-                    raise TimeoutError("No avalibe server within {timeout}s") from exc
-                self._log.debug("try to requeue")
-                old_server = server
-
-        return server
+            if index + 1 < len(line):
+                heapq.heappush(heads, (line[index + 1], index + 1, line))
+        for reservation in granted:
+            self._remove_waiter(reservation)
+            if self._admission is not None:
+                self._admission.leave(reservation.filter_)
+                self._admission.served(reservation.filter_)
+            reservation.wake()
 
     def _get_shortes_queue(self, servers):
         """
-        Get the shortest queue from all servers
+        Get the server with the fewest requests in flight that has a free slot, None if all are full
+        must hold the lock
+
+            servers:    the servers to choose from, a ServerGroup avoids building a set of names
         """
+        if servers is self._all_servers:
+            return self._get_least_loaded(None)
+        names = getattr(servers, "names", None)
+        if names is None:
+            names = {server[0] for server in servers}
+        return self._get_least_loaded(names)
 
-        if len(servers) == 0:
-            return None, None
-
-        min_queued_server = servers[0]
-        if min_queued_server[0] not in self._queues:
-            self._queues[min_queued_server[0]] = queue.Queue(maxsize=self._max_queue_size)
-
-        que = self._queues[min_queued_server[0]]
-
-        # TODO: speed this up  # pylint: disable=fixme
-        for server in servers:
-            sname = server[0]
-            if sname not in self._queues:
-                self._queues[sname] = queue.Queue(maxsize=self._max_queue_size)
-            if self._queues[sname].qsize() < self._queues[min_queued_server[0]].qsize():
-                min_queued_server = server
-                que = self._queues[sname]
-            # cant be less then zero so bail out here
-            if que.qsize() == 0:
-                return que, min_queued_server
-        return que, min_queued_server
-
-    def dequeue(self, server_name, ok=False):
+    def _get_least_loaded(self, names):
+        """the least loaded server with a free slot among a set of names, None for all servers"""
+        name = self._index.best(names)
+        return self._servers_dict[name] if name is not None else None
+
+    def dequeue(self, server_name, ok=None, latency=None):
         """removes a request from the servers queue"""
-        if ok:
+        if ok and server_name not in self._draining:
             self._servers_dict[server_name][1]["last_seen"] = datetime.datetime.now()
-        self._queues[server_name].get_nowait()
+        with self._lock:
+            if self._index.count(server_name) <= 0:
+                raise KeyError(f"no request in flight on {server_name}")
+            more = False
+            if self._index.incr(server_name, -1) == 0 and server_name in self._draining:
+                self._draining.discard(server_name)
+                self._index.remove(server_name)
+                self._log.info("server %s drained", server_name)
+            elif server_name not in self._draining:
+                adapted = latency is not None and self._limits is not None and server_name in self._limits
+                if adapted:
+                    self._limits[server_name].update(latency)
+                health_changed = self._health is not None and ok is not None and self._health.record(server_name, ok, latency)
+                if adapted or health_changed:
+                    more = self._update_slots(server_name)
+                if health_changed:
+                    self._servers_changed()
+            self._grant(all_slots=more)
+
+    def _update_slots(self, server_name):
+        """applies a changed limit or health to the slots of a server, must hold the lock, returns True if it got more"""
+        old = self._index.capacity(server_name)
+        new = self._slots(self._servers_dict[server_name])
+        if new != old:
+            self._log.debug("slots of %s %d -> %d", server_name, old, new)
+            self._index.set_capacity(server_name, new)
+        return new > old
+
+    def report_probe(self, server_name, ok):
+        """the result of an active health probe of a server"""
+        with self._lock:
+            if self._health is None or server_name not in self._servers_dict:
+                return
+            if self._health.probe(server_name, ok):
+                more = self._update_slots(server_name)
+                self._servers_changed()
+                self._grant(all_slots=more)
+
+    def health(self):
+        """state of the circuit breaker per server, dict of server name -> closed, half_open or open"""
+        with self._lock:
+            if self._health is None:
+                return super().health()
+            return {server[0]: self._health.state(server[0]) for server in self._servers}
+
+    def limits(self):
+        """slots per server, dict of server name -> count"""
+        with self._lock:
+            return {server[0]: self._index.capacity(server[0]) for server in self._servers}
+
+    def waiting(self):
+        """number of requests waiting for a slot"""
+        return self._waiting
+
+    def retry_after(self, filter_=None):
+        """estimated seconds until a request could get a slot"""
+        with self._lock:
+            if self._admission is None:
+                return super().retry_after(filter_)
+            return self._admission.retry_after(filter_)
@@ -0,0 +1,274 @@
+"""
+per user limits checked before a request is queued
+
+every user or tenant can be limited in
+    requests per second     a token bucket refilled at rps and holding burst requests
+    concurrency             requests in flight at the same time
+    tokens                  prompt and generated tokens per window, counted from the last chunk of the responses
+
+the limits come from a file like config.ini, its DEFAULT section applies to everyone:
+
+    [DEFAULT]
+    rps = 5
+    burst = 10
+
+    [batch]
+    concurrency = 2
+    tokens = 200000
+    window = 3600
+
+jwt claims with the same names override the file for the user of the token. 0 means no limit
+"""
+
+import configparser
+import math
+import re
+import threading
+import time
+
+LIMIT_FIELDS = ("rps", "burst", "concurrency", "tokens", "window")
+# the counters of the last chunk of ollama and openai responses
+_USAGE = re.compile(rb'"(prompt_eval_count|eval_count|prompt_tokens|completion_tokens)"\s*:\s*(\d+)')
+# bytes of the end of a response kept to find the counters
+_TAIL_SIZE = 1024
+# endpoints that are not queued but run a model, they are limited like the queued ones
+LIMITED_PATHS = ("/api/embed", "/api/embeddings", "/v1/embeddings")
+
+
+class RateLimited(Exception):
+    """a request over a limit, retry_after is the seconds until it could pass"""
+
+    def __init__(self, retry_after, reason):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+
+def retry_after_header(seconds):
+    """value of a Retry-After header, whole seconds and at least 1"""
+    return str(max(1, math.ceil(seconds)))
+
+
+class Limits:
+    """
+    limits of one user or tenant, 0 for no limit
+
+        rps:            requests per second
+        burst:          requests allowed at once after a quiet period, max(1, rps) if 0
+        concurrency:    requests in flight
+        tokens:         tokens per window
+        window:         seconds of the token window
+    """
+
+    __slots__ = LIMIT_FIELDS
+
+    def __init__(self, rps=0.0, burst=0, concurrency=0, tokens=0, window=3600.0):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self.rps = rps
+        self.burst = burst or max(1.0, rps)
+        self.concurrency = concurrency
+        self.tokens = tokens
+        self.window = window
+
+    def __bool__(self):
+        return bool(self.rps or self.concurrency or self.tokens)
+
+    def __eq__(self, other):
+        return isinstance(other, Limits) and all(getattr(self, name) == getattr(other, name) for name in LIMIT_FIELDS)
+
+    def __repr__(self):
+        return "Limits(" + ", ".join(f"{name}={getattr(self, name)}" for name in LIMIT_FIELDS) + ")"
+
+    def override(self, values):
+        """a copy with the numbers found in values, a dict like a jwt payload"""
+        fields = {name: getattr(self, name) for name in LIMIT_FIELDS}
+        changed = set()
+        for name in LIMIT_FIELDS:
+            value = values.get(name)
+            if isinstance(value, (int, float)) and not isinstance(value, bool) and value >= 0:
+                fields[name] = value
+                changed.add(name)
+        if "rps" in changed and "burst" not in changed:
+            # the burst follows the new rate
+            fields["burst"] = 0
+        return Limits(**fields)
+
+
+def get_limits(filename, readf="read"):
+    """
+    reads a limits file, returns (limits of everyone, dict of user or tenant -> limits)
+    raises ValueError on a value that is not a number
+    """
+    config = configparser.ConfigParser()
+    getattr(config, readf)(filename)
+
+    def section_limits(section):
+        return Limits(
+            rps=section.getfloat("rps", fallback=0.0),
+            burst=section.getfloat("burst", fallback=0.0),
+            concurrency=section.getint("concurrency", fallback=0),
+            tokens=section.getint("tokens", fallback=0),
+            window=section.getfloat("window", fallback=3600.0),
+        )
+
+    return section_limits(config[configparser.DEFAULTSECT]), {name: section_limits(config[name]) for name in config.sections()}
+
+
+class _State:  # pylint: disable=too-few-public-methods
+    """counters of one user or tenant"""
+
+    __slots__ = ("in_flight", "level", "limits", "updated", "used", "window_start")
+
+    def __init__(self, now, limits):
+        # the limits of the latest request
+        self.limits = limits
+        self.level = limits.burst
+        self.updated = now
+        self.in_flight = 0
+        self.window_start = now
+        self.used = 0
+
+
+class Ticket:
+    """an admitted request, released once when it is done"""
+
+    __slots__ = ("_limiter", "_released", "_tenant", "limits")
+
+    def __init__(self, limiter, tenant, limits):
+        self._limiter = limiter
+        self._tenant = tenant
+        self._released = False
+        self.limits = limits
+
+    def release(self, tokens=0):
+        """the request is done, tokens is what it used, later calls do nothing"""
+        if not self._released:
+            self._released = True
+            self._limiter.release(self._tenant, self.limits, tokens)
+
+
+class RateLimiter:
+    """
+    checks and counts the limits of every user or tenant
+
+        default:    Limits of everyone
+        limits:     dict of user or tenant -> Limits replacing the default
+        max_idle:   users kept without activity before the idle ones are forgotten
+    """
+
+    def __init__(self, default=None, limits=None, max_idle=4096):
+        self.default = default or Limits()
+        self.limits = limits or {}
+        self._max_idle = max_idle
+        self._states = {}
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.rejected = 0
+
+    def limits_for(self, tenant, jwt_payload=None):
+        """the limits of a user or tenant, jwt claims win over the file"""
+        limits = self.limits.get(tenant, self.default)
+        if jwt_payload and any(name in jwt_payload for name in LIMIT_FIELDS):
+            limits = limits.override(jwt_payload)
+        return limits
+
+    def _refill(self, state, limits, now):
+        if limits.rps:
+            state.level = min(limits.burst, state.level + (now - state.updated) * limits.rps)
+        state.updated = now
+        if now - state.window_start >= limits.window:
+            state.window_start = now
+            state.used = 0
+
+    def _prune(self, now):
+        """forgets the users that are back to a clean state, must hold the lock"""
+        for tenant, state in list(self._states.items()):
+            self._refill(state, state.limits, now)
+            if state.in_flight == 0 and state.used == 0 and state.level >= state.limits.burst:
+                del self._states[tenant]
+
+    def acquire(self, tenant, jwt_payload=None, now=None):
+        """
+        admits a request of a user or tenant
+
+        returns a Ticket to release when the request is done, None if the user has no limits
+        raises RateLimited if the request is over a limit
+        """
+        limits = self.limits_for(tenant, jwt_payload)
+        if not limits:
+            return None
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            state = self._states.get(tenant)
+            if state is None:
+                if len(self._states) >= self._max_idle:
+                    self._prune(now)
+                state = self._states[tenant] = _State(now, limits)
+            state.limits = limits
+            self._refill(state, limits, now)
+            try:
+                if limits.concurrency and state.in_flight >= limits.concurrency:
+                    raise RateLimited(1.0, f"more than {limits.concurrency} requests in flight")
+                if limits.tokens and state.used >= limits.tokens:
+                    raise RateLimited(state.window_start + limits.window - now, f"more than {limits.tokens} tokens in {limits.window:g}s")
+                if limits.rps and state.level < 1:
+                    raise RateLimited((1 - state.level) / limits.rps, f"more than {limits.rps:g} requests per second")
+            except RateLimited:
+                self.rejected += 1
+                raise
+            if limits.rps:
+                state.level -= 1
+            state.in_flight += 1
+            self.admitted += 1
+        return Ticket(self, tenant, limits)
+
+    def release(self, tenant, limits, tokens=0, now=None):
+        """counts a finished request, use Ticket.release"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            state = self._states.get(tenant)
+            if state is None:
+                return
+            state.in_flight = max(0, state.in_flight - 1)
+            if tokens and limits.tokens:
+                self._refill(state, limits, now)
+                state.used += tokens
+
+    def stats(self):
+        """requests admitted and rejected, users tracked"""
+        return {"admitted": self.admitted, "rejected": self.rejected, "tracked": len(self._states)}
+
+
+def count_tokens(data):
+    """prompt and generated tokens of a whole response, 0 if it has no counters"""
+    meter = UsageMeter()
+    meter.write(data)
+    return meter.tokens()
+
+
+class UsageMeter:
+    """
+    keeps the end of a response while it is written to find the token counts of its last chunk
+
+        wfile:  optional file the writes are passed on to
+    """
+
+    def __init__(self, wfile=None):
+        self._wfile = wfile
+        self._tail = b""
+
+    def write(self, data):
+        """keeps the end of data and writes it to the file if there is one"""
+        if self._wfile is not None:
+            self._wfile.write(data)
+        self._tail = (self._tail + bytes(data[-_TAIL_SIZE:]))[-_TAIL_SIZE:]
+
+    def flush(self):
+        """flushes the file"""
+        if self._wfile is not None:
+            self._wfile.flush()
+
+    def tokens(self):
+        """prompt and generated tokens of the response, 0 if it has no counters"""
+        counts = {}
+        for name, value in _USAGE.findall(self._tail):
+            counts[name] = int(value)
+        return counts.get(b"prompt_eval_count", counts.get(b"prompt_tokens", 0)) + counts.get(b"eval_count", counts.get(b"completion_tokens", 0))
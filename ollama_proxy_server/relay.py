@@ -0,0 +1,179 @@
+"""
+relays upstream response bodies to the clients
+
+non streaming bodies are copied through one large reusable buffer per thread,
+streamed bodies are written chunk by chunk, or with a coalescing window merged into fewer writes
+"""
+
+import select
+import threading
+import time
+
+DEFAULT_BUFFER_SIZE = 65536
+# upper bound for the coalescing window a client can ask for
+MAX_COALESCE_MS = 1000.0
+
+_buffers = threading.local()
+
+
+def _get_buffer(size):
+    """reusable buffer for this thread"""
+    buf = getattr(_buffers, "buf", None)
+    if buf is None or len(buf) != size:
+        buf = _buffers.buf = bytearray(size)
+    return buf
+
+
+def coalesce_window(header_value, default_ms=0.0):
+    """
+    coalescing window in seconds from the X-Proxy-Coalesce-Ms header value, falls back to default_ms
+    """
+    try:
+        coalesce_ms = float(header_value) if header_value is not None else default_ms
+    except ValueError:
+        coalesce_ms = default_ms
+    return min(max(coalesce_ms, 0.0), MAX_COALESCE_MS) / 1000.0
+
+
+class NdjsonCoalescer:
+    """
+    merges ndjson lines that arrive within a time window into one write
+
+    only complete lines are released so a token line is never split between writes,
+    with a window of 0 every chunk is released as is
+    """
+
+    def __init__(self, window=0.0):
+        self.window = window
+        self._buf = bytearray()
+        self._since = None
+
+    def feed(self, chunk, now=None):
+        """
+        adds a chunk, returns the bytes that should be written now or None
+        """
+        if self.window <= 0:
+            return chunk
+        now = time.monotonic() if now is None else now
+        self._buf += chunk
+        if self._since is None:
+            self._since = now
+        if now - self._since < self.window:
+            return None
+        end = self._buf.rfind(b"\n") + 1
+        if end == 0:
+            return None
+        out = bytes(self._buf[:end])
+        del self._buf[:end]
+        self._since = now if self._buf else None
+        return out
+
+    def pending(self, now=None):
+        """seconds until the complete lines held back are due, None if no complete line is held"""
+        if self._since is None or self._buf.rfind(b"\n") < 0:
+            return None
+        now = time.monotonic() if now is None else now
+        return max(0.0, self.window - (now - self._since))
+
+    def flush(self):
+        """returns everything still buffered"""
+        out = bytes(self._buf)
+        self._buf.clear()
+        self._since = None
+        return out
+
+
+def _upstream_connection(response):
+    """(buffered file, socket) the body of a requests response is read from, None if they are not known"""
+    fp = getattr(getattr(response.raw, "_fp", None), "fp", None)
+    sock = getattr(getattr(response.raw, "_connection", None), "sock", None)
+    return (fp, sock) if fp is not None and sock is not None else None
+
+
+def _readable(fp, sock, timeout):
+    """if body bytes are buffered in fp or arrive on sock within timeout seconds"""
+    previous = sock.gettimeout()
+    sock.settimeout(0.0)
+    try:
+        # the buffered bytes, or what the socket has without waiting
+        if fp.peek(1):
+            return True
+    except OSError:
+        # nothing to read without waiting on a tls socket
+        pass
+    finally:
+        sock.settimeout(previous)
+    return bool(select.select([sock], [], [], timeout)[0])
+
+
+def _with_deadline(chunks, coalescer, connection):
+    """
+    yields the chunks and b"" whenever the lines held back by coalescer are due before the next chunk arrives
+    the relaying thread waits on the upstream connection until then, no thread reads ahead
+    """
+    chunks = iter(chunks)
+    while True:
+        timeout = coalescer.pending()
+        if timeout is not None and not _readable(*connection, timeout):
+            yield b""
+            continue
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            return
+        yield chunk
+
+
+def relay_response(response, wfile, stream=True, window=0.0, buffer_size=DEFAULT_BUFFER_SIZE, on_first_write=None):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+    """
+    copies the body of a requests response opened with stream=True to wfile
+
+        response:           the upstream requests.Response
+        wfile:              file like object of the client
+        stream:             the client wants the body chunk by chunk as it is generated
+        window:             seconds that small streamed chunks may be held back to merge them
+        buffer_size:        size of the read buffer
+        on_first_write:     called once before the first byte of the body is written
+
+    returns the number of bytes written
+    """
+    raw = response.raw
+    written = 0
+    # compressed bodies need decoding so they go through the chunk path
+    if not stream and not response.headers.get("content-encoding"):
+        buf = _get_buffer(buffer_size)
+        view = memoryview(buf)
+        while True:
+            n = raw.readinto(view)
+            if not n:
+                break
+            if on_first_write is not None:
+                on_first_write()
+                on_first_write = None
+            wfile.write(view[:n])
+            written += n
+        wfile.flush()
+        return written
+
+    coalescer = NdjsonCoalescer(window)
+    chunks = raw.stream(buffer_size, decode_content=True)
+    connection = _upstream_connection(response) if window > 0 else None
+    if connection is not None:
+        chunks = _with_deadline(chunks, coalescer, connection)
+    for chunk in chunks:
+        out = coalescer.feed(chunk)
+        if out:
+            if on_first_write is not None:
+                on_first_write()
+                on_first_write = None
+            wfile.write(out)
+            wfile.flush()
+            written += len(out)
+    out = coalescer.flush()
+    if out:
+        if on_first_write is not None:
+            on_first_write()
+        wfile.write(out)
+        wfile.flush()
+        written += len(out)
+    return written
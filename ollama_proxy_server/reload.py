@@ -0,0 +1,158 @@
+"""
+reloads config.ini and authorized_users.txt while the proxy is running
+
+on SIGHUP, or when the files change on disk, only what changed is applied:
+new servers are added to the live queue, removed servers are drained and the user table is swapped in one assignment
+"""
+
+import os
+import signal
+import threading
+
+from ollama_proxy_server.ollama_logger import get_logger
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def diff_servers(current, new):
+    """
+    compares two server lists from get_config
+
+    returns (added or changed servers, names of removed servers)
+    """
+    current = dict(current)
+    changed = []
+    for name, settings in new:
+        old = current.pop(name, None)
+        # the queues keep runtime state like last_seen in the settings, only compare what the config sets
+        if old is None or any(old.get(key) != value for key, value in settings.items()):
+            changed.append((name, settings))
+    return changed, list(current)
+
+
+class ConfigReloader:  # pylint: disable=too-many-instance-attributes
+    """
+    applies changes of the config and users files
+
+        config_path:        the config.ini
+        users_path:         the authorized_users.txt
+        server_queue:       the live queue, servers are added and deleted on it
+        servers:            the server list shared with the queue
+        load_config:        function reading a server list from config_path
+        load_users:         function reading the user dict from users_path
+        on_users:           called with the new user dict when it changed
+        on_server_removed:  called with the name of a server that was removed or changed
+        interval:           seconds between checks of the files modification time, 0 only reloads on SIGHUP
+    """
+
+    def __init__(
+        self,
+        config_path,
+        users_path,
+        server_queue,
+        servers,
+        load_config,
+        load_users,
+        on_users=None,
+        on_server_removed=None,
+        interval=0.0,
+    ):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self._config_path = config_path
+        self._users_path = users_path
+        self._queue = server_queue
+        self._servers = servers
+        self._load_config = load_config
+        self._load_users = load_users
+        self._on_users = on_users
+        self._on_server_removed = on_server_removed
+        self._interval = interval
+        self._mtimes = (_mtime(config_path), _mtime(users_path))
+        self._users = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._log = get_logger(__name__, "INFO")
+
+    def reload(self, config=True, users=True):
+        """reads the files again and applies the changes, a file that can not be read leaves the old state"""
+        if config:
+            try:
+                new_servers = self._load_config(self._config_path)
+            except Exception:  # noqa: BLE001 a broken file keeps the old servers
+                self._log.exception("could not reload %s, keeping the old servers", self._config_path)
+            else:
+                self._apply_servers(new_servers)
+        if users:
+            try:
+                new_users = self._load_users(self._users_path)
+            except Exception:  # noqa: BLE001 a broken file keeps the old users
+                self._log.exception("could not reload %s, keeping the old users", self._users_path)
+            else:
+                if new_users != self._users:
+                    self._users = new_users
+                    if self._on_users is not None:
+                        self._on_users(new_users)
+                    self._log.info("reloaded %d users", len(new_users))
+
+    def _apply_servers(self, new_servers):
+        changed, removed = diff_servers(self._servers, new_servers)
+        for name in removed:
+            self._log.info("removing server %s", name)
+            self._queue.delete_server(name)
+            if self._on_server_removed is not None:
+                self._on_server_removed(name)
+        for server in changed:
+            self._log.info("adding server %s", server[0])
+            replaced = any(name == server[0] for name, _ in self._servers)
+            self._queue.add_server(server)
+            if replaced and self._on_server_removed is not None:
+                self._on_server_removed(server[0])
+
+    def check(self):
+        """reloads the files whose modification time changed"""
+        mtimes = (_mtime(self._config_path), _mtime(self._users_path))
+        if mtimes != self._mtimes:
+            config, users = (new != old for new, old in zip(mtimes, self._mtimes))
+            self._mtimes = mtimes
+            self.reload(config=config, users=users)
+
+    def _run(self):
+        while not self._stop.is_set():
+            woken = self._wake.wait(self._interval if self._interval > 0 else None)
+            if self._stop.is_set():
+                return
+            if woken:
+                self._wake.clear()
+                self._mtimes = (_mtime(self._config_path), _mtime(self._users_path))
+                self.reload()
+            else:
+                self.check()
+
+    def _on_sighup(self, signum, frame):  # pylint: disable=unused-argument
+        # do as little as possible in the signal handler, the thread does the work
+        self._wake.set()
+
+    def start(self, users=None):
+        """
+        starts the reload thread and installs the SIGHUP handler, must be called from the main thread
+
+            users:  the user dict in use, so an unchanged users file does not swap it
+        """
+        self._users = users
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, self._on_sighup)
+        self._thread = threading.Thread(target=self._run, name="config-reloader", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """stops the reload thread"""
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
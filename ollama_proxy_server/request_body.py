@@ -0,0 +1,123 @@
+"""
+request bodies read from the client before they are sent upstream
+
+small bodies stay in memory, larger ones are spooled to a temp file and read back in blocks when they are sent,
+so the memory used by one request does not grow with the size of the upload
+"""
+
+import mmap
+import tempfile
+
+from ollama_proxy_server.json_peek import ROUTING_FIELDS, peek_json
+
+DEFAULT_SPOOL_THRESHOLD = 1024 * 1024
+BLOCK_SIZE = 65536
+
+
+class BodyError(ValueError):
+    """the client sent a body we cant read"""
+
+
+class RequestBody:
+    """
+    a request body in memory or in a temp file
+
+    can be passed as data to requests, it has a length so it is sent with a Content-Length
+    and it can be iterated more than once if a request has to be sent again
+
+        spool_threshold:    bodies larger than this many bytes are moved to a temp file
+        block_size:         size of the blocks the body is sent in
+    """
+
+    def __init__(self, spool_threshold=DEFAULT_SPOOL_THRESHOLD, block_size=BLOCK_SIZE):
+        self._file = tempfile.SpooledTemporaryFile(max_size=spool_threshold)  # noqa: SIM115 pylint: disable=consider-using-with
+        self._block_size = block_size
+        self._map = None
+        self.size = 0
+
+    @classmethod
+    def read_from(cls, rfile, headers, spool_threshold=DEFAULT_SPOOL_THRESHOLD, block_size=BLOCK_SIZE):
+        """
+        reads the body of a request from a blocking file like object
+
+            rfile:      the client stream
+            headers:    the request headers, Content-Length and Transfer-Encoding are used
+        """
+        body = cls(spool_threshold, block_size)
+        try:
+            if (headers.get("Transfer-Encoding") or "").lower() == "chunked":
+                body._read_chunked(rfile)
+            elif headers.get("Content-Length"):
+                body._read_length(rfile, int(headers["Content-Length"]))
+        except BaseException:
+            body.close()
+            raise
+        return body
+
+    def _read_length(self, rfile, length):
+        while length > 0:
+            data = rfile.read(min(self._block_size, length))
+            if not data:
+                raise BodyError("client closed the connection inside the body")
+            self.write(data)
+            length -= len(data)
+
+    def _read_chunked(self, rfile):
+        while True:
+            line = rfile.readline(1024)
+            if not line:
+                raise BodyError("client closed the connection inside a chunked body")
+            try:
+                size = int(line.split(b";", 1)[0].strip(), 16)
+            except ValueError as ex:
+                raise BodyError(f"bad chunk size {line!r}") from ex
+            if size == 0:
+                # skip trailers
+                while rfile.readline(1024) not in (b"\r\n", b"\n", b""):
+                    pass
+                return
+            self._read_length(rfile, size)
+            rfile.readline(1024)
+
+    def write(self, data):
+        """appends data to the body"""
+        self._file.write(data)
+        self.size += len(data)
+
+    @property
+    def spooled(self):
+        """if the body has been moved to a temp file"""
+        return getattr(self._file, "_rolled", False)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        self._file.seek(0)
+        while True:
+            data = self._file.read(self._block_size)
+            if not data:
+                return
+            yield data
+
+    def view(self):
+        """the body as bytes, or a read only memory map of the temp file"""
+        if not self.spooled or self.size == 0:
+            self._file.seek(0)
+            return self._file.read()
+        if self._map is None:
+            self._file.flush()
+            self._map = mmap.mmap(self._file.fileno(), self.size, access=mmap.ACCESS_READ)
+        return self._map
+
+    def peek(self, fields=ROUTING_FIELDS):
+        """the top level json fields needed for routing, see json_peek.peek_json"""
+        # a body on disk is scanned however many values it has, decoding all of it would load it in memory
+        return peek_json(self.view(), fields, limit_skips=not self.spooled)
+
+    def close(self):
+        """frees the memory or the temp file"""
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
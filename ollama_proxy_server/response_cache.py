@@ -0,0 +1,194 @@
+"""
+cache of complete responses to deterministic /api/generate and /api/chat requests
+
+a request is deterministic when it asks for temperature 0 and a fixed seed, the same request then always gets the
+same answer so it can be replayed without a generation. streamed responses are kept as the chunks that were sent
+and replayed chunk by chunk, so streaming clients get the same ndjson
+"""
+
+import collections
+import hashlib
+import json
+import threading
+import time
+
+from ollama_proxy_server.ollama_queues.residency import normalize_model
+
+CACHED_PATHS = ("/api/generate", "/api/chat")
+# fields needed to tell if a request can be cached
+CACHE_FIELDS = ("model", "stream", "options")
+# fields that do not change what is generated
+_IGNORED_FIELDS = ("keep_alive",)
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def is_deterministic(fields):
+    """if the request fields ask for greedy sampling with a fixed seed"""
+    options = fields.get("options")
+    if not isinstance(options, dict):
+        return False
+    return _is_number(options.get("temperature")) and options["temperature"] == 0 and _is_number(options.get("seed"))
+
+
+def cache_key(path, body):
+    """
+    canonical hash of a request, None if it must not be cached
+
+        path:   the endpoint
+        body:   the decoded request body
+    """
+    if path not in CACHED_PATHS or not isinstance(body, dict) or not isinstance(body.get("model"), str) or not is_deterministic(body):
+        return None
+    data = {key: value for key, value in body.items() if key not in _IGNORED_FIELDS}
+    data["model"] = normalize_model(data["model"])
+    # ollama streams when stream is missing
+    data["stream"] = bool(data.get("stream", True))
+    canonical = json.dumps([path, data], sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class CachedResponse:  # pylint: disable=too-few-public-methods
+    """
+    a response kept in the cache
+
+        content_type:   the Content-Type header of the response
+        chunks:         the body as the chunks that were written to the client
+    """
+
+    def __init__(self, content_type, chunks, expires):
+        self.content_type = content_type
+        self.chunks = chunks
+        self.expires = expires
+        self.size = sum(len(chunk) for chunk in chunks)
+
+
+class ResponseCache:  # pylint: disable=too-many-instance-attributes
+    """
+    bounded lru cache of responses
+
+        max_bytes:          total size of the bodies kept
+        ttl:                seconds a response is kept
+        max_entry_bytes:    larger responses are not kept, max_bytes / 8 if None
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=3600.0, max_entry_bytes=None):
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self.max_entry_bytes = max_entry_bytes if max_entry_bytes is not None else max_bytes // 8
+        # key -> CachedResponse
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, now=None):
+        """the CachedResponse of key or None"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry.expires > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def put(self, key, content_type, chunks, now=None):
+        """keeps a response, returns False if it is too large"""
+        now = time.monotonic() if now is None else now
+        entry = CachedResponse(content_type, tuple(chunks), now + self._ttl)
+        if entry.size > self.max_entry_bytes:
+            return False
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._bytes += entry.size
+            while self._bytes > self._max_bytes:
+                self._remove(next(iter(self._entries)))
+        return True
+
+    def _remove(self, key):
+        """must hold the lock"""
+        self._bytes -= self._entries.pop(key).size
+
+    def recorder(self, key, content_type, wfile=None):
+        """a ResponseRecorder that puts the response in this cache"""
+        return ResponseRecorder(self, key, content_type, wfile)
+
+    def clear(self):
+        """forgets all responses"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """hit and miss counters and the size of the cache"""
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries), "bytes": self._bytes}
+
+
+class ResponseRecorder:
+    """
+    records the chunks of a response while they are written to the client
+
+        cache:          the ResponseCache to put the response in
+        key:            the cache key of the request
+        content_type:   the Content-Type header of the response
+        wfile:          optional client file, writes are passed on to it
+    """
+
+    def __init__(self, cache, key, content_type, wfile=None):
+        self._cache = cache
+        self._key = key
+        self._content_type = content_type
+        self._wfile = wfile
+        self._chunks = []
+        self._size = 0
+        self._failed = False
+
+    def write(self, data):
+        """records data and writes it to the client file if there is one"""
+        if self._wfile is not None:
+            try:
+                self._wfile.write(data)
+            except BaseException:
+                self._failed = True
+                raise
+        if not self._failed:
+            self._size += len(data)
+            if self._size > self._cache.max_entry_bytes:
+                # too large to be kept, stop copying
+                self._failed = True
+                self._chunks = []
+            else:
+                self._chunks.append(bytes(data))
+
+    def flush(self):
+        """flushes the client file"""
+        if self._wfile is not None:
+            try:
+                self._wfile.flush()
+            except BaseException:
+                self._failed = True
+                raise
+
+    def commit(self):
+        """
+        puts the response in the cache if it was written completely
+        a complete ollama response ends with a json line with done true, errors and cut streams are not kept
+        """
+        if self._failed or not self._chunks:
+            return False
+        # a non streamed body is one line over many chunks
+        last = b"".join(self._chunks).rstrip().rsplit(b"\n", 1)[-1]
+        try:
+            done = json.loads(last).get("done") is True
+        except (ValueError, AttributeError):
+            done = False
+        return done and self._cache.put(self._key, self._content_type, self._chunks)
@@ -0,0 +1,160 @@
+"""
+keep alive connection pools towards the backend servers
+one requests session per server shared by all handler threads
+"""
+
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from ollama_proxy_server.ollama_logger import get_logger
+
+# seconds the last request of this thread spent opening connections
+_connect_time = threading.local()
+
+
+class _TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            _connect_time.value = getattr(_connect_time, "value", 0.0) + time.perf_counter() - start
+
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            super().connect()  # pylint: disable=no-member
+        finally:
+            _connect_time.value = getattr(_connect_time, "value", 0.0) + time.perf_counter() - start
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class UpstreamPool:  # pylint: disable=too-many-instance-attributes
+    """
+    one pooled requests session per backend server
+
+        pool_size:      max idle connections kept per server
+        idle_timeout:   seconds a server can be unused before its connections are closed
+    """
+
+    def __init__(self, pool_size=10, idle_timeout=60.0):
+        self._pool_size = pool_size
+        self._idle_timeout = idle_timeout
+        self._sessions = {}
+        self._last_used = {}
+        # counters from sessions we have evicted
+        self._closed_stats = {}
+        self._lock = threading.Lock()
+        self._next_eviction = time.monotonic() + idle_timeout / 2
+        self._log = get_logger(__name__, "INFO")
+
+    def _new_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self._pool_size, pool_block=False)
+        adapter.poolmanager.pool_classes_by_scheme = {"http": _TimedHTTPConnectionPool, "https": _TimedHTTPSConnectionPool}
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def session(self, server_name):
+        """gets the session for a server, creates it if needed"""
+        now = time.monotonic()
+        if now >= self._next_eviction:
+            self.evict_idle(now)
+        with self._lock:
+            session = self._sessions.get(server_name)
+            if session is None:
+                session = self._sessions[server_name] = self._new_session()
+            self._last_used[server_name] = now
+        return session
+
+    def request(self, server_name, method, url, **kwargs):
+        """same as requests.request but over the pooled session of the server"""
+        _connect_time.value = 0.0
+        return self.session(server_name).request(method, url, **kwargs)
+
+    @staticmethod
+    def connect_time():
+        """seconds the last request of this thread spent connecting, 0 if it reused a connection"""
+        return getattr(_connect_time, "value", 0.0)
+
+    @staticmethod
+    def _session_stats(session):
+        stats = {"connections": 0, "requests": 0}
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            # the pool container does not support plain iteration
+            for key in pools.keys():  # noqa: SIM118
+                pool = pools.get(key)
+                if pool is not None:
+                    stats["connections"] += pool.num_connections
+                    stats["requests"] += pool.num_requests
+        return stats
+
+    def _close(self, server_name):
+        """closes a session, must hold the lock"""
+        session = self._sessions.pop(server_name, None)
+        self._last_used.pop(server_name, None)
+        if session is None:
+            return
+        closed = self._closed_stats.setdefault(server_name, {"connections": 0, "requests": 0})
+        for key, value in self._session_stats(session).items():
+            closed[key] += value
+        session.close()
+
+    def evict_idle(self, now=None):
+        """closes the connections of servers that have been idle longer than idle_timeout"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._next_eviction = now + self._idle_timeout / 2
+            idle = [name for name, last in self._last_used.items() if now - last > self._idle_timeout]
+            for name in idle:
+                self._close(name)
+        if idle:
+            self._log.debug("evicted idle sessions %s", idle)
+        return idle
+
+    def remove(self, server_name):
+        """closes the session for a server that is not scheduled any more"""
+        with self._lock:
+            self._close(server_name)
+            self._closed_stats.pop(server_name, None)
+
+    def close(self):
+        """closes all sessions"""
+        with self._lock:
+            for name in list(self._sessions):
+                self._close(name)
+
+    def stats(self):
+        """
+        connection counters per server
+
+        returns dict of server -> {connections, requests, reused}
+            connections:    new connections opened
+            requests:       requests sent
+            reused:         requests sent on an already open connection
+        """
+        with self._lock:
+            result = {name: dict(stats) for name, stats in self._closed_stats.items()}
+            for name, session in self._sessions.items():
+                stats = result.setdefault(name, {"connections": 0, "requests": 0})
+                for key, value in self._session_stats(session).items():
+                    stats[key] += value
+        for stats in result.values():
+            stats["reused"] = max(0, stats["requests"] - stats["connections"])
+        return result
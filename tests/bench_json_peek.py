@@ -0,0 +1,90 @@
+"""
+micro benchmark of json_peek against json.loads on request bodies
+
+measures a multimodal /api/generate body with large base64 images and a long /api/chat body
+
+    peek_us     time of peek_json in microseconds, best of the repeats
+    loads_us    time of json.loads of the same body in microseconds
+
+    python -m tests.bench_json_peek --json peek.json
+
+it exits with 1 when peek_json is not at least 5 times faster than json.loads on the multimodal body, or takes more
+than 3 times as long on the chat body where it gives up early and decodes it all
+"""
+
+import argparse
+import base64
+import json
+import os
+import sys
+import timeit
+
+from ollama_proxy_server.json_peek import peek_json
+
+
+def multimodal_body(image_size=4 * 1024 * 1024, images=2, model_last=True):
+    """an /api/generate body with images of image_size bytes, the model after the images if model_last"""
+    images = [base64.b64encode(os.urandom(image_size * 3 // 4)).decode("ascii") for _ in range(images)]
+    fields = {"prompt": "describe the images", "images": images, "options": {"temperature": 0.2, "stop": ["\n", "}"]}}
+    if model_last:
+        fields.update({"stream": False, "model": "llava:13b"})
+    else:
+        fields = {"model": "llava:13b", "stream": False, **fields}
+    return json.dumps(fields).encode("utf-8")
+
+
+def chat_body(messages=200):
+    """an /api/chat body with messages messages"""
+    return json.dumps(
+        {
+            "model": "llama3.2",
+            "messages": [{"role": "user", "content": f'message {i} with "quotes" and \\ backslashes é', "images": []} for i in range(messages)],
+        }
+    ).encode("utf-8")
+
+
+def bench(name, body, number=5, repeat=3):
+    """times peek_json and json.loads on body, returns the result dict"""
+    peek = min(timeit.repeat(lambda: peek_json(body), number=number, repeat=repeat)) / number
+    loads = min(timeit.repeat(lambda: json.loads(body), number=number, repeat=repeat)) / number
+    return {"body": name, "bytes": len(body), "peek_us": round(peek * 1e6, 1), "loads_us": round(loads * 1e6, 1)}
+
+
+def run(image_size=4 * 1024 * 1024, number=5):
+    """runs both cases, returns the report dict"""
+    cases = [bench("multimodal", multimodal_body(image_size), number), bench("chat", chat_body(), number * 4)]
+    return {"python": sys.version.split()[0], "cases": cases}
+
+
+def check(report):
+    """the cases where peek_json is not fast enough, an empty list if there are none"""
+    problems = []
+    for case in report["cases"]:
+        if case["body"] == "multimodal" and case["peek_us"] * 5 >= case["loads_us"]:
+            problems.append(f"multimodal peek_us {case['peek_us']} is not 5 times below loads_us {case['loads_us']}")
+        # giving up early costs little on top of json.loads
+        if case["body"] == "chat" and case["peek_us"] >= case["loads_us"] * 3:
+            problems.append(f"chat peek_us {case['peek_us']} is 3 times loads_us {case['loads_us']} or more")
+    return problems
+
+
+def main():
+    """command line of the json_peek benchmark"""
+    parser = argparse.ArgumentParser(description="Micro benchmark of json_peek against json.loads")
+    parser.add_argument("--image_size", type=int, default=4 * 1024 * 1024, help="Bytes of each of the two images of the multimodal body")
+    parser.add_argument("--number", type=int, default=5, help="Calls per timing of the multimodal body, four times as many for the chat body")
+    parser.add_argument("--json", default=None, help="Write the report to this file")
+    args = parser.parse_args()
+    report = run(args.image_size, args.number)
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+    problems = check(report)
+    for problem in problems:
+        print("too slow:", problem, file=sys.stderr)
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
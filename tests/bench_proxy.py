@@ -0,0 +1,301 @@
+"""
+load test of the proxy against local fake ollama backends, runs offline
+
+starts backends fake ollama servers and the proxy in a subprocess, sends the same streamed requests to one backend
+directly and through the proxy from concurrent clients, and reports
+
+    requests_per_s          requests per second through the proxy
+    latency_ms              p50 and p99 of the whole request through the proxy
+    added_latency_ms        p50 and p99 the proxy adds compared to the backend directly
+    ttft_ms                 p50 and p99 of the time to the first streamed line through the proxy
+    cpu_s_per_1k_streams    cpu seconds the proxy spends per 1000 requests
+    rss_mb                  peak memory of the proxy
+    rss_mb_per_1k_streams   memory the proxy grew by per 1000 requests
+
+both engines are measured one after the other unless --engine picks one, the report has one run per engine
+
+    python -m tests.bench_proxy --backends 4 --requests 2000 --concurrency 64 --json report.json
+    python -m tests.bench_proxy --compare report.json
+
+with --compare it exits with 1 when the requests per second dropped or the added latency grew by more than
+--tolerance compared to the run of the same engine in an earlier report
+"""
+
+import argparse
+import json
+import math
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from .fake_ollama import FakeOllama
+
+AUTH = {"Authorization": "Bearer bench:key"}
+PATHS = {"generate": "/api/generate", "chat": "/api/chat", "embed": "/api/embed"}
+ENGINES = ("threaded", "asyncio")
+
+
+def percentile(values, fraction):
+    """nearest rank percentile of values, 0 if there are none"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _proc_stats(pid):
+    """(cpu seconds, rss MB, peak rss MB) of a process, None where /proc is not there"""
+    try:
+        with open(f"/proc/{pid}/stat", encoding="ascii") as stat:
+            fields = stat.read().rsplit(")", 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        memory = {}
+        with open(f"/proc/{pid}/status", encoding="ascii") as status:
+            for line in status:
+                name, _, value = line.partition(":")
+                if name in ("VmRSS", "VmHWM"):
+                    memory[name] = int(value.split()[0]) / 1024
+        return cpu, memory.get("VmRSS"), memory.get("VmHWM")
+    except (OSError, ValueError, IndexError):
+        return None, None, None
+
+
+def _request_body(kind, model, i):
+    if kind == "embed":
+        return {"model": model, "input": [f"text {i}"]}
+    if kind == "chat":
+        return {"model": model, "messages": [{"role": "user", "content": f"hi {i}"}]}
+    return {"model": model, "prompt": f"hi {i}"}
+
+
+class LoadGenerator:
+    """
+    sends requests from concurrent clients and times them
+
+        url:            base url of the proxy or of a backend
+        kind:           generate, chat or embed
+        concurrency:    clients sending at the same time, every client keeps its connection
+    """
+
+    def __init__(self, url, kind="generate", concurrency=16, model="llama3.2"):
+        self.url = url
+        self.kind = kind
+        self.concurrency = concurrency
+        self.model = model
+        self._local = threading.local()
+
+    def _session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def _one(self, i):
+        """(ok, seconds, seconds to the first line) of one request"""
+        start = time.perf_counter()
+        first = None
+        try:
+            with self._session().post(self.url + PATHS[self.kind], json=_request_body(self.kind, self.model, i), headers=AUTH, stream=True, timeout=60) as res:
+                for _ in res.iter_lines():
+                    if first is None:
+                        first = time.perf_counter() - start
+                ok = res.status_code == 200
+        except requests.RequestException:
+            ok = False
+        total = time.perf_counter() - start
+        return ok, total, first if first is not None else total
+
+    def run(self, count):
+        """sends count requests, returns (seconds, list of (ok, seconds, seconds to first line))"""
+        start = time.perf_counter()
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            results = list(pool.map(self._one, range(count)))
+        return time.perf_counter() - start, results
+
+
+class ProxyProcess:
+    """
+    the proxy in a subprocess in front of the backends
+
+        backends:   FakeOllama servers
+        engine:             threaded or asyncio
+        extra_args:         more command line arguments of the proxy
+        max_concurrency:    slots of every backend
+    """
+
+    def __init__(self, backends, engine="asyncio", extra_args=(), max_concurrency=64):
+        self.backends = backends
+        self.engine = engine
+        self.extra_args = list(extra_args)
+        self.max_concurrency = max_concurrency
+        self.port = _free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self._dir = None
+        self._process = None
+
+    @property
+    def pid(self):
+        """pid of the proxy"""
+        return self._process.pid
+
+    def start(self, timeout=15.0):
+        """starts the proxy and waits until it answers"""
+        self._dir = tempfile.TemporaryDirectory()
+        config = os.path.join(self._dir.name, "config.ini")
+        users = os.path.join(self._dir.name, "users.txt")
+        with open(config, "w", encoding="utf-8") as file:
+            file.writelines(f"[Backend{i}]\nurl = {backend.url}\nmax_concurrency = {self.max_concurrency}\n\n" for i, backend in enumerate(self.backends))
+        with open(users, "w", encoding="utf-8") as file:
+            file.write("bench:key\n")
+        # fmt: off
+        args = [
+            sys.executable, "-m", "ollama_proxy_server.main",
+            "--config", config, "--users_list", users, "--port", str(self.port), "--engine", self.engine,
+            "--log_path", os.path.join(self._dir.name, "access_log.txt"), "--ps_interval", "0", "--health_interval", "0",
+            *self.extra_args,
+        ]
+        # fmt: on
+        self._process = subprocess.Popen(args, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self._process.poll() is not None:
+                raise RuntimeError(f"the proxy exited with {self._process.returncode}")
+            try:
+                requests.get(self.url + "/api/version", headers=AUTH, timeout=1)
+                return self
+            except requests.RequestException:
+                time.sleep(0.1)
+        self.stop()
+        raise RuntimeError("the proxy did not start")
+
+    def stop(self):
+        """stops the proxy"""
+        if self._process is not None:
+            self._process.terminate()
+            try:
+                self._process.wait(10)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+                self._process.wait()
+        if self._dir is not None:
+            self._dir.cleanup()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def _ms(values):
+    return {"p50": round(percentile(values, 0.5) * 1000, 3), "p99": round(percentile(values, 0.99) * 1000, 3)}
+
+
+def run(engine="asyncio", backends=2, count=200, concurrency=16, kind="generate", tokens=32, ttft=0.0, tokens_per_second=0.0, load_delay=0.0, extra_args=()):
+    """runs a load test, returns the report dict"""
+    fakes = [FakeOllama(tokens=["tok "] * tokens, load_delay=load_delay, ttft=ttft, tokens_per_second=tokens_per_second).start() for _ in range(backends)]
+    try:
+        # warm up the models and the connections, then the same load straight to one backend
+        LoadGenerator(fakes[0].url, kind, concurrency).run(concurrency)
+        _, direct = LoadGenerator(fakes[0].url, kind, concurrency).run(count)
+        with ProxyProcess(fakes, engine, extra_args) as proxy:
+            generator = LoadGenerator(proxy.url, kind, concurrency)
+            generator.run(concurrency)
+            cpu_before, rss_before, _ = _proc_stats(proxy.pid)
+            duration, results = generator.run(count)
+            cpu_after, rss_after, rss_peak = _proc_stats(proxy.pid)
+    finally:
+        for fake in fakes:
+            fake.stop()
+    latencies = [seconds for ok, seconds, _ in results if ok]
+    direct_latencies = [seconds for ok, seconds, _ in direct if ok]
+    report = {
+        "engine": engine,
+        "kind": kind,
+        "backends": backends,
+        "requests": count,
+        "concurrency": concurrency,
+        "errors": sum(1 for ok, _, _ in results if not ok),
+        "duration_s": round(duration, 3),
+        "requests_per_s": round(count / duration, 1),
+        "latency_ms": _ms(latencies),
+        "direct_latency_ms": _ms(direct_latencies),
+        "ttft_ms": _ms([first for ok, _, first in results if ok]),
+    }
+    report["added_latency_ms"] = {name: round(report["latency_ms"][name] - report["direct_latency_ms"][name], 3) for name in ("p50", "p99")}
+    if cpu_before is not None and cpu_after is not None:
+        report["cpu_s_per_1k_streams"] = round((cpu_after - cpu_before) * 1000 / count, 3)
+        report["rss_mb"] = round(rss_peak, 1)
+        report["rss_mb_per_1k_streams"] = round((rss_after - rss_before) * 1000 / count, 2)
+    return report
+
+
+def compare(report, baseline, tolerance=0.2):
+    """the regressions of report compared to baseline, an empty list if there are none"""
+    problems = []
+    if report["requests_per_s"] < baseline["requests_per_s"] * (1 - tolerance):
+        problems.append(f"requests_per_s {report['requests_per_s']} < {baseline['requests_per_s']}")
+    for name in ("p50", "p99"):
+        # a few milliseconds of noise are not a regression
+        limit = baseline["added_latency_ms"][name] * (1 + tolerance) + 5
+        if report["added_latency_ms"][name] > limit:
+            problems.append(f"added_latency_ms {name} {report['added_latency_ms'][name]} > {limit:.3f}")
+    return problems
+
+
+def main():
+    """command line of the load test"""
+    parser = argparse.ArgumentParser(description="Load test of the proxy against local fake ollama backends")
+    parser.add_argument("--engine", nargs="+", choices=ENGINES, default=list(ENGINES), help="Engines of the proxy measured")
+    parser.add_argument("--backends", type=int, default=2, help="Fake ollama backends started")
+    parser.add_argument("--requests", type=int, default=1000, help="Requests sent through the proxy")
+    parser.add_argument("--concurrency", type=int, default=32, help="Clients sending at the same time")
+    parser.add_argument("--kind", choices=sorted(PATHS), default="generate", help="Endpoint requested")
+    parser.add_argument("--tokens", type=int, default=32, help="Tokens streamed per response")
+    parser.add_argument("--ttft", type=float, default=0.0, help="Seconds the backends take to the first token")
+    parser.add_argument("--tokens_per_second", type=float, default=0.0, help="Rate the backends stream tokens at, 0 as fast as possible")
+    parser.add_argument("--load_delay", type=float, default=0.0, help="Seconds the backends take to load a model")
+    parser.add_argument("--json", default=None, help="Write the report to this file")
+    parser.add_argument("--compare", default=None, help="Report of an earlier run, exit with 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Fraction the results may be worse than the earlier report")
+    parser.add_argument("proxy_args", nargs="*", help="More arguments of the proxy, after --")
+    args = parser.parse_args()
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as file:
+            baseline = json.load(file)
+    report = {
+        "runs": [
+            run(engine, args.backends, args.requests, args.concurrency, args.kind, args.tokens, args.ttft, args.tokens_per_second, args.load_delay, args.proxy_args)
+            for engine in args.engine
+        ]
+    }
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+    if baseline is not None:
+        earlier = {before["engine"]: before for before in baseline["runs"]}
+        problems = [
+            f"{after['engine']} {problem}" for after in report["runs"] if after["engine"] in earlier for problem in compare(after, earlier[after["engine"]], args.tolerance)
+        ]
+        for problem in problems:
+            print("regression:", problem, file=sys.stderr)
+        sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
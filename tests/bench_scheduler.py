@@ -0,0 +1,217 @@
+"""
+micro benchmarks of the schedulers at fleet scale
+
+builds a config of 10 to 1000 servers with a mix of white lists, black lists and glob patterns, read with
+get_config(..., "read_string") like a real config.ini, and measures for SimpleQueue and ModelLoadedQueue, with and
+without ModelResidency
+
+    ops_per_s       enqueue and dequeue pairs per second over all threads
+    us_per_op       p50 and p99 of one enqueue and dequeue pair in microseconds
+
+with one thread it is the cost of scheduling, with more it is the contention on the queue. the waiting cases take
+every slot, let 1000 to 10000 requests wait, most of them for servers that stay busy, and measure
+
+    us_per_release  p50 and p99 of a dequeue handing the released slot to a waiter in microseconds
+
+    python -m tests.bench_scheduler --servers 10 100 1000 --threads 1 8 32 --waiters 1000 10000 --json baseline.json
+    python -m tests.bench_scheduler --compare baseline.json
+
+with --compare it exits with 1 when a case got slower by more than --tolerance compared to an earlier report
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import threading
+import time
+
+from ollama_proxy_server import ollama_queues
+from ollama_proxy_server.main import get_config
+
+from .bench_proxy import percentile
+
+MODELS = ["llama3.2", "llama3.2:1b", "llama3.1:70b", "qwen2.5:7b", "qwen2.5:32b", "mistral", "phi3", "gemma2:9b", "nomic-embed-text", "deepseek-r1:14b"]
+QUEUES = ("simple", "model", "model_residency")
+
+
+def synthetic_config(count, seed=0):
+    """
+    a config.ini text with count servers
+
+    a third of them have a white list, some with glob patterns, a third a black list, the others take every model.
+    the last server takes every model so each model has a server
+    """
+    rng = random.Random(seed)
+    sections = []
+    for i in range(count):
+        lines = [f"[Server{i:04d}]", f"url = http://10.0.{i // 256}.{i % 256}:11434", f"max_concurrency = {rng.choice((1, 2, 4, 8))}"]
+        kind = i % 3 if i < count - 1 else 2
+        if kind == 0:
+            models = rng.sample(MODELS, 3) + (["qwen2.5:*"] if rng.random() < 0.5 else [])
+            lines.append(f"model_white_list = {json.dumps(models)}")
+        elif kind == 1:
+            models = rng.sample(MODELS, 2) + (["llama3.*"] if rng.random() < 0.5 else [])
+            lines.append(f"model_black_list = {json.dumps(models)}")
+        sections.append("\n".join(lines))
+    return "\n\n".join(sections) + "\n"
+
+
+def make_queue(kind, servers):
+    """a queue of kind, one of QUEUES, over servers"""
+    if kind == "simple":
+        return ollama_queues.SimpleQueue(servers)
+    if kind == "model":
+        return ollama_queues.ModelLoadedQueue(servers)
+    return ollama_queues.ModelLoadedQueue(servers, residency=ollama_queues.ModelResidency(servers))
+
+
+def _worker(queue, ops, seed, start, timings):
+    rng = random.Random(seed)
+    requests = [{"model": rng.choice(MODELS), "user": f"user{rng.randrange(50)}"} for _ in range(64)]
+    start.wait()
+    local = []
+    for i in range(ops):
+        request = requests[i % len(requests)]
+        begin = time.perf_counter()
+        server = queue.enqueue(request)
+        queue.dequeue(server[0], True)
+        local.append(time.perf_counter() - begin)
+    timings.extend(local)
+
+
+def bench(kind, servers, threads=1, ops=10000, seed=0):
+    """runs one case, ops enqueue and dequeue pairs spread over threads, returns its result dict"""
+    queue = make_queue(kind, get_config(synthetic_config(servers, seed), "read_string"))
+    start = threading.Event()
+    timings = []
+    per_thread = max(1, ops // threads)
+    workers = [threading.Thread(target=_worker, args=(queue, per_thread, seed + i, start, timings)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    begin = time.perf_counter()
+    start.set()
+    for worker in workers:
+        worker.join()
+    duration = time.perf_counter() - begin
+    if any(queue.in_flight().values()):
+        raise RuntimeError(f"{kind} leaked slots")
+    return {
+        "queue": kind,
+        "servers": servers,
+        "threads": threads,
+        "ops": len(timings),
+        "ops_per_s": round(len(timings) / duration, 1),
+        "us_per_op": {"p50": round(percentile(timings, 0.5) * 1e6, 2), "p99": round(percentile(timings, 0.99) * 1e6, 2)},
+    }
+
+
+def bench_waiting(kind, servers, waiters=1000, releases=1000, seed=0):
+    """
+    runs one waiting case, returns its result dict
+
+    every slot is taken and waiters requests wait on an event loop. the first ones, for random models, can not use the
+    first half of the servers, the last releases ones can use any. then slots of random servers of the first half are
+    released one at a time, each handed to one of the last waiters past all the ones before it
+    """
+    queue = make_queue(kind, get_config(synthetic_config(servers, seed), "read_string"))
+    rng = random.Random(seed)
+    for _ in range(sum(queue.limits().values())):
+        queue.enqueue()
+    released = sorted(queue.limits())[: max(1, servers // 2)]
+    releases = min(releases, waiters // 2)
+    filters = [{"model": rng.choice(MODELS), "user": "bench", "exclude": set(released)} for _ in range(waiters - releases)]
+    filters += [{"user": "bench"} for _ in range(releases)]
+    loop = asyncio.new_event_loop()
+    tasks = [loop.create_task(queue.enqueue_async(filter_)) for filter_ in filters]
+    # every task puts its reservation in line on its first step
+    loop.run_until_complete(asyncio.sleep(0))
+    if queue.waiting() != waiters:
+        raise RuntimeError(f"{kind} has {queue.waiting()} waiters instead of {waiters}")
+    busy = list(released)
+    timings = []
+    for _ in range(releases):
+        name = rng.choice(busy)
+        begin = time.perf_counter()
+        queue.dequeue(name)
+        timings.append(time.perf_counter() - begin)
+        if not queue.get_length(name):
+            busy.remove(name)
+    for task in tasks:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+    loop.close()
+    return {
+        "queue": kind,
+        "servers": servers,
+        "waiters": waiters,
+        "releases": len(timings),
+        "us_per_release": {"p50": round(percentile(timings, 0.5) * 1e6, 2), "p99": round(percentile(timings, 0.99) * 1e6, 2)},
+    }
+
+
+def run(servers=(10, 100, 1000), threads=(1, 8), ops=10000, queues=QUEUES, seed=0, waiters=(1000, 10000)):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+    """runs every case, returns the report dict"""
+    cases = [bench(kind, count, thread_count, ops, seed) for kind in queues for count in servers for thread_count in threads]
+    waiting = [bench_waiting(kind, count, waiter_count, min(ops, waiter_count), seed) for kind in queues for count in servers for waiter_count in waiters]
+    return {"python": sys.version.split()[0], "cases": cases, "waiting": waiting}
+
+
+def _key(case):
+    return case["queue"], case["servers"], case["threads"]
+
+
+def _waiting_key(case):
+    return case["queue"], case["servers"], case["waiters"]
+
+
+def compare(report, baseline, tolerance=0.2):
+    """the cases of report slower than in baseline, an empty list if there are none"""
+    earlier = {_key(case): case for case in baseline["cases"]}
+    problems = []
+    for case in report["cases"]:
+        before = earlier.get(_key(case))
+        if before is not None and case["ops_per_s"] < before["ops_per_s"] * (1 - tolerance):
+            problems.append(f"{case['queue']} servers={case['servers']} threads={case['threads']} ops_per_s {case['ops_per_s']} < {before['ops_per_s']}")
+    earlier = {_waiting_key(case): case for case in baseline.get("waiting", [])}
+    for case in report.get("waiting", []):
+        before = earlier.get(_waiting_key(case))
+        if before is not None and case["us_per_release"]["p50"] > before["us_per_release"]["p50"] * (1 + tolerance):
+            problems.append(
+                f"{case['queue']} servers={case['servers']} waiters={case['waiters']} us_per_release {case['us_per_release']['p50']} > {before['us_per_release']['p50']}"
+            )
+    return problems
+
+
+def main():
+    """command line of the scheduler benchmarks"""
+    parser = argparse.ArgumentParser(description="Micro benchmarks of the schedulers with many servers")
+    parser.add_argument("--servers", type=int, nargs="+", default=[10, 100, 1000], help="Server counts of the synthetic configs")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 8, 32], help="Threads enqueuing and dequeuing at the same time")
+    parser.add_argument("--ops", type=int, default=10000, help="Enqueue and dequeue pairs per case, at most that many releases per waiting case")
+    parser.add_argument("--waiters", type=int, nargs="*", default=[1000, 10000], help="Requests waiting for a slot in the waiting cases")
+    parser.add_argument("--queues", nargs="+", choices=QUEUES, default=list(QUEUES), help="Schedulers measured")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic configs and requests")
+    parser.add_argument("--json", default=None, help="Write the report to this file")
+    parser.add_argument("--compare", default=None, help="Report of an earlier run, exit with 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Fraction a case may be slower than in the earlier report")
+    args = parser.parse_args()
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as file:
+            baseline = json.load(file)
+    report = run(args.servers, args.threads, args.ops, args.queues, args.seed, args.waiters)
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+    if baseline is not None:
+        problems = compare(report, baseline, args.tolerance)
+        for problem in problems:
+            print("regression:", problem, file=sys.stderr)
+        sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""
+fake ollama backend used by the tests, runs on a random local port
+"""
+
+import datetime
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def fake_embedding(text, dim=4):
+    """deterministic embedding for a text"""
+    digest = hashlib.sha256(text.encode("utf-8")).digest()
+    return [b / 255.0 for b in digest[:dim]]
+
+
+def _tagged(model):
+    return model if ":" in model else f"{model}:latest"
+
+
+class _Server(ThreadingHTTPServer):
+    # the load tests open many connections at once
+    request_queue_size = 256
+    daemon_threads = True
+
+
+class FakeOllama:
+    """
+    emulates the ollama endpoints the proxy uses
+
+        load_delay:         seconds a request for a model that is not loaded waits for it to load
+        ttft:               seconds until the first token or the embeddings
+        tokens_per_second:  rate the tokens are streamed at after the first, 0 sends them at once
+    """
+
+    def __init__(self, tokens=("Hello", " ", "world", "!"), models=("llama3.2",), load_delay=0.0, ttft=0.0, tokens_per_second=0.0):
+        self.tokens = list(tokens)
+        self.models = list(models)
+        self.load_delay = load_delay
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        # model -> epoch seconds it stays loaded
+        self.loaded = {}
+        self.keep_alive = 300
+        # status of the generate and chat answers when set, like a server out of memory
+        self.fail_status = None
+        self.requests = []
+        self._lock = threading.Lock()
+        self._httpd = _Server(("127.0.0.1", 0), self._make_handler())
+        self._thread = None
+
+    @property
+    def url(self):
+        """base url of the fake server"""
+        return f"http://127.0.0.1:{self._httpd.server_address[1]}"
+
+    def start(self):
+        """serve in a background thread"""
+        self._thread = threading.Thread(target=self._httpd.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """stop serving"""
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _record(self, method, path, body):
+        with self._lock:
+            self.requests.append((method, path, body))
+
+    def is_loaded(self, model):
+        """if the model is loaded"""
+        return self.loaded.get(_tagged(model), 0) > time.time()
+
+    def _wait_first(self, model):
+        """waits for the model to load and the first token"""
+        delay = self.ttft + (0.0 if not model or self.is_loaded(model) else self.load_delay)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _wait_next(self):
+        """waits for the next token"""
+        if self.tokens_per_second > 0:
+            time.sleep(1.0 / self.tokens_per_second)
+
+    def load(self, model, keep_alive=None):
+        """mark a model as loaded like ollama does when it serves a request"""
+        self.loaded[_tagged(model)] = time.time() + (self.keep_alive if keep_alive is None else keep_alive)
+
+    def ps(self):
+        """the /api/ps response"""
+        now = time.time()
+        return {
+            "models": [
+                {
+                    "name": model,
+                    "model": model,
+                    "size": 1000,
+                    "expires_at": datetime.datetime.fromtimestamp(expires, datetime.timezone.utc).isoformat().replace("+00:00", "123Z"),
+                    "size_vram": 1000,
+                }
+                for model, expires in list(self.loaded.items())
+                if expires > now
+            ]
+        }
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, obj, code=200):
+                data = json.dumps(obj).encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _send_ndjson(self, lines):
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for i, line in enumerate(lines):
+                    if i:
+                        fake._wait_next()
+                    data = json.dumps(line).encode("utf-8") + b"\n"
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                    self.wfile.flush()
+                self.wfile.write(b"0\r\n\r\n")
+                self.wfile.flush()
+
+            def do_HEAD(self):
+                fake._record("HEAD", self.path, b"")
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def do_GET(self):
+                fake._record("GET", self.path, b"")
+                if self.path == "/api/ps":
+                    self._send_json(fake.ps())
+                elif self.path == "/api/tags":
+                    self._send_json({"models": [{"name": m, "model": m} for m in fake.models]})
+                elif self.path == "/api/version":
+                    self._send_json({"version": "0.0.0-fake"})
+                else:
+                    data = b"Ollama is running"
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; charset=utf-8")
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                fake._record("POST", self.path, body)
+                try:
+                    req = json.loads(body or b"{}")
+                except json.JSONDecodeError:
+                    self._send_json({"error": "invalid json"}, 400)
+                    return
+                model = req.get("model", "")
+                if model and self.path != "/api/show":
+                    if self.path in ("/api/generate", "/api/chat", "/api/embed", "/api/embeddings"):
+                        fake._wait_first(model)
+                    fake.load(model)
+                if self.path in ("/api/generate", "/api/chat") and fake.fail_status:
+                    self._send_json({"error": "failed"}, fake.fail_status)
+                elif self.path in ("/api/generate", "/api/chat"):
+                    key = "response" if self.path == "/api/generate" else "message"
+                    parts = [{"model": model, key: t if key == "response" else {"role": "assistant", "content": t}, "done": False} for t in fake.tokens]
+                    final = {"model": model, key: "" if key == "response" else {"role": "assistant", "content": ""}, "done": True}
+                    final.update({"prompt_eval_count": 3, "eval_count": len(fake.tokens)})
+                    if req.get("stream", True):
+                        self._send_ndjson(parts + [final])
+                    else:
+                        for _ in fake.tokens:
+                            fake._wait_next()
+                        final[key] = "".join(fake.tokens) if key == "response" else {"role": "assistant", "content": "".join(fake.tokens)}
+                        self._send_json(final)
+                elif self.path == "/api/embed":
+                    inputs = req.get("input", [])
+                    inputs = [inputs] if isinstance(inputs, str) else inputs
+                    self._send_json({"model": model, "embeddings": [fake_embedding(i) for i in inputs], "prompt_eval_count": len(inputs)})
+                elif self.path == "/api/embeddings":
+                    self._send_json({"embedding": fake_embedding(req.get("prompt", ""))})
+                elif self.path == "/api/show":
+                    name = model or req.get("name", "")
+                    if name and _tagged(name) in (_tagged(m) for m in fake.models):
+                        self._send_json({"modelfile": f"FROM {name}", "details": {"family": "fake"}, "model_info": {}})
+                    else:
+                        self._send_json({"error": f"model '{name}' not found"}, 404)
+                else:
+                    self._send_json({"error": "not found"}, 404)
+
+        return Handler
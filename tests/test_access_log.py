@@ -0,0 +1,95 @@
+import csv
+import datetime
+
+from ollama_proxy_server.access_log import FIELDNAMES, AccessLog
+
+
+def record(i, event="gen_request"):
+    return {
+        "rid": f"rid{i}",
+        "event": event,
+        "user_name": "user1",
+        "ip_address": "127.0.0.1",
+        "access": "Authorized",
+        "server": "server0",
+        "nb_queued_requests_on_server": 0,
+    }
+
+
+def read_rows(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        return list(csv.DictReader(f))
+
+
+class TestAccessLog:
+    def test_writes_batches(self, tmp_path):
+        """
+        Should write every record with one header
+        """
+        path = tmp_path / "access.csv"
+        log = AccessLog(path, batch_size=10).start()
+        for i in range(25):
+            log(**record(i))
+        log.close()
+
+        rows = read_rows(path)
+        assert [row["request_id"] for row in rows] == [f"rid{i}" for i in range(25)]
+        assert list(rows[0]) == FIELDNAMES
+        assert log.stats() == {"queued": 0, "written": 25, "dropped": 0}
+
+    def test_appends_to_existing(self, tmp_path):
+        """
+        Should not write the header again
+        """
+        path = tmp_path / "access.csv"
+        for i in range(2):
+            log = AccessLog(path).start()
+            log.log(**record(i), error="boom")
+            log.close()
+        rows = read_rows(path)
+        assert len(rows) == 2
+        assert rows[1]["error"] == "boom"
+
+    def test_drops_when_full(self, tmp_path):
+        """
+        Should count the records that do not fit instead of blocking
+        """
+        path = tmp_path / "access.csv"
+        log = AccessLog(path, max_queue=5)
+        for i in range(8):
+            log(**record(i))
+        assert log.stats()["dropped"] == 3
+        log.close()
+        assert len(read_rows(path)) == 5
+
+    def test_rotate_by_size(self, tmp_path):
+        """
+        Should rotate the file and keep backup_count old files
+        """
+        path = tmp_path / "access.csv"
+        log = AccessLog(path, batch_size=1, max_bytes=200, backup_count=2).start()
+        for i in range(20):
+            log(**record(i))
+        log.close()
+
+        assert (tmp_path / "access.csv.1").exists()
+        assert (tmp_path / "access.csv.2").exists()
+        assert not (tmp_path / "access.csv.3").exists()
+        for name in ["access.csv.1", "access.csv.2"]:
+            assert read_rows(tmp_path / name)
+
+    def test_rotate_daily(self, tmp_path):
+        """
+        Should move the log of the previous day away
+        """
+        path = tmp_path / "access.csv"
+        log = AccessLog(path, daily=True)
+        log(**record(0))
+        log._drain()
+        yesterday = datetime.date.today() - datetime.timedelta(days=1)
+        log._date = yesterday
+        log(**record(1))
+        log.close()
+
+        assert [row["request_id"] for row in read_rows(tmp_path / f"access.csv.{yesterday.isoformat()}")] == ["rid0"]
+        assert [row["request_id"] for row in read_rows(path)] == ["rid1"]
@@ -0,0 +1,121 @@
+import threading
+
+import pytest
+
+from ollama_proxy_server import ollama_queues
+from ollama_proxy_server.main import get_config
+from ollama_proxy_server.ollama_queues.admission import (
+    AdmissionControl,
+    Overloaded,
+    parse_bounds,
+    parse_timeout,
+)
+
+test_config = """
+[First]
+url = http://localhost:11434
+"""
+
+
+class TestAdmissionControl:
+    def test_max_waiting(self):
+        """
+        Should turn away requests over the global and the model bounds
+        """
+        admission = AdmissionControl(max_waiting=3, models={"big": (1, None)})
+        admission.admit({"model": "big"})
+        with pytest.raises(Overloaded):
+            admission.admit({"model": "big:latest"})
+        admission.admit({"model": "small"})
+        admission.admit({})
+        with pytest.raises(Overloaded):
+            admission.admit({"model": "small"})
+        admission.leave({"model": "big"})
+        admission.admit({"model": "big"})
+        assert admission.stats() == {"admitted": 4, "shed": 2, "timed_out": 0, "waiting": 3}
+
+    def test_timeout(self):
+        """
+        Should wait the shortest of the client timeout and the bound of the model
+        """
+        admission = AdmissionControl(max_wait=30.0, models={"big": (None, 60.0)})
+        assert admission.timeout({"model": "small"}) == 30.0
+        assert admission.timeout({"model": "small"}, 5.0) == 5.0
+        assert admission.timeout({"model": "big"}, 90.0) == 60.0
+        assert AdmissionControl().timeout({}) == 0.0
+        assert AdmissionControl().timeout({}, 2.0) == 2.0
+
+    def test_retry_after(self):
+        """
+        Should estimate the wait from the rate requests are served at, and shed requests that would wait too long
+        """
+        admission = AdmissionControl()
+        assert admission.retry_after({}, now=0) == 1.0
+        for i in range(20):
+            admission.served({}, now=i / 2)
+        assert admission.retry_after({}, now=10) == pytest.approx(0.5)
+        for _ in range(9):
+            admission.admit({}, now=10)
+        assert admission.retry_after({}, now=10) == pytest.approx(5.0)
+        admission.admit({}, 10.0, now=10)
+        with pytest.raises(Overloaded) as ex:
+            admission.admit({}, 5.0, now=10)
+        assert ex.value.retry_after == pytest.approx(5.5)
+
+    def test_parse(self):
+        """
+        Should read the model bounds and the timeout header
+        """
+        assert parse_bounds(["llama3.2=10:30", "big:70b=5", "small=:2.5"]) == {"llama3.2:latest": (10, 30.0), "big:70b": (5, None), "small:latest": (None, 2.5)}
+        for broken in ("llama3.2", "llama3.2=", "llama3.2=many"):
+            with pytest.raises(ValueError):
+                parse_bounds([broken])
+        assert parse_timeout("2.5") == 2.5
+        assert parse_timeout(None) == 0.0
+        assert parse_timeout("soon") == 0.0
+        assert parse_timeout("-1") == 0.0
+        assert parse_timeout("inf") == 0.0
+
+
+class TestAdmissionQueue:
+    def test_shed(self):
+        """
+        Should turn away requests once the waiting line is full and serve the ones in it
+        """
+        admission = AdmissionControl(max_waiting=1)
+        mq = ollama_queues.SimpleQueue(get_config(test_config, "read_string"), admission=admission)
+        assert mq.enqueue()[0] == "First"
+        servers = []
+        waiter = threading.Thread(target=lambda: servers.append(mq.enqueue()))
+        waiter.start()
+        while mq.waiting() == 0:
+            waiter.join(0.01)
+        with pytest.raises(Overloaded) as ex:
+            mq.enqueue()
+        assert ex.value.retry_after > 0
+        mq.dequeue("First")
+        waiter.join(5)
+        assert servers[0][0] == "First"
+        mq.dequeue("First")
+        assert admission.stats() == {"admitted": 1, "shed": 1, "timed_out": 0, "waiting": 0}
+        assert mq.retry_after() > 0
+
+    def test_max_wait(self):
+        """
+        Should give up on a request waiting longer than the bound
+        """
+        admission = AdmissionControl(max_wait=0.05)
+        mq = ollama_queues.ModelLoadedQueue(get_config(test_config, "read_string"), admission=admission)
+        mq.enqueue({"model": "llama3.2"})
+        # one request served per second, it would wait longer than the bound
+        with pytest.raises(Overloaded):
+            mq.enqueue({"model": "llama3.2"})
+        assert admission.stats()["shed"] == 1
+        for _ in range(100):
+            admission.served({})
+        with pytest.raises(TimeoutError):
+            mq.enqueue({"model": "llama3.2"})
+        assert admission.stats()["timed_out"] == 1
+        assert mq.waiting() == 0
+        mq.dequeue("First")
+        assert mq.enqueue({"model": "llama3.2"})[0] == "First"
@@ -0,0 +1,414 @@
+import asyncio
+import json
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import requests
+
+from ollama_proxy_server import async_server, ollama_queues
+from ollama_proxy_server.async_server import AsyncProxyServer
+from ollama_proxy_server.embed_batcher import AsyncEmbedBatcher
+from ollama_proxy_server.embedding_cache import EmbeddingCache
+from ollama_proxy_server.main import get_config
+from ollama_proxy_server.metrics import ProxyMetrics
+from ollama_proxy_server.rate_limit import Limits, RateLimiter
+from ollama_proxy_server.request_body import BLOCK_SIZE, RequestBody
+from ollama_proxy_server.response_cache import ResponseCache
+
+from .fake_ollama import FakeOllama, fake_embedding
+
+AUTH = {"Authorization": "Bearer user1:key1"}
+
+
+@pytest.fixture
+def backend():
+    with FakeOllama() as fake:
+        yield fake
+
+
+@pytest.fixture
+def hanging_url():
+    """a server whose accept queue is full, connecting to it hangs"""
+    with socket.socket() as listener:
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(0)
+        port = listener.getsockname()[1]
+        clients = [socket.socket() for _ in range(3)]
+        for client in clients:
+            client.setblocking(False)
+            client.connect_ex(("127.0.0.1", port))
+        yield f"http://127.0.0.1:{port}"
+        for client in clients:
+            client.close()
+
+
+@pytest.fixture
+def async_proxy(backend):
+    servers = get_config(f"[FakeServer]\nurl = {backend.url}\n", "read_string")
+    mq = ollama_queues.SimpleQueue(servers)
+    log = []
+    proxy = AsyncProxyServer(mq, {"user1": "key1"}, access_log=lambda **kw: log.append(kw), metrics=ProxyMetrics(mq))
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(proxy.start("127.0.0.1", 0))
+        started.set()
+        loop.run_forever()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    assert started.wait(5)
+    yield f"http://127.0.0.1:{proxy.port}", mq, log, proxy
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(5)
+
+
+class TestAsyncServer:
+    def test_stream_generate(self, async_proxy):
+        """
+        Should relay the ndjson stream line by line
+        """
+        url, mq, log, _ = async_proxy
+        res = requests.post(url + "/api/generate", json={"model": "llama3.2", "prompt": "hi"}, headers=AUTH, stream=True, timeout=5)
+        assert res.status_code == 200
+        lines = [json.loads(line) for line in res.iter_lines() if line]
+        assert "".join(line["response"] for line in lines) == "Hello world!"
+        assert lines[-1]["done"] is True
+        assert mq.get_length("FakeServer") == 0
+        assert [entry["event"] for entry in log] == ["gen_request", "gen_done"]
+        assert log[0]["user_name"] == "user1"
+
+    def test_non_stream_chat(self, async_proxy):
+        """
+        Should return the whole json body
+        """
+        url, _, _, _ = async_proxy
+        res = requests.post(url + "/api/chat", json={"model": "llama3.2", "messages": [], "stream": False}, headers=AUTH, timeout=5)
+        assert res.status_code == 200
+        assert res.json()["message"]["content"] == "Hello world!"
+
+    def test_unauthorized(self, async_proxy):
+        """
+        Should be rejected before scheduling
+        """
+        url, _, log, _ = async_proxy
+        res = requests.post(url + "/api/generate", json={"model": "llama3.2"}, headers={"Authorization": "Bearer user1:bad"}, timeout=5)
+        assert res.status_code == 403
+        assert log[0]["event"] == "rejected"
+
+    def test_bad_json(self, async_proxy):
+        """
+        Should return bad request
+        """
+        url, _, log, _ = async_proxy
+        res = requests.post(url + "/api/generate", data=b"{not json", headers=AUTH, timeout=5)
+        assert res.status_code == 400
+        assert log[0]["event"] == "request_error"
+
+    def test_concurrent_streams(self, async_proxy):
+        """
+        Should serve many clients on one loop, slots are released after each
+        """
+        url, mq, log, _ = async_proxy
+
+        def call(_):
+            res = requests.post(url + "/api/generate", json={"model": "llama3.2", "prompt": "hi"}, headers=AUTH, timeout=10)
+            return res.status_code, res.content.count(b"\n")
+
+        with ThreadPoolExecutor(8) as pool:
+            results = list(pool.map(call, range(16)))
+        assert results == [(200, 5)] * 16
+        assert mq.get_length("FakeServer") == 0
+        assert sum(1 for entry in log if entry["event"] == "gen_done") == 16
+
+    def test_keep_alive_pool(self, async_proxy):
+        """
+        Should reuse the upstream connection for sequential requests
+        """
+        url, _, _, proxy = async_proxy
+        for _ in range(3):
+            res = requests.post(url + "/api/generate", json={"model": "llama3.2", "prompt": "hi"}, headers=AUTH, timeout=5)
+            assert res.status_code == 200
+        assert proxy.pool_stats()["FakeServer"] == {"connections": 1, "requests": 3, "reused": 2}
+
+    def test_metrics(self, async_proxy):
+        """
+        Should record the phases of every request
+        """
+        url, _, _, proxy = async_proxy
+        for _ in range(2):
+            res = requests.post(url + "/api/generate", json={"model": "llama3.2", "prompt": "hi"}, headers=AUTH, timeout=5)
+            assert res.status_code == 200
+        labels = ("FakeServer", "llama3.2", "/api/generate", "200")
+        metrics = proxy._metrics
+        for histogram in (metrics.queue_wait, metrics.upstream_connect, metrics.first_byte, metrics.duration):
+            assert histogram.collect()[labels][2] == 2
+        # the second request reused the connection
+        assert metrics.upstream_connect.collect()[labels][0][0] >= 1
+        text = metrics.registry.render()
+        assert 'ollama_proxy_in_flight_requests{server="FakeServer"} 0' in text
+        assert "ollama_proxy_waiting_requests 0" in text
+
+    def test_coalesce_slow_second_chunk(self, async_proxy):
+        """
+        Should send the held lines when the coalescing window ends, not when the next chunk arrives
+        """
+        url, mq, _, _ = async_proxy
+        with FakeOllama(tokens=["a", "b"], tokens_per_second=2) as slow:
+            mq.add_server(("FakeServer", {"url": slow.url}))
+            start = time.monotonic()
+            res = requests.post(url + "/api/generate", json={"model": "llama3.2"}, headers=dict(AUTH, **{"X-Proxy-Coalesce-Ms": "50"}), stream=True, timeout=5)
+            assert json.loads(res.raw.readline())["response"] == "a"
+            assert time.monotonic() - start < 0.4
+            assert [json.loads(line)["done"] for line in res.raw.read().splitlines()] == [False, True]
+
+    def test_chunked_large_upload(self, async_proxy, backend):
+        """
+        Should accept a chunked upload larger than the spool threshold and forward all of it
+        """
+        url, _, _, proxy = async_proxy
+        proxy._spool_threshold = 64 * 1024
+        data = json.dumps({"model": "llava", "images": ["A" * (512 * 1024)], "stream": False}).encode("utf-8")
+
+        def chunks():
+            for i in range(0, len(data), 10000):
+                yield data[i : i + 10000]
+
+        res = requests.post(url + "/api/generate", data=chunks(), headers=AUTH, timeout=5)
+        assert res.status_code == 200
+        assert res.json()["response"] == "Hello world!"
+        assert backend.requests[-1] == ("POST", "/api/generate", data)
+
+    def test_large_body_off_loop(self):
+        """
+        Should parse large bodies and read spooled ones in a thread, small ones on the event loop
+        """
+
+        async def run(body):
+            blocks = [block async for block in async_server._iter_request_body(body)]
+            return await async_server._off_loop(body, threading.get_ident), await async_server._off_loop(body, body.peek), b"".join(blocks)
+
+        small = RequestBody()
+        small.write(b'{"model": "llama3.2"}')
+        large = RequestBody(spool_threshold=BLOCK_SIZE)
+        large.write(json.dumps({"model": "llama3.2", "prompt": "x" * BLOCK_SIZE}).encode("utf-8"))
+        assert large.spooled
+        for body, on_loop in ((small, True), (large, False)):
+            ident, fields, data = asyncio.run(run(body))
+            assert (ident == threading.get_ident()) == on_loop
+            assert fields["model"] == "llama3.2"
+            assert data == body.view()[:]
+            body.close()
+
+    def test_cluster_endpoints(self, async_proxy, backend):
+        """
+        Should answer /api/tags from the cluster view and mirror the other endpoints
+        """
+        url, _, log, _ = async_proxy
+        res = requests.get(url + "/api/tags", headers=AUTH, timeout=5)
+        assert res.status_code == 200
+        assert res.json() == {"models": [{"name": "llama3.2", "model": "llama3.2"}]}
+        res = requests.post(url + "/api/show", json={"model": "llama3.2"}, headers=AUTH, timeout=5)
+        assert res.status_code == 200
+        assert res.json()["details"] == {"family": "fake"}
+        res = requests.post(url + "/api/show", json={"model": "nope"}, headers=AUTH, timeout=5)
+        assert res.status_code == 404
+        res = requests.get(url + "/api/version", headers=AUTH, timeout=5)
+        assert res.json() == {"version": "0.0.0-fake"}
+        assert [entry["event"] for entry in log] == ["cluster_request", "request", "request", "request"]
+        # /api/show was routed with the cached tags
+        assert [r[1] for r in backend.requests].count("/api/tags") == 1
+
+    def test_response_cache(self, async_proxy, backend):
+        """
+        Should replay deterministic requests from the cache without asking the server
+        """
+        url, mq, log, proxy = async_proxy
+        proxy._response_cache = ResponseCache()
+        request = {"model": "llama3.2", "prompt": "hi", "options": {"temperature": 0, "seed": 1}}
+        bodies = []
+        for _ in range(2):
+            res = requests.post(url + "/api/generate", json=request, headers=AUTH, stream=True, timeout=5)
+            assert res.status_code == 200
+            assert res.headers["Content-Type"] == "application/x-ndjson"
+            bodies.append([json.loads(line) for line in res.iter_lines() if line])
+        assert bodies[0] == bodies[1]
+        assert len(bodies[1]) == 5
+        assert [r[1] for r in backend.requests] == ["/api/generate"]
+        assert [entry["event"] for entry in log] == ["gen_request", "gen_done", "cache_hit"]
+        assert mq.get_length("FakeServer") == 0
+        # sampling requests always go to the server
+        request["options"]["temperature"] = 0.5
+        requests.post(url + "/api/generate", json=request, headers=AUTH, timeout=5)
+        requests.post(url + "/api/generate", json=request, headers=AUTH, timeout=5)
+        assert len(backend.requests) == 3
+
+    def test_embedding_cache(self, async_proxy, backend, tmp_path):
+        """
+        Should answer cached inputs without the server
+        """
+        url, _, log, proxy = async_proxy
+        proxy._embedding_cache = EmbeddingCache(str(tmp_path / "embeddings.cache"), 64 * 1024)
+        res = requests.post(url + "/api/embed", json={"model": "llama3.2", "input": ["a", "b"]}, headers=AUTH, timeout=5)
+        assert res.json()["embeddings"] == [fake_embedding("a"), fake_embedding("b")]
+        res = requests.post(url + "/api/embed", json={"model": "llama3.2", "input": ["b", "c", "a"]}, headers=AUTH, timeout=5)
+        assert res.json()["embeddings"] == [fake_embedding("b"), fake_embedding("c"), fake_embedding("a")]
+        assert json.loads(backend.requests[-1][2])["input"] == ["c"]
+        res = requests.post(url + "/api/embed", json={"model": "llama3.2", "input": "c"}, headers=AUTH, timeout=5)
+        assert res.json() == {"model": "llama3.2", "embeddings": [fake_embedding("c")]}
+        res = requests.post(url + "/api/embeddings", json={"model": "llama3.2", "prompt": "a"}, headers=AUTH, timeout=5)
+        assert res.json() == {"embedding": fake_embedding("a")}
+        assert [entry["event"] for entry in log] == ["request", "request", "cache_hit", "request"]
+        proxy._embedding_cache.close()
+
+    def test_embedding_cache_off_loop(self, async_proxy, tmp_path):
+        """
+        Should look up and store the vectors in a thread, not on the event loop
+        """
+        url, _, _, proxy = async_proxy
+        cache = proxy._embedding_cache = EmbeddingCache(str(tmp_path / "embeddings.cache"), 64 * 1024)
+        loops = []
+        lookup = cache.lookup
+
+        def recording_lookup(path, body):
+            loops.append(asyncio._get_running_loop())
+            result = lookup(path, body)
+            merge = result.merge
+
+            def recording_merge(upstream):
+                loops.append(asyncio._get_running_loop())
+                return merge(upstream)
+
+            result.merge = recording_merge
+            return result
+
+        cache.lookup = recording_lookup
+        for _ in range(2):
+            res = requests.post(url + "/api/embed", json={"model": "llama3.2", "input": ["a"]}, headers=AUTH, timeout=5)
+            assert res.json()["embeddings"] == [fake_embedding("a")]
+        assert loops == [None] * 4
+        cache.close()
+
+    def test_embed_batching(self, async_proxy, backend):
+        """
+        Should send concurrent /api/embed requests to the server as one
+        """
+        url, _, _, proxy = async_proxy
+        proxy._embed_batcher = AsyncEmbedBatcher(proxy._send_embed_batch, max_batch=64, max_wait=0.2)
+        proxy._rate_limiter = RateLimiter(Limits(tokens=1000))
+
+        def call(i):
+            res = requests.post(url + "/api/embed", json={"model": "llama3.2", "input": [str(i)]}, headers=AUTH, timeout=5)
+            return res.json()["embeddings"]
+
+        with ThreadPoolExecutor(6) as pool:
+            results = list(pool.map(call, range(6)))
+        assert results == [[fake_embedding(str(i))] for i in range(6)]
+        batches = [json.loads(body)["input"] for _, path, body in backend.requests if path == "/api/embed"]
+        assert len(batches) < 6
+        assert sorted(text for batch in batches for text in batch) == [str(i) for i in range(6)]
+        # every request is counted its share of the batch
+        assert proxy._rate_limiter._states["user1"].used == 6
+
+    def test_rate_limit(self, async_proxy, backend):
+        """
+        Should answer too many requests with a Retry-After and count the tokens of the others
+        """
+        url, mq, log, proxy = async_proxy
+        proxy._rate_limiter = RateLimiter(Limits(rps=0.1, burst=1, tokens=1000))
+        res = requests.post(url + "/api/generate", json={"model": "llama3.2", "prompt": "hi"}, headers=AUTH, timeout=5)
+        assert res.status_code == 200
+        res = requests.post(url + "/api/generate", json={"model": "llama3.2", "prompt": "hi"}, headers=AUTH, timeout=5)
+        assert res.status_code == 429
+        assert int(res.headers["Retry-After"]) >= 1
+        assert [entry["event"] for entry in log] == ["gen_request", "gen_done", "rate_limited"]
+        assert len(backend.requests) == 1
+        assert mq.get_length("FakeServer") == 0
+        assert proxy._rate_limiter._states["user1"].used == 3 + len(backend.tokens)
+
+    def test_rate_limit_embed(self, async_proxy, backend):
+        """
+        Should limit the embedding endpoints and count their tokens, /api/show is not limited
+        """
+        url, _, log, proxy = async_proxy
+        proxy._rate_limiter = RateLimiter(Limits(rps=0.1, burst=1, tokens=1000))
+        res = requests.post(url + "/api/embed", json={"model": "llama3.2", "input": ["a", "b"]}, headers=AUTH, timeout=5)
+        assert res.status_code == 200
+        res = requests.post(url + "/api/embeddings", json={"model": "llama3.2", "prompt": "a"}, headers=AUTH, timeout=5)
+        assert res.status_code == 429
+        assert int(res.headers["Retry-After"]) >= 1
+        res = requests.post(url + "/api/show", json={"model": "llama3.2"}, headers=AUTH, timeout=5)
+        assert res.status_code == 200
+        assert [entry["event"] for entry in log] == ["request", "rate_limited", "request"]
+        state = proxy._rate_limiter._states["user1"]
+        assert (state.used, state.in_flight) == (2, 0)
+
+    def test_request_timeout(self, async_proxy):
+        """
+        Should answer a request that waited longer than its timeout header with a 503 and a Retry-After
+        """
+        url, mq, log, _ = async_proxy
+        mq.enqueue()
+        res = requests.post(url + "/api/generate", json={"model": "llama3.2", "prompt": "hi"}, headers=dict(AUTH, **{"X-Request-Timeout": "0.1"}), timeout=5)
+        assert res.status_code == 503
+        assert res.headers["Retry-After"] == "1"
+        assert [entry["event"] for entry in log] == ["overloaded"]
+        mq.dequeue("FakeServer")
+        assert mq.waiting() == 0
+
+    def test_failover(self, async_proxy, backend):
+        """
+        Should send a request to another server when its server fails before answering
+        """
+        url, mq, log, proxy = async_proxy
+        backend.fail_status = 503
+        with FakeOllama() as other:
+            mq.add_server(("Other", {"url": other.url}))
+            res = requests.post(url + "/api/generate", json={"model": "llama3.2", "prompt": "hi", "stream": False}, headers=AUTH, timeout=5)
+            assert res.status_code == 200
+            assert res.json()["response"] == "Hello world!"
+            assert [entry["event"] for entry in log] == ["gen_request", "gen_retry", "gen_done"]
+            assert log[1]["server"] == "FakeServer"
+            assert log[2]["server"] == "Other"
+            # an unreachable server
+            mq.add_server(("FakeServer", {"url": "http://127.0.0.1:1"}))
+            res = requests.post(url + "/api/generate", json={"model": "llama3.2", "prompt": "hi", "stream": False}, headers=AUTH, timeout=5)
+            assert res.status_code == 200
+            # no server left to try
+            other.fail_status = 500
+            res = requests.post(url + "/api/generate", json={"model": "llama3.2", "prompt": "hi", "stream": False}, headers=AUTH, timeout=5)
+            assert res.status_code in (500, 503)
+        assert mq.in_flight() == {"FakeServer": 0, "Other": 0}
+        assert proxy._retry_budget.stats()["retries"] == 3
+
+    def test_failover_connect_timeout(self, async_proxy, backend, hanging_url):
+        """
+        Should send a request to another server when connecting to its server times out
+        """
+        url, mq, log, proxy = async_proxy
+        proxy._connect_timeout = 0.5
+        mq.add_server(("FakeServer", {"url": hanging_url}))
+        mq.add_server(("Other", {"url": backend.url}))
+        res = requests.post(url + "/api/generate", json={"model": "llama3.2", "prompt": "hi", "stream": False}, headers=AUTH, timeout=5)
+        assert res.status_code == 200
+        assert [(entry["event"], entry["server"]) for entry in log] == [("gen_request", "FakeServer"), ("gen_retry", "FakeServer"), ("gen_done", "Other")]
+        res = requests.get(url + "/api/version", headers=AUTH, timeout=5)
+        assert res.status_code == 200
+        assert mq.in_flight() == {"FakeServer": 0, "Other": 0}
+
+    def test_failover_not_scheduled(self, async_proxy, backend):
+        """
+        Should send a mirrored request to another server when the first one is dead
+        """
+        url, mq, log, _ = async_proxy
+        mq.add_server(("FakeServer", {"url": "http://127.0.0.1:1"}))
+        mq.add_server(("Other", {"url": backend.url}))
+        res = requests.get(url + "/api/version", headers=AUTH, timeout=5)
+        assert res.status_code == 200
+        assert res.json() == {"version": "0.0.0-fake"}
+        assert [(entry["event"], entry["server"]) for entry in log] == [("request", "FakeServer"), ("retry", "FakeServer")]
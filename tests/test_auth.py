@@ -0,0 +1,100 @@
+import jwt
+import pytest
+
+from ollama_proxy_server.auth import (
+    TokenCache,
+    parse_weights,
+    request_tenant,
+    validate_auth_header,
+)
+
+key = "secret-key-with-at-least-32-bytes-for-hs256"
+
+
+def make_token(exp, user="user1", jwt_key=key):
+    return "Bearer " + jwt.encode({"user": user, "aud": "urn:ollama_proxy", "exp": exp}, jwt_key, algorithm="HS256")
+
+
+class TestTokenCache:
+    def test_hit_and_miss(self):
+        """
+        Should verify a token once and serve it from the cache after
+        """
+        cache = TokenCache()
+        header = make_token(4102444800)
+        users = {"user2": "key2"}
+        for _ in range(3):
+            assert validate_auth_header(header, users, key, cache)[0] == "user1"
+            assert validate_auth_header("Bearer user2:key2", users, key, cache) == ("user2", None)
+        assert cache.stats() == {"hits": 4, "misses": 2, "size": 2}
+
+    def test_invalid_not_cached(self):
+        """
+        Should not remember tokens that failed
+        """
+        cache = TokenCache()
+        assert validate_auth_header("Bearer user2:wrong", {"user2": "key2"}, key, cache) is None
+        assert cache.stats()["size"] == 0
+        with pytest.raises(jwt.InvalidTokenError):
+            validate_auth_header(make_token(4102444800, jwt_key="other-key-with-at-least-32-bytes-long"), {}, key, cache)
+
+    def test_expires_with_token(self):
+        """
+        Should drop a token at its exp
+        """
+        cache = TokenCache(max_age=3600)
+        header = make_token(2000)
+        token = header.split(" ")[1]
+        payload = {"user": "user1", "exp": 2000}
+        users = {}
+        cache.put(token, users, key, "user1", payload, now=1000)
+        assert cache.get(token, users, key, now=1999) == ("user1", payload)
+        assert cache.get(token, users, key, now=2000) is None
+        assert cache.stats()["size"] == 0
+
+    def test_max_age_and_lru(self):
+        """
+        Should bound the age and the number of tokens
+        """
+        cache = TokenCache(max_size=2, max_age=10)
+        users = {}
+        for i in range(3):
+            cache.put(f"u{i}:k", users, None, f"u{i}", None, now=0)
+        assert cache.get("u0:k", users, None, now=1) is None
+        assert cache.get("u1:k", users, None, now=1) == ("u1", None)
+        assert cache.get("u1:k", users, None, now=10) is None
+
+    def test_cleared_on_key_change(self):
+        """
+        Should forget everything when the jwt key or the users table is replaced
+        """
+        cache = TokenCache()
+        users = {"user2": "key2"}
+        assert validate_auth_header("Bearer user2:key2", users, key, cache)
+        assert validate_auth_header("Bearer user2:key2", {}, key, cache) is None
+        assert validate_auth_header("Bearer user2:key2", users, key, cache)
+        assert cache.get("user2:key2", users, "new-key") is None
+        assert cache.stats()["size"] == 0
+
+
+class TestTenant:
+    def test_request_tenant(self):
+        """
+        Should queue users as their tenant claim with the weight of the jwt or the config
+        """
+        weights = {"team-a": 3.0, "bob": 0.5}
+        assert request_tenant("bob", None, weights) == ("bob", 0.5)
+        assert request_tenant("alice", None, weights) == ("alice", 1.0)
+        assert request_tenant("alice", {"user": "alice", "tenant": "team-a"}, weights) == ("team-a", 3.0)
+        assert request_tenant("alice", {"user": "alice", "tenant": "team-a", "weight": 2}, weights) == ("team-a", 2.0)
+        assert request_tenant("alice", {"user": "alice", "org": "x", "weight": True}, weights, claim="org") == ("x", 1.0)
+
+    def test_parse_weights(self):
+        """
+        Should parse name=weight and refuse anything else
+        """
+        assert parse_weights(["batch=0.25", "a=b=2"]) == {"batch": 0.25, "a=b": 2.0}
+        assert parse_weights(None) == {}
+        for value in ("batch", "=1", "batch=0", "batch=x"):
+            with pytest.raises(ValueError):
+                parse_weights([value])
@@ -0,0 +1,18 @@
+from .bench_json_peek import check, run
+
+
+class TestBenchJsonPeek:
+    def test_run(self):
+        """
+        Should time both bodies and report the ones where peek_json is too slow
+        """
+        report = run(image_size=64 * 1024, number=1)
+        assert [case["body"] for case in report["cases"]] == ["multimodal", "chat"]
+        for case in report["cases"]:
+            assert case["bytes"] > 0
+            assert case["peek_us"] > 0
+            assert case["loads_us"] > 0
+        slow = {"cases": [dict(case, peek_us=case["loads_us"] * 10) for case in report["cases"]]}
+        assert len(check(slow)) == 2
+        fast = {"cases": [dict(case, peek_us=case["loads_us"] / 10) for case in report["cases"]]}
+        assert check(fast) == []
@@ -0,0 +1,50 @@
+import time
+
+import pytest
+import requests
+
+from .bench_proxy import AUTH, ENGINES, compare, percentile, run
+from .fake_ollama import FakeOllama
+
+
+class TestBenchProxy:
+    def test_percentile(self):
+        """
+        Should pick the nearest rank
+        """
+        values = list(range(1, 101))
+        assert percentile(values, 0.5) == 50
+        assert percentile(values, 0.99) == 99
+        assert percentile([3.0], 0.99) == 3.0
+        assert percentile([], 0.5) == 0.0
+
+    def test_compare(self):
+        """
+        Should report a drop of throughput or a growth of the added latency
+        """
+        baseline = {"requests_per_s": 100.0, "added_latency_ms": {"p50": 10.0, "p99": 50.0}}
+        assert compare(dict(baseline), baseline) == []
+        assert len(compare({"requests_per_s": 70.0, "added_latency_ms": {"p50": 10.0, "p99": 100.0}}, baseline)) == 2
+
+    def test_fake_timing(self):
+        """
+        Should wait for the model to load, the first token and every token after it
+        """
+        with FakeOllama(tokens=["a"] * 5, load_delay=0.2, ttft=0.05, tokens_per_second=50) as fake:
+            for expected in (0.25 + 0.1, 0.05 + 0.1):
+                start = time.perf_counter()
+                res = requests.post(fake.url + "/api/generate", json={"model": "llama3.2", "prompt": "hi"}, headers=AUTH, timeout=5)
+                assert res.content.count(b"\n") == 6
+                assert time.perf_counter() - start >= expected
+
+    @pytest.mark.parametrize("engine", ENGINES)
+    def test_run(self, engine):
+        """
+        Should drive the proxy with concurrent streams and report its overhead
+        """
+        report = run(engine=engine, backends=2, count=40, concurrency=4, tokens=8, ttft=0.01)
+        assert report["errors"] == 0
+        assert report["requests_per_s"] > 0
+        assert report["ttft_ms"]["p50"] >= 10
+        assert report["latency_ms"]["p99"] >= report["latency_ms"]["p50"]
+        assert set(report["added_latency_ms"]) == {"p50", "p99"}
@@ -0,0 +1,40 @@
+from ollama_proxy_server.main import get_config
+
+from .bench_scheduler import MODELS, QUEUES, compare, make_queue, run, synthetic_config
+
+
+class TestBenchScheduler:
+    def test_synthetic_config(self):
+        """
+        Should build a config with every kind of server where each model has a server
+        """
+        servers = get_config(synthetic_config(30), "read_string")
+        assert len(servers) == 30
+        assert sum(1 for _, server in servers if server["model_wl"]) == 10
+        assert sum(1 for _, server in servers if server["model_bl"]) == 10
+        for kind in QUEUES:
+            queue = make_queue(kind, servers)
+            for model in MODELS:
+                server = queue.enqueue({"model": model})
+                assert server is not None
+                queue.dequeue(server[0], True)
+
+    def test_run(self):
+        """
+        Should measure every case and compare it to a baseline
+        """
+        report = run(servers=(10, 50), threads=(1, 4), ops=400, waiters=(500,))
+        assert len(report["cases"]) == len(QUEUES) * 4
+        for case in report["cases"]:
+            assert case["ops"] == 400
+            assert case["ops_per_s"] > 0
+            assert case["us_per_op"]["p99"] >= case["us_per_op"]["p50"]
+        assert len(report["waiting"]) == len(QUEUES) * 2
+        for case in report["waiting"]:
+            assert case["releases"] == 250
+            assert case["us_per_release"]["p99"] >= case["us_per_release"]["p50"] > 0
+        assert compare(report, report) == []
+        slower = {"cases": [dict(case, ops_per_s=case["ops_per_s"] / 2) for case in report["cases"]]}
+        assert len(compare(slower, report)) == len(report["cases"])
+        slower = {"cases": [], "waiting": [dict(case, us_per_release={"p50": case["us_per_release"]["p50"] * 2}) for case in report["waiting"]]}
+        assert len(compare(slower, report)) == len(report["waiting"])
@@ -0,0 +1,157 @@
+import threading
+import time
+
+import pytest
+
+from ollama_proxy_server import ollama_queues
+from ollama_proxy_server.cluster import ClusterView, merge_ps
+from ollama_proxy_server.failover import RetryBudget
+from ollama_proxy_server.main import get_config
+
+from .fake_ollama import FakeOllama
+
+
+@pytest.fixture
+def backends():
+    with FakeOllama(models=("llama3.2", "phi3")) as fake1, FakeOllama(models=("llama3.2:latest", "mistral:7b")) as fake2:
+        yield fake1, fake2
+
+
+def make_queue(*urls):
+    cfg = "".join(f"[Server{i}]\nurl = {url}\n" for i, url in enumerate(urls, 1))
+    return ollama_queues.SimpleQueue(get_config(cfg, "read_string"))
+
+
+class TestClusterView:
+    def test_tags_merged(self, backends):
+        """
+        Should list the models of all servers once
+        """
+        fake1, fake2 = backends
+        cluster = ClusterView(make_queue(fake1.url, fake2.url))
+        names = [m["name"] for m in cluster.get("/api/tags")["models"]]
+        assert sorted(names) == ["llama3.2", "mistral:7b", "phi3"]
+
+    def test_ps_merged(self, backends):
+        """
+        Should list a model loaded on several servers once with the latest expiry
+        """
+        fake1, fake2 = backends
+        fake1.load("llama3.2", 10)
+        fake2.load("llama3.2", 1000)
+        fake2.load("mistral:7b")
+        cluster = ClusterView(make_queue(fake1.url, fake2.url))
+        models = cluster.get("/api/ps")["models"]
+        assert [m["name"] for m in models] == ["llama3.2:latest", "mistral:7b"]
+        assert models[0] == fake2.ps()["models"][0]
+        assert merge_ps([{"models": None}, {}]) == {"models": []}
+
+    def test_cached(self, backends):
+        """
+        Should ask the servers once per ttl
+        """
+        fake1, fake2 = backends
+        cluster = ClusterView(make_queue(fake1.url, fake2.url), ttl=60)
+        for _ in range(5):
+            cluster.get("/api/tags")
+        assert [r[1] for r in fake1.requests] == [r[1] for r in fake2.requests] == ["/api/tags"]
+        cluster.invalidate()
+        cluster.get("/api/tags")
+        assert len(fake1.requests) == 2
+
+    def test_server_for_model(self, backends):
+        """
+        Should pick a server that has the model, the least busy one if several do
+        """
+        fake1, fake2 = backends
+        mq = make_queue(fake1.url, fake2.url)
+        cluster = ClusterView(mq)
+        assert cluster.server_for("phi3:latest")[0] == "Server1"
+        assert cluster.server_for("mistral:7b")[0] == "Server2"
+        mq.enqueue({"model": "x"})
+        assert cluster.server_for("llama3.2")[0] == "Server2"
+        # nobody has it, any server answers the 404
+        assert cluster.server_for("unknown") is not None
+
+    def test_server_for_schedulable(self, backends):
+        """
+        Should only pick servers that are healthy and allowed the model, another one after a failure
+        """
+        fake1, fake2 = backends
+        cfg = f'[Server1]\nurl = http://127.0.0.1:1\n[Server2]\nurl = {fake1.url}\n[Server3]\nurl = {fake2.url}\nmodel_black_list = ["llama3.2"]\n'
+        mq = ollama_queues.ModelLoadedQueue(get_config(cfg, "read_string"), health=ollama_queues.HealthMonitor(failures=1))
+        cluster = ClusterView(mq, timeout=1)
+        dead = cluster.server_for()
+        assert dead[0] == "Server1"
+        tried = set()
+        assert cluster.failover(dead, tried, "llama3.2", RetryBudget())[0] == "Server2"
+        assert tried == {"Server1"}
+        assert mq.health()["Server1"] == "open"
+        assert cluster.server_for()[0] == "Server2"
+        # Server3 has llama3.2 but is not allowed to run it
+        assert cluster.server_for("llama3.2", exclude={"Server2"}) is None
+        assert cluster.server_for("mistral:7b")[0] == "Server3"
+        # a 500 can be the fault of the request, the server stays healthy
+        assert cluster.failover(cluster.server_for(), set(), None, RetryBudget(), 500)[0] == "Server3"
+        assert mq.health()["Server2"] == "closed"
+        assert cluster.failover(cluster.server_for(), set(), None, RetryBudget(), 503)[0] == "Server3"
+        assert mq.health()["Server2"] == "open"
+        # no retry left
+        assert cluster.failover(cluster.server_for(), set(), None, RetryBudget(max_retries=0)) is None
+
+    def test_dead_server(self, backends):
+        """
+        Should skip servers that do not answer
+        """
+        fake1, _ = backends
+        with FakeOllama() as dead:
+            url = dead.url
+        cluster = ClusterView(make_queue(fake1.url, url), timeout=1)
+        assert sorted(m["name"] for m in cluster.get("/api/tags")["models"]) == ["llama3.2", "phi3"]
+        assert cluster.servers_with_model("llama3.2") == {"Server1"}
+
+    def test_stale_while_refreshing(self, backends):
+        """
+        Should answer with the expired model list while it is refreshed in the background
+        """
+        fake1, fake2 = backends
+        cluster = ClusterView(make_queue(fake1.url, fake2.url), ttl=0)
+        assert cluster.servers_with_model("mistral:7b") == {"Server2"}
+        release = threading.Event()
+        fan_out = cluster._fan_out
+
+        def slow_fan_out(path):
+            release.wait(5)
+            return fan_out(path)
+
+        cluster._fan_out = slow_fan_out
+        fake1.models.append("mistral:7b")
+        start = time.monotonic()
+        assert cluster.servers_with_model("mistral:7b") == {"Server2"}
+        assert cluster.server_for("mistral:7b")[0] == "Server2"
+        assert time.monotonic() - start < 1
+        release.set()
+        deadline = time.monotonic() + 5
+        while cluster.servers_with_model("mistral:7b") != {"Server1", "Server2"} and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert cluster.servers_with_model("mistral:7b") == {"Server1", "Server2"}
+
+    def test_skips_unhealthy(self, backends):
+        """
+        Should not ask the servers the health monitor took out
+        """
+        fake1, fake2 = backends
+        cfg = f"[Server1]\nurl = {fake1.url}\n[Server2]\nurl = {fake2.url}\n"
+        mq = ollama_queues.SimpleQueue(get_config(cfg, "read_string"), health=ollama_queues.HealthMonitor(failures=1))
+        mq.report_probe("Server2", False)
+        cluster = ClusterView(mq)
+        assert sorted(m["name"] for m in cluster.get("/api/tags")["models"]) == ["llama3.2", "phi3"]
+        assert fake2.requests == []
+
+    def test_no_servers(self):
+        """
+        Should answer empty lists without servers
+        """
+        cluster = ClusterView(ollama_queues.SimpleQueue([]))
+        assert cluster.get("/api/tags") == {"models": []}
+        assert cluster.server_for("llama3.2") is None
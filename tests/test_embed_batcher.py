@@ -0,0 +1,133 @@
+import asyncio
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from ollama_proxy_server.embed_batcher import AsyncEmbedBatcher, EmbedBatcher, batch_key
+
+from .fake_ollama import fake_embedding
+
+
+class FakeSend:
+    def __init__(self, status=200):
+        self.status = status
+        self.batches = []
+        self._lock = threading.Lock()
+
+    def __call__(self, request):
+        with self._lock:
+            self.batches.append(request)
+        if self.status != 200:
+            return self.status, "application/json", b'{"error": "boom"}'
+        data = {"model": request["model"], "embeddings": [fake_embedding(text) for text in request["input"]], "prompt_eval_count": 2 * len(request["input"])}
+        return 200, "application/json; charset=utf-8", json.dumps(data).encode("utf-8")
+
+
+class TestEmbedBatcher:
+    def test_batch_key(self):
+        """
+        Should batch requests with the same model and parameters only
+        """
+        key = batch_key({"model": "nomic", "input": "a"})
+        assert key == batch_key({"model": "nomic:latest", "input": ["b", "c"]})
+        assert key != batch_key({"model": "nomic", "input": "a", "truncate": False})
+        assert key != batch_key({"model": "other", "input": "a"})
+        for request in ({"model": "nomic"}, {"model": "nomic", "input": []}, {"model": "nomic", "input": [1]}, {"input": "a"}, ["a"]):
+            assert batch_key(request) is None
+
+    def test_concurrent_requests(self):
+        """
+        Should send concurrent requests as one and give every caller its vectors
+        """
+        send = FakeSend()
+        batcher = EmbedBatcher(send, max_batch=64, max_wait=0.2)
+        requests = [{"model": "nomic", "input": [f"text {i}", f"more {i}"] if i % 2 else f"text {i}"} for i in range(8)]
+        with ThreadPoolExecutor(8) as pool:
+            results = list(pool.map(batcher.submit, requests))
+        assert len(send.batches) == 1
+        assert len(send.batches[0]["input"]) == 12
+        for request, (status, _, data) in zip(requests, results):
+            texts = [request["input"]] if isinstance(request["input"], str) else request["input"]
+            assert status == 200
+            assert data["embeddings"] == [fake_embedding(text) for text in texts]
+            assert data["prompt_eval_count"] == 2 * len(texts)
+        assert batcher.stats() == {"requests": 8, "batches": 1}
+
+    def test_max_batch(self):
+        """
+        Should send a batch as soon as it is full
+        """
+        send = FakeSend()
+        batcher = EmbedBatcher(send, max_batch=4, max_wait=5)
+        with ThreadPoolExecutor(8) as pool:
+            results = list(pool.map(batcher.submit, [{"model": "nomic", "input": [str(i)]} for i in range(8)]))
+        assert [len(batch["input"]) for batch in send.batches] == [4, 4]
+        assert [data["embeddings"] for _, _, data in results] == [[fake_embedding(str(i))] for i in range(8)]
+
+    def test_server_error(self):
+        """
+        Should give every caller the error of the server
+        """
+        batcher = EmbedBatcher(FakeSend(status=404), max_wait=0.05)
+        with ThreadPoolExecutor(2) as pool:
+            results = list(pool.map(batcher.submit, [{"model": "nope", "input": "a"}] * 2))
+        assert results == [(404, "application/json", b'{"error": "boom"}')] * 2
+
+    def test_send_fails(self):
+        """
+        Should raise in every caller when the batch could not be sent
+        """
+
+        def send(request):
+            raise ConnectionError("down")
+
+        batcher = EmbedBatcher(send, max_wait=0.05)
+        with ThreadPoolExecutor(2) as pool:
+            futures = [pool.submit(batcher.submit, {"model": "nomic", "input": "a"}) for _ in range(2)]
+        for future in futures:
+            with pytest.raises(ConnectionError):
+                future.result()
+
+    def test_async(self):
+        """
+        Should batch the requests of an event loop
+        """
+        send = FakeSend()
+
+        async def async_send(request):
+            return send(request)
+
+        async def run():
+            batcher = AsyncEmbedBatcher(async_send, max_wait=0.05)
+            return await asyncio.gather(*(batcher.submit({"model": "nomic", "input": [str(i)]}) for i in range(5)))
+
+        results = asyncio.run(run())
+        assert len(send.batches) == 1
+        assert [data["embeddings"] for _, _, data in results] == [[fake_embedding(str(i))] for i in range(5)]
+
+    def test_async_leader_cancelled(self):
+        """
+        Should fail the waiting requests and start a new batch when the leader is cancelled while the batch fills
+        """
+        send = FakeSend()
+
+        async def async_send(request):
+            return send(request)
+
+        async def run():
+            batcher = AsyncEmbedBatcher(async_send, max_wait=10)
+            leader = asyncio.ensure_future(batcher.submit({"model": "nomic", "input": ["a"]}))
+            await asyncio.sleep(0)
+            follower = asyncio.ensure_future(batcher.submit({"model": "nomic", "input": ["b"]}))
+            await asyncio.sleep(0)
+            leader.cancel()
+            with pytest.raises(ConnectionError):
+                await asyncio.wait_for(follower, 1)
+            batcher.max_wait = 0.01
+            return await asyncio.wait_for(batcher.submit({"model": "nomic", "input": ["c"]}), 1)
+
+        _, _, data = asyncio.run(run())
+        assert data["embeddings"] == [fake_embedding("c")]
+        assert send.batches == [{"model": "nomic", "input": ["c"]}]
@@ -0,0 +1,111 @@
+import json
+
+import pytest
+
+from ollama_proxy_server.embedding_cache import EmbeddingCache
+
+
+@pytest.fixture
+def cache_path(tmp_path):
+    return str(tmp_path / "embeddings.cache")
+
+
+def vector(i, dim=8):
+    return [i + j / 10 for j in range(dim)]
+
+
+class TestEmbeddingCache:
+    def test_roundtrip(self, cache_path):
+        """
+        Should return the exact vectors stored and None for the others
+        """
+        cache = EmbeddingCache(cache_path, 64 * 1024)
+        keys = [cache.key("llama3.2", f"text {i}") for i in range(3)]
+        cache.put_many([(keys[0], [0.1, 0.2, 1 / 3]), (keys[2], vector(2))])
+        assert cache.get_many(keys) == [[0.1, 0.2, 1 / 3], None, vector(2)]
+        assert cache.key("llama3.2", "a") == cache.key("llama3.2:latest", "a") != cache.key("llama3.2", "a", "params")
+        cache.close()
+
+    def test_persistent_and_shared(self, cache_path):
+        """
+        Should keep the vectors after a restart and share them between open caches
+        """
+        first = EmbeddingCache(cache_path, 64 * 1024)
+        second = EmbeddingCache(cache_path, 1024)
+        key = first.key("m", "shared")
+        first.put_many([(key, vector(1))])
+        assert second.get_many([key]) == [vector(1)]
+        second.put_many([(second.key("m", "other"), vector(2))])
+        first.close()
+        second.close()
+        reopened = EmbeddingCache(cache_path)
+        assert reopened.get_many([key, reopened.key("m", "other")]) == [vector(1), vector(2)]
+        assert reopened.stats()["entries"] == 2
+        assert reopened.stats()["bytes"] == 2 * 8 * 8
+        reopened.close()
+
+    def test_full(self, cache_path):
+        """
+        Should start over when the data region is full
+        """
+        cache = EmbeddingCache(cache_path, 10 * 8 * 8, slots=64)
+        keys = [cache.key("m", str(i)) for i in range(11)]
+        cache.put_many([(key, vector(i)) for i, key in enumerate(keys[:10])])
+        assert None not in cache.get_many(keys[:10])
+        cache.put_many([(keys[10], vector(10))])
+        assert cache.get_many(keys) == [None] * 10 + [vector(10)]
+        assert cache.stats()["entries"] == 1
+        cache.close()
+
+    def test_many_collisions(self, cache_path):
+        """
+        Should keep working when the slots are all taken
+        """
+        cache = EmbeddingCache(cache_path, 1024 * 1024, slots=4)
+        keys = [cache.key("m", str(i)) for i in range(20)]
+        for i, key in enumerate(keys):
+            cache.put_many([(key, vector(i))])
+            assert cache.get_many([key]) == [vector(i)]
+        assert sum(found is not None for found in cache.get_many(keys)) == 4
+        cache.close()
+
+    def test_not_a_cache(self, cache_path):
+        """
+        Should replace a file that is not a cache
+        """
+        with open(cache_path, "wb") as f:
+            f.write(b"something else")
+        cache = EmbeddingCache(cache_path, 1024)
+        assert cache.get_many([cache.key("m", "a")]) == [None]
+        cache.close()
+
+    def test_lookup(self, cache_path):
+        """
+        Should ask the server only for the missing inputs and merge the vectors in order
+        """
+        cache = EmbeddingCache(cache_path, 64 * 1024)
+        body = {"model": "nomic", "input": ["a", "b", "c"]}
+        lookup = cache.lookup("/api/embed", body)
+        assert lookup.missing == [0, 1, 2]
+        merged = lookup.merge({"model": "nomic", "embeddings": [vector(0), vector(1), vector(2)], "prompt_eval_count": 3})
+        assert merged["embeddings"] == [vector(0), vector(1), vector(2)]
+
+        lookup = cache.lookup("/api/embed", {"model": "nomic", "input": ["c", "d", "a"]})
+        assert lookup.missing == [1]
+        assert json.loads(lookup.upstream_body()) == {"model": "nomic", "input": ["d"]}
+        merged = lookup.merge({"model": "nomic", "embeddings": [vector(3)], "prompt_eval_count": 1})
+        assert merged == {"model": "nomic", "embeddings": [vector(2), vector(3), vector(0)], "prompt_eval_count": 1}
+        with pytest.raises(ValueError):
+            cache.lookup("/api/embed", {"model": "nomic", "input": ["e", "f"]}).merge({"embeddings": [vector(4)]})
+
+        # other endpoint or options, other vectors
+        assert cache.lookup("/api/embeddings", {"model": "nomic", "prompt": "a"}).missing == [0]
+        assert cache.lookup("/api/embed", {"model": "nomic", "input": "a", "truncate": False}).missing == [0]
+        assert cache.lookup("/api/embed", {"model": "nomic", "input": []}) is None
+        assert cache.lookup("/api/embed", {"input": ["a"]}) is None
+
+        stats = cache.stats()
+        assert (stats["hits"], stats["misses"]) == (2, 4)
+        assert stats["hit_rate"] == pytest.approx(1 / 3)
+        assert stats["bytes_saved"] == 2 * (1 + 8 * 8)
+        cache.close()
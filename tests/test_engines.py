@@ -0,0 +1,120 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import requests
+
+from .bench_proxy import AUTH, ENGINES, ProxyProcess
+from .fake_ollama import FakeOllama, fake_embedding
+
+GENERATE = {"model": "llama3.2", "prompt": "hi", "stream": False}
+
+
+@pytest.fixture(params=ENGINES)
+def engine(request):
+    return request.param
+
+
+def generated(backend):
+    return [r for r in backend.requests if r[1] == "/api/generate"]
+
+
+class TestEngines:
+    def test_failover(self, engine):
+        """
+        Should send a request to the other server when the first one answers with a 5xx
+        """
+        with FakeOllama() as failing, FakeOllama() as other:
+            failing.fail_status = 503
+            with ProxyProcess([failing, other], engine) as proxy:
+                res = requests.post(proxy.url + "/api/generate", json=GENERATE, headers=AUTH, timeout=10)
+                assert res.status_code == 200
+                assert res.json()["response"] == "Hello world!"
+            assert len(generated(failing)) == 1
+            assert len(generated(other)) == 1
+
+    def test_failover_dead_server(self, engine):
+        """
+        Should send queued and mirrored requests to the other server when the first one is down
+        """
+        with FakeOllama() as dead:
+            pass
+        with FakeOllama() as other, ProxyProcess([dead, other], engine) as proxy:
+            assert requests.post(proxy.url + "/api/generate", json=GENERATE, headers=AUTH, timeout=10).status_code == 200
+            res = requests.get(proxy.url + "/api/version", headers=AUTH, timeout=10)
+            assert res.json() == {"version": "0.0.0-fake"}
+
+    def test_rate_limited(self, engine, tmp_path):
+        """
+        Should answer 429 with a Retry-After once a user is over its limit, the embeddings too
+        """
+        limits = tmp_path / "limits.ini"
+        limits.write_text("[DEFAULT]\nrps = 0.1\nburst = 1\n")
+        with FakeOllama() as backend, ProxyProcess([backend], engine, ["--limits", str(limits)]) as proxy:
+            assert requests.post(proxy.url + "/api/generate", json=GENERATE, headers=AUTH, timeout=10).status_code == 200
+            for path, body in (("/api/generate", GENERATE), ("/api/embed", {"model": "llama3.2", "input": "a"})):
+                res = requests.post(proxy.url + path, json=body, headers=AUTH, timeout=10)
+                assert res.status_code == 429
+                assert int(res.headers["Retry-After"]) >= 1
+            assert len(generated(backend)) == 1
+            assert not [r for r in backend.requests if r[1] == "/api/embed"]
+
+    def test_overloaded(self, engine):
+        """
+        Should answer 503 with a Retry-After when no slot frees up in time
+        """
+        with FakeOllama(ttft=1.0) as backend, ProxyProcess([backend], engine, ["--max_wait", "0.2"], max_concurrency=1) as proxy:
+            busy = threading.Thread(target=requests.post, args=(proxy.url + "/api/generate",), kwargs={"json": GENERATE, "headers": AUTH, "timeout": 10})
+            busy.start()
+            time.sleep(0.3)
+            res = requests.post(proxy.url + "/api/generate", json=GENERATE, headers=AUTH, timeout=10)
+            busy.join()
+        assert res.status_code == 503
+        assert int(res.headers["Retry-After"]) >= 1
+
+    def test_response_cache(self, engine):
+        """
+        Should answer a deterministic request again from the cache
+        """
+        body = dict(GENERATE, options={"temperature": 0, "seed": 1})
+        with FakeOllama() as backend, ProxyProcess([backend], engine, ["--response_cache_mb", "16"]) as proxy:
+            first = requests.post(proxy.url + "/api/generate", json=body, headers=AUTH, timeout=10)
+            second = requests.post(proxy.url + "/api/generate", json=body, headers=AUTH, timeout=10)
+        assert first.status_code == second.status_code == 200
+        assert first.content == second.content
+        assert len(generated(backend)) == 1
+
+    def test_embed_batching(self, engine):
+        """
+        Should send concurrent /api/embed requests to the server together
+        """
+        with FakeOllama() as backend, ProxyProcess([backend], engine, ["--embed_batch_ms", "200"]) as proxy:
+
+            def call(i):
+                res = requests.post(proxy.url + "/api/embed", json={"model": "llama3.2", "input": [str(i)]}, headers=AUTH, timeout=10)
+                return res.json()["embeddings"]
+
+            with ThreadPoolExecutor(6) as pool:
+                results = list(pool.map(call, range(6)))
+        assert results == [[fake_embedding(str(i))] for i in range(6)]
+        batches = [json.loads(body)["input"] for _, path, body in backend.requests if path == "/api/embed"]
+        assert len(batches) < 6
+        assert sorted(text for batch in batches for text in batch) == [str(i) for i in range(6)]
+
+    def test_chunked_upload(self, engine):
+        """
+        Should pass a large chunked upload to the server intact, spooled to disk
+        """
+        data = json.dumps(dict(GENERATE, prompt="x" * 300000)).encode()
+
+        def chunks():
+            for i in range(0, len(data), 65536):
+                yield data[i : i + 65536]
+
+        with FakeOllama() as backend, ProxyProcess([backend], engine, ["--spool_threshold", "100000"]) as proxy:
+            res = requests.post(proxy.url + "/api/generate", data=chunks(), headers=AUTH, timeout=10)
+        assert res.status_code == 200
+        assert res.json()["response"] == "Hello world!"
+        assert generated(backend)[-1] == ("POST", "/api/generate", data)
@@ -0,0 +1,32 @@
+from ollama_proxy_server.failover import RetryBudget, retryable_status
+
+
+class TestRetryBudget:
+    def test_max_retries(self):
+        """
+        Should retry a request on as many other servers as allowed
+        """
+        budget = RetryBudget(max_retries=2)
+        assert budget.allow(0)
+        assert budget.allow(1)
+        assert not budget.allow(2)
+        assert not RetryBudget(max_retries=0).allow(0)
+        assert retryable_status(503)
+        assert not retryable_status(404)
+
+    def test_budget(self):
+        """
+        Should keep the retries to a fraction of the requests
+        """
+        budget = RetryBudget(ratio=0.5, min_per_second=1.0, burst=2.0)
+        assert budget.allow(0, now=budget._updated)
+        assert budget.allow(0, now=budget._updated)
+        assert not budget.allow(0, now=budget._updated)
+        now = budget._updated
+        budget.request(now)
+        budget.request(now)
+        assert budget.allow(0, now)
+        assert not budget.allow(0, now)
+        # time refills it
+        assert budget.allow(0, now + 1.0)
+        assert budget.stats() == {"requests": 2, "retries": 4, "denied": 2}
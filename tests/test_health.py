@@ -0,0 +1,156 @@
+import pytest
+
+from ollama_proxy_server import ollama_queues
+from ollama_proxy_server.main import get_config
+from ollama_proxy_server.ollama_queues.health import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    HealthMonitor,
+    HealthProber,
+)
+
+from .fake_ollama import FakeOllama
+
+test_config = """
+[First]
+url = http://localhost:11434
+max_concurrency = 4
+
+[Second]
+url = http://localhost:11435
+max_concurrency = 4
+model_black_list = ["other"]
+"""
+
+
+@pytest.fixture
+def health_queue():
+    health = HealthMonitor(failures=2, cooldown=10.0, recovery=3)
+    return health, ollama_queues.ModelLoadedQueue(get_config(test_config, "read_string"), health=health)
+
+
+class TestHealthMonitor:
+    def test_consecutive_failures(self):
+        """
+        Should open after consecutive failures only
+        """
+        health = HealthMonitor(failures=3)
+        assert not health.record("a", False, now=0)
+        assert not health.record("a", False, now=1)
+        assert not health.record("a", True, 0.1, now=2)
+        assert not health.record("a", False, now=3)
+        assert not health.probe("a", False, now=4)
+        assert health.probe("a", False, now=5)
+        assert health.state("a") == OPEN
+        assert health.capacity("a", 4) == 0
+        assert not health.available("a")
+        # requests sent before it opened change nothing
+        assert not health.record("a", True, now=6)
+        assert health.state("b") == CLOSED
+
+    def test_half_open(self):
+        """
+        Should let a server back in after the cooldown with one more slot per success
+        """
+        health = HealthMonitor(failures=1, cooldown=10.0, recovery=3)
+        health.record("a", False, now=0)
+        assert not health.probe("a", True, now=5)
+        assert health.probe("a", True, now=10)
+        assert health.state("a") == HALF_OPEN
+        assert health.capacity("a", 4) == 1
+        health.record("a", True, now=11)
+        assert health.capacity("a", 4) == 2
+        health.record("a", True, now=12)
+        assert health.capacity("a", 4) == 3
+        health.record("a", True, now=13)
+        assert health.state("a") == CLOSED
+        assert health.capacity("a", 4) == 4
+
+        health.record("a", False, now=20)
+        health.probe("a", True, now=30)
+        assert health.record("a", False, now=31)
+        assert health.state("a") == OPEN
+
+    def test_outlier(self):
+        """
+        Should take out a server much slower than the others, but never most of them
+        """
+        health = HealthMonitor(outlier_factor=5.0, min_samples=3, max_ejected=0.25)
+        for _ in range(3):
+            for name in ("a", "b", "c"):
+                assert not health.record(name, True, 0.1)
+        health.record("d", True, 2.0)
+        health.record("d", True, 2.0)
+        assert health.record("d", True, 2.0)
+        assert health.state("d") == OPEN
+        for _ in range(3):
+            health.record("c", True, 2.0)
+        assert health.state("c") == CLOSED
+
+        disabled = HealthMonitor(min_samples=1)
+        for name, latency in (("a", 0.1), ("b", 0.1), ("c", 100.0)):
+            disabled.record(name, True, latency)
+        assert disabled.states() == {"a": CLOSED, "b": CLOSED, "c": CLOSED}
+
+
+class TestHealthQueue:
+    def test_eject_and_recover(self, health_queue):
+        """
+        Should stop scheduling a failing server and let it back in gradually
+        """
+        health, mq = health_queue
+        for _ in range(2):
+            assert mq.enqueue({"model": "llama3.2"})[0] == "First"
+            mq.dequeue("First", ok=False)
+        assert mq.health() == {"First": OPEN, "Second": CLOSED}
+        assert mq.limits()["First"] == 0
+        assert [mq.enqueue({"model": "llama3.2"})[0] for _ in range(4)] == ["Second"] * 4
+        # no healthy server for the model
+        assert mq.enqueue({"model": "other"}) is None
+        for _ in range(4):
+            mq.dequeue("Second", ok=True)
+
+        health.cooldown = 0
+        mq.report_probe("First", True)
+        assert mq.health()["First"] == HALF_OPEN
+        assert mq.enqueue({"model": "other"})[0] == "First"
+        with pytest.raises(TimeoutError):
+            mq.enqueue({"model": "other"}, timeout=0.01)
+        mq.dequeue("First", ok=True)
+        assert mq.limits()["First"] == 2
+        mq.enqueue({"model": "other"})
+        mq.dequeue("First", ok=True)
+        mq.enqueue({"model": "other"})
+        mq.dequeue("First", ok=True)
+        assert mq.health()["First"] == CLOSED
+        assert mq.limits()["First"] == 4
+
+    def test_not_sent(self, health_queue):
+        """
+        Should not count requests that were never sent, and forget deleted servers
+        """
+        health, mq = health_queue
+        for _ in range(3):
+            mq.enqueue()
+            mq.dequeue("First")
+        assert mq.health()["First"] == CLOSED
+        mq.enqueue()
+        mq.dequeue("First", ok=False)
+        mq.delete_server("First")
+        assert "First" not in health.states()
+
+    def test_prober(self, health_queue):
+        """
+        Should probe every server and take out the ones not answering
+        """
+        health, mq = health_queue
+        with FakeOllama() as fake:
+            mq.add_server(("First", {"url": fake.url, "max_concurrency": 4}))
+            mq.add_server(("Second", {"url": "http://127.0.0.1:1", "max_concurrency": 4}))
+            prober = HealthProber(mq, timeout=1.0)
+            prober.probe_once()
+            prober.probe_once()
+            prober.stop()
+        assert mq.health() == {"First": CLOSED, "Second": OPEN}
+        assert health.states()["Second"] == OPEN
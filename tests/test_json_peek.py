@@ -0,0 +1,76 @@
+import json
+
+import pytest
+
+from ollama_proxy_server.json_peek import PeekError, _peek, peek_json
+
+from .bench_json_peek import chat_body, multimodal_body
+
+
+class TestPeekJson:
+    @pytest.mark.parametrize(
+        "body",
+        [
+            b'{"model": "llama3.2", "stream": true}',
+            b' {\n"prompt":"a \\"quoted\\" \\\\", "model" : "m\\u00e9", "x": [1, {"y": "]}"}], "stream":false } ',
+            b'{"n": -1.5e3, "t": true, "z": null, "model": "m"}',
+            b"{}",
+            b'{"stream": 0}',
+        ],
+    )
+    def test_same_as_json_loads(self, body):
+        """
+        Should return the same fields as json.loads
+        """
+        data = json.loads(body)
+        expected = {key: data[key] for key in ("model", "stream") if key in data}
+        assert peek_json(body) == expected
+        assert _peek(body, ("model", "stream"))[0] == expected
+
+    def test_large_payload(self):
+        """
+        Should find the fields before and after large images
+        """
+        for model_last in (True, False):
+            body = multimodal_body(64 * 1024, model_last=model_last)
+            assert _peek(body, ("model", "stream"))[0] == {"model": "llava:13b", "stream": False}
+            assert peek_json(body) == {"model": "llava:13b", "stream": False}
+        assert peek_json(chat_body(), ("model", "messages"))["messages"][3]["content"].startswith("message 3")
+
+    def test_gives_up_on_many_values(self):
+        """
+        Should leave bodies made of many small values to json.loads
+        """
+        with pytest.raises(PeekError):
+            _peek(chat_body(), ("model",))
+        assert peek_json(chat_body()) == {"model": "llama3.2"}
+
+    @pytest.mark.parametrize(
+        "body",
+        [
+            b'{"model": "a", "model": "b"}',
+            b'{"model": "a", "x": [1, 2}, "stream": true}',
+            b'{"model": "a"} trailing',
+            b'["model"]',
+            b'{"model": "a", "x": "unterminated}',
+        ],
+    )
+    def test_fallback(self, body):
+        """
+        Should leave malformed or ambiguous bodies to json.loads
+        """
+        with pytest.raises(PeekError):
+            _, end = _peek(body, ("model", "stream"))
+            if body[end:].strip():
+                raise PeekError("trailing data")
+        try:
+            data = json.loads(body)
+        except ValueError as ex:
+            with pytest.raises(type(ex)):
+                peek_json(body)
+            return
+        if isinstance(data, dict):
+            assert peek_json(body) == {"model": data["model"]}
+        else:
+            with pytest.raises(ValueError):
+                peek_json(body)
@@ -2,6 +2,9 @@ import jwt
 import timeit
 import sys
 import math
+import time
+
+from ollama_proxy_server.auth import TokenCache, validate_auth_header
 
 
 def _format_time(timespan, precision=3):
@@ -134,6 +137,21 @@ def decode():
     jwt.decode(encoded, key, algorithms="HS256")
 
 
+token_header = "Bearer " + jwt.encode({"user": "user1", "aud": "urn:ollama_proxy", "exp": int(time.time()) + 3600}, key, algorithm="HS256")
+token_cache = TokenCache()
+users = {}
+
+
+def validate():
+    """validate without cache"""
+    validate_auth_header(token_header, users, key)
+
+
+def validate_cached():
+    """validate through the verified token cache"""
+    validate_auth_header(token_header, users, key, token_cache)
+
+
 def test_jwt_decode_speed():
     print("decode jwt")
     a = run_timeit(decode, number=1000)
@@ -148,6 +166,18 @@ def test_jwt_encode_speed():
     assert a.worst < 10e-5
 
 
+def test_validate_cached_speed():
+    print("validate jwt")
+    uncached = run_timeit(validate, number=1000)
+    print(uncached)
+    print("validate jwt cached")
+    cached = run_timeit(validate_cached, number=1000)
+    print(cached)
+    print(token_cache.stats())
+    assert token_cache.stats()["misses"] == 1
+    assert cached.best < uncached.best
+
+
 if __name__ == "__main__":
     print("encode jwt")
     a = run_timeit("encode()", setup="from __main__ import encode", number=1000)
@@ -155,3 +185,9 @@ if __name__ == "__main__":
     print("decode jwt")
     a = run_timeit("decode()", setup="from __main__ import decode", number=1000)
     print(a)
+    print("validate jwt")
+    a = run_timeit("validate()", setup="from __main__ import validate", number=1000)
+    print(a)
+    print("validate jwt cached")
+    a = run_timeit("validate_cached()", setup="from __main__ import validate_cached", number=1000)
+    print(a)
@@ -0,0 +1,115 @@
+import threading
+
+import requests
+
+from ollama_proxy_server import ollama_queues
+from ollama_proxy_server.metrics import (
+    OVERFLOW,
+    Histogram,
+    MetricsServer,
+    ProxyMetrics,
+    Registry,
+    RequestTimer,
+)
+
+
+class TestHistogram:
+    def test_buckets(self):
+        """
+        Should count values in cumulative buckets
+        """
+        h = Histogram("h", "help", ("server",), buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 5):
+            h.observe(value, "a")
+        cumulative, total, count = h.collect()[("a",)]
+        assert cumulative == [2, 3, 4]
+        assert total == 5.65
+        assert count == 4
+
+    def test_threads(self):
+        """
+        Should not lose values recorded by many threads
+        """
+        h = Histogram("h", "help", ("server",), stripes=4)
+
+        def work():
+            for _ in range(1000):
+                h.observe(0.01, "a")
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert h.collect()[("a",)][2] == 8000
+
+    def test_max_series(self):
+        """
+        Should fold label combinations past max_series into one
+        """
+        h = Histogram("h", "help", ("model",), max_series=2)
+        for model in ("a", "b", "c", "d", "a"):
+            h.observe(1, model)
+        series = h.collect()
+        assert set(series) == {("a",), ("b",), (OVERFLOW,)}
+        assert series[(OVERFLOW,)][2] == 2
+
+
+class TestRegistry:
+    def test_render(self):
+        """
+        Should render the prometheus text format
+        """
+        registry = Registry()
+        h = registry.histogram("req_seconds", "Request time", ("server", "model"), buckets=(1,))
+        registry.gauge("depth", "Queue depth", ("server",), lambda: [(("a",), 3)])
+        h.observe(0.5, "a", 'quo"te')
+        assert registry.render() == (
+            "# HELP req_seconds Request time\n"
+            "# TYPE req_seconds histogram\n"
+            'req_seconds_bucket{server="a",model="quo\\"te",le="1.0"} 1\n'
+            'req_seconds_bucket{server="a",model="quo\\"te",le="+Inf"} 1\n'
+            'req_seconds_sum{server="a",model="quo\\"te"} 0.5\n'
+            'req_seconds_count{server="a",model="quo\\"te"} 1\n'
+            "# HELP depth Queue depth\n"
+            "# TYPE depth gauge\n"
+            'depth{server="a"} 3\n'
+        )
+
+    def test_stats(self):
+        """
+        Should render counters and counters per server as gauges
+        """
+        metrics = ProxyMetrics(ollama_queues.SimpleQueue([]))
+        metrics.add_stats("access_log", "Access log", lambda: {"written": 3, "dropped": 1})
+        metrics.add_server_stats("upstream_pool", "Pool", lambda: {"a": {"connections": 1, "reused": 2}})
+        text = metrics.registry.render()
+        assert 'ollama_proxy_access_log{stat="dropped"} 1\n' in text
+        assert 'ollama_proxy_upstream_pool{server="a",stat="connections"} 1\n' in text
+        assert 'ollama_proxy_upstream_pool{server="a",stat="reused"} 2\n' in text
+
+    def test_server(self):
+        """
+        Should serve the metrics on /metrics only
+        """
+        registry = Registry()
+        registry.gauge("depth", "Queue depth", (), lambda: [((), 1)])
+        server = MetricsServer(registry, host="127.0.0.1", port=0).start()
+        try:
+            res = requests.get(f"http://127.0.0.1:{server.port}/metrics", timeout=5)
+            assert res.status_code == 200
+            assert res.headers["Content-Type"].startswith("text/plain")
+            assert "depth 1" in res.text
+            assert requests.get(f"http://127.0.0.1:{server.port}/", timeout=5).status_code == 404
+        finally:
+            server.stop()
+
+    def test_timer(self):
+        """
+        Should keep the first time the body was written
+        """
+        timer = RequestTimer()
+        timer.mark_first_byte()
+        first = timer.first_byte
+        timer.mark_first_byte()
+        assert timer.first_byte == first >= timer.start
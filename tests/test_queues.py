@@ -1,10 +1,19 @@
 # content of conftest.py
-import pytest
+import asyncio
 import datetime
+import threading
+import time
+
+import pytest
 
 from ollama_proxy_server import ollama_queues
+from ollama_proxy_server.ollama_queues.adaptive import AimdLimit
+from ollama_proxy_server.ollama_queues.load_index import LoadIndex
+from ollama_proxy_server.ollama_queues.residency import parse_expires_at
 from ollama_proxy_server.main import get_config
 
+from .fake_ollama import FakeOllama
+
 test_config = """
 [DefaultServer00]
 url = http://localhost:11434
@@ -332,3 +341,536 @@ class TestModelQueue:
         sf = {"model": "llama3.2"}
         ms = mq.enqueue(filter_=sf)
         assert ms is None
+
+
+class TestReservation:
+    def test_wakeup_on_dequeue(self, simple_queue):
+        """
+        Should wake a waiter as soon as a slot is released, not on a poll interval
+        """
+        servers, mq = simple_queue
+        for _ in servers:
+            mq.enqueue()
+        granted = []
+
+        def wait():
+            granted.append((mq.enqueue(timeout=5), time.monotonic()))
+
+        waiter = threading.Thread(target=wait)
+        waiter.start()
+        while mq.waiting() == 0:
+            time.sleep(0.001)
+        released = time.monotonic()
+        mq.dequeue(servers[1][0])
+        waiter.join(5)
+        assert granted[0][0][0] == servers[1][0]
+        assert granted[0][1] - released < 0.1
+
+    def test_fifo(self, simple_queue):
+        """
+        Should grant slots in arrival order
+        """
+        servers, mq = simple_queue
+        for _ in servers:
+            mq.enqueue()
+        order = []
+        threads = []
+        for i in range(10):
+            thread = threading.Thread(target=lambda i=i: order.append((i, mq.enqueue(timeout=5)[0])))
+            thread.start()
+            threads.append(thread)
+            while mq.waiting() != i + 1:
+                time.sleep(0.001)
+        for i in range(10):
+            done = len(order)
+            mq.dequeue(servers[0][0])
+            while len(order) == done:
+                time.sleep(0.001)
+        for thread in threads:
+            thread.join(5)
+        assert [i for i, _ in order] == list(range(10))
+
+    @staticmethod
+    def _grant_order(filters):
+        """the order in which requests with filters, arriving one after the other, get the only slot"""
+        servers = get_config("[Only]\nurl = http://localhost:11434\n", "read_string")
+        mq = ollama_queues.SimpleQueue(servers)
+        mq.enqueue()
+        order = []
+        threads = []
+        for i, filter_ in enumerate(filters):
+            thread = threading.Thread(target=lambda filter_=filter_: order.append(mq.enqueue(filter_, timeout=5) and filter_["user"]))
+            thread.start()
+            threads.append(thread)
+            while mq.waiting() != i + 1:
+                time.sleep(0.001)
+        for _ in filters:
+            done = len(order)
+            mq.dequeue("Only")
+            while len(order) == done:
+                time.sleep(0.001)
+        for thread in threads:
+            thread.join(5)
+        return order
+
+    def test_fair_between_users(self):
+        """
+        Should serve a user with one request before the backlog of another user
+        """
+        order = self._grant_order([{"user": "batch"}] * 6 + [{"user": "alice"}])
+        assert order.index("alice") == 1
+
+    def test_weights(self):
+        """
+        Should give users slots in proportion to their weight
+        """
+        order = self._grant_order([{"user": "big", "weight": 2}] * 6 + [{"user": "small"}] * 3)
+        assert order == ["big", "small", "big", "big", "small", "big", "big", "small", "big"]
+
+    def test_lines(self, model_queue):
+        """
+        Should pass over the waiters that can not use a released server, in one look per set of servers
+        """
+        servers, mq = model_queue
+        for _ in servers:
+            mq.enqueue()
+        granted = []
+        threads = []
+        # LocalServer01 only for llama3.2:1b, LocalServer01 and LocalServer02 for llama3.2
+        for i, model in enumerate(["llama3.2:1b"] * 5 + ["llama3.2"]):
+            thread = threading.Thread(target=lambda i=i, model=model: granted.append((i, mq.enqueue({"model": model}, timeout=5)[0])))
+            thread.start()
+            threads.append(thread)
+            while mq.waiting() != i + 1:
+                time.sleep(0.001)
+        assert len(mq._lines) == 2
+        mq.dequeue("DefaultServer00")
+        assert mq.waiting() == 6
+        mq.dequeue("LocalServer02")
+        while not granted:
+            time.sleep(0.001)
+        assert granted == [(5, "LocalServer02")]
+        mq.dequeue("LocalServer01")
+        while len(granted) == 1:
+            time.sleep(0.001)
+        assert granted[1] == (0, "LocalServer01")
+        for _ in range(4):
+            done = len(granted)
+            mq.dequeue("LocalServer01")
+            while len(granted) == done:
+                time.sleep(0.001)
+        for thread in threads:
+            thread.join(5)
+        assert [i for i, _ in granted] == [5, 0, 1, 2, 3, 4]
+        assert mq.waiting() == 0
+        assert mq._lines == {}
+
+    def test_timeout_leaves_no_waiter(self, simple_queue):
+        """
+        Should remove the reservation when it times out
+        """
+        servers, mq = simple_queue
+        for _ in servers:
+            mq.enqueue()
+        with pytest.raises(TimeoutError):
+            mq.enqueue(timeout=0.05)
+        assert mq.waiting() == 0
+        mq.dequeue(servers[0][0])
+        assert mq.get_length(servers[0][0]) == 0
+
+    def test_stress_never_oversubscribed(self):
+        """
+        Should never have more requests in flight on a server than it has slots
+        """
+        servers = get_config(test_config, "read_string")
+        mq = ollama_queues.ModelLoadedQueue(servers, max_queue_size=2)
+        lock = threading.Lock()
+        in_flight = {s[0]: 0 for s in servers}
+        peak = {s[0]: 0 for s in servers}
+        models = [None, "llama3.2", "llama3.2:1b", "other"]
+
+        def worker(n):
+            for i in range(50):
+                model = models[(n + i) % len(models)]
+                server = mq.enqueue({"model": model} if model else None, timeout=10)
+                with lock:
+                    in_flight[server[0]] += 1
+                    peak[server[0]] = max(peak[server[0]], in_flight[server[0]])
+                time.sleep(0.0005)
+                with lock:
+                    in_flight[server[0]] -= 1
+                mq.dequeue(server[0], ok=True)
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(32)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(60)
+        assert not any(thread.is_alive() for thread in threads)
+        assert max(peak.values()) <= 2
+        assert all(mq.get_length(s[0]) == 0 for s in servers)
+        assert mq.waiting() == 0
+
+    def test_async_enqueue(self, simple_queue):
+        """
+        Should wait on the event loop and be woken by dequeue from another thread
+        """
+        servers, mq = simple_queue
+
+        async def run():
+            for _ in servers:
+                await mq.enqueue_async()
+            with pytest.raises(TimeoutError):
+                await mq.enqueue_async(timeout=0.05)
+            waiter = asyncio.ensure_future(mq.enqueue_async(timeout=5))
+            await asyncio.sleep(0.01)
+            threading.Thread(target=mq.dequeue, args=(servers[2][0],)).start()
+            server = await waiter
+            assert server[0] == servers[2][0]
+
+            # a cancelled waiter must not keep a slot
+            waiter = asyncio.ensure_future(mq.enqueue_async())
+            await asyncio.sleep(0.01)
+            waiter.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await waiter
+            assert mq.waiting() == 0
+
+        asyncio.run(run())
+
+
+class TestLoadIndex:
+    def test_order(self):
+        """
+        Should prefer fewer requests in flight then config order
+        """
+        index = LoadIndex()
+        for rank, name in enumerate("abc"):
+            index.add(name, rank, capacity=2)
+        assert index.best() == "a"
+        index.incr("a")
+        assert index.best() == "b"
+        index.incr("b")
+        index.incr("c")
+        assert index.best() == "a"
+        index.incr("a")
+        assert index.best() == "b"
+        index.incr("b")
+        index.incr("c")
+        assert index.best() is None
+        index.incr("c", -1)
+        assert index.best() == "c"
+        assert index.count("a") == 2
+        assert index.count("unknown") == 0
+
+    def test_best_of_names(self):
+        """
+        Should only pick from the given names, both for few and many names
+        """
+        index = LoadIndex()
+        for rank in range(100):
+            index.add(f"s{rank}", rank)
+        assert index.best({"s50", "s7"}) == "s7"
+        many = {f"s{rank}" for rank in range(40, 100)}
+        assert index.best(many) == "s40"
+        index.incr("s7")
+        assert index.best({"s50", "s7"}) == "s50"
+        assert index.best({"s7"}) is None
+        assert index.best({"nope"}) is None
+
+    def test_capacity_and_remove(self):
+        """
+        Should follow capacity changes and removed servers
+        """
+        index = LoadIndex()
+        index.add("a", 0, capacity=1)
+        index.add("b", 1, capacity=1)
+        index.incr("a")
+        index.set_capacity("a", 3)
+        assert index.has_free_slot("a")
+        index.remove("b")
+        assert "b" not in index
+        assert index.best() == "a"
+        index.set_capacity("a", 1)
+        assert index.best() is None
+
+    def test_large_fleet(self):
+        """
+        Should fill a large fleet evenly, least loaded first
+        """
+        servers = get_config("".join(f"[Server{i:04}]\nurl = http://localhost:{10000 + i}\n" for i in range(1000)), "read_string")
+        mq = ollama_queues.SimpleQueue(servers, max_queue_size=2)
+        picked = [mq.enqueue()[0] for _ in range(2000)]
+        assert picked[:1000] == [s[0] for s in servers]
+        assert picked[1000:] == [s[0] for s in servers]
+        with pytest.raises(TimeoutError):
+            mq.enqueue(timeout=0.01)
+        mq.dequeue(servers[500][0])
+        assert mq.enqueue()[0] == servers[500][0]
+
+    def test_weight(self):
+        """
+        Should compare the requests in flight relative to the weight
+        """
+        index = LoadIndex()
+        index.add("big", 1, capacity=4, weight=2.0)
+        index.add("small", 0, capacity=4)
+        picked = []
+        for _ in range(6):
+            picked.append(index.best())
+            index.incr(picked[-1])
+        assert picked == ["small", "big", "big", "small", "big", "big"]
+        index.set_weight("big", 1.0)
+        index.incr("small", -2)
+        assert index.best() == "small"
+
+
+capacity_config = """
+[Big]
+url = http://localhost:11434
+max_concurrency = 3
+weight = 3
+
+[Small]
+url = http://localhost:11435
+"""
+
+
+class TestCapacity:
+    def test_config(self):
+        """
+        Should read max_concurrency and weight, with defaults for servers without them
+        """
+        servers = dict(get_config(capacity_config, "read_string"))
+        assert (servers["Big"]["max_concurrency"], servers["Big"]["weight"]) == (3, 3.0)
+        assert (servers["Small"]["max_concurrency"], servers["Small"]["weight"]) == (None, 1.0)
+
+    def test_per_server_slots(self):
+        """
+        Should give each server its own number of slots, max_queue_size for the ones without
+        """
+        servers = get_config(capacity_config, "read_string")
+        mq = ollama_queues.SimpleQueue(servers, max_queue_size=1)
+        picked = [mq.enqueue()[0] for _ in range(4)]
+        assert sorted(picked) == ["Big", "Big", "Big", "Small"]
+        with pytest.raises(TimeoutError):
+            mq.enqueue(timeout=0.01)
+        assert mq.limits() == {"Big": 3, "Small": 1}
+
+    def test_reload(self):
+        """
+        Should apply a changed max_concurrency and weight to a known server
+        """
+        servers = get_config(capacity_config, "read_string")
+        mq = ollama_queues.ModelLoadedQueue(servers)
+        mq.add_server(("Small", dict(servers[1][1], max_concurrency=2, weight=2.0)))
+        assert mq.limits() == {"Big": 3, "Small": 2}
+        assert [mq.enqueue()[0] for _ in range(5)].count("Small") == 2
+
+    def test_adaptive(self):
+        """
+        Should lower the slots of a slow server and raise them again when it is fast
+        """
+        servers = get_config(capacity_config, "read_string")
+        mq = ollama_queues.ModelLoadedQueue(servers, adaptive=True)
+        assert mq.limits() == {"Big": 3, "Small": 1}
+        for latency in (0.1, 1.0):
+            mq.enqueue({"model": "llama3.2"})
+            mq.dequeue("Big", ok=True, latency=latency)
+        assert mq.limits()["Big"] == 2
+        for _ in range(20):
+            mq.enqueue({"model": "llama3.2"})
+            mq.dequeue("Big", ok=True, latency=0.1)
+        assert mq.limits()["Big"] == 3
+        # unknown latency changes nothing
+        mq.enqueue()
+        mq.dequeue("Big", ok=False)
+        assert mq.limits()["Big"] == 3
+
+    def test_aimd(self):
+        """
+        Should cut the limit once per slow round trip and grow it by one per limit fast answers
+        """
+        limit = AimdLimit(8)
+        assert limit.update(1.0, now=0) == 8
+        assert limit.update(3.0, now=1) == 6
+        # the other requests running at the time report it too
+        assert limit.update(3.0, now=1.5) == 6
+        assert limit.update(3.0, now=4) == 4
+        assert limit.update(1.0, now=5) == 4
+        for step in range(4):
+            limit.update(1.0, now=6 + step)
+        assert limit.limit == 5
+        for i in range(10):
+            limit.update(100.0, now=1000 + i * 1000)
+        assert limit.limit == 1
+        assert AimdLimit(1).update(100.0) == 1
+
+
+@pytest.fixture
+def fake_backends():
+    with FakeOllama() as first, FakeOllama() as second:
+        yield first, second
+
+
+class TestResidency:
+    def test_parse(self):
+        """
+        Should parse ollama timestamps with nanoseconds and offsets
+        """
+        assert parse_expires_at("2024-06-04T14:38:31.83753123-07:00") == pytest.approx(1717537111.837531)
+        assert parse_expires_at("2024-06-04T21:38:31Z") == 1717537111.0
+
+    def test_update_and_expiry(self):
+        """
+        Should know what is loaded until it expires
+        """
+        residency = ollama_queues.ModelResidency([])
+        residency.update(
+            "a",
+            {"models": [{"model": "llama3.2:latest", "expires_at": "2024-06-04T21:38:31Z", "size_vram": 42}]},
+        )
+        assert residency.is_loaded("a", "llama3.2", now=1717537000)
+        assert residency.loaded("a", now=1717537000)["llama3.2:latest"].size_vram == 42
+        assert not residency.is_loaded("a", "llama3.2", now=1717538000)
+        assert not residency.is_loaded("b", "llama3.2")
+
+    def test_poll_fake_backends(self, fake_backends):
+        """
+        Should prefer the server that reports the model loaded
+        """
+        first, second = fake_backends
+        second.load("llama3.2:1b")
+        servers = get_config(f"[First]\nurl = {first.url}\n[Second]\nurl = {second.url}\n", "read_string")
+        residency = ollama_queues.ModelResidency(servers)
+        residency.poll_once()
+        assert residency.is_loaded("Second", "llama3.2:1b")
+        assert not residency.is_loaded("First", "llama3.2:1b")
+
+        mq = ollama_queues.ModelLoadedQueue(servers, residency=residency)
+        ms = mq.enqueue({"model": "llama3.2:1b"})
+        assert ms[0] == "Second"
+        mq.dequeue(ms[0])
+        ms = mq.enqueue({"model": "other"})
+        assert ms[0] == "First"
+        mq.dequeue(ms[0])
+
+    def test_poll_dead_backend(self):
+        """
+        Should forget what was loaded on a server that does not answer
+        """
+        servers = get_config("[Dead]\nurl = http://127.0.0.1:1\n", "read_string")
+        residency = ollama_queues.ModelResidency(servers, timeout=0.5)
+        residency.mark_loaded("Dead", "llama3.2")
+        assert residency.is_loaded("Dead", "llama3.2")
+        residency.poll_once()
+        assert not residency.is_loaded("Dead", "llama3.2")
+
+    def test_poller_thread(self, fake_backends):
+        """
+        Should keep polling in the background
+        """
+        first, _ = fake_backends
+        servers = get_config(f"[First]\nurl = {first.url}\n", "read_string")
+        residency = ollama_queues.ModelResidency(servers, interval=0.02).start()
+        first.load("llama3.2")
+        deadline = time.monotonic() + 5
+        while not residency.is_loaded("First", "llama3.2") and time.monotonic() < deadline:
+            time.sleep(0.01)
+        residency.stop()
+        assert residency.is_loaded("First", "llama3.2")
+
+    def test_last_model_fallback(self, model_queue):
+        """
+        Should prefer the server that served the model recently without residency
+        """
+        servers, mq = model_queue
+        ms = mq.enqueue({"model": "other"})
+        assert ms[0] == servers[0][0]
+        mq.dequeue(ms[0], ok=True)
+        ms = mq.enqueue({"model": "llama3.2:3b"})
+        assert ms[0] == servers[0][0]
+        other = mq.enqueue({"model": "other"})
+        assert other[0] == servers[1][0]
+        mq.dequeue(ms[0], ok=True)
+        mq.dequeue(other[0], ok=True)
+        assert mq.enqueue({"model": "other"})[0] == servers[1][0]
+
+
+test_config_glob = """
+[Small]
+url = http://localhost:11434
+model_black_list = ["llama3.*"]
+
+[Qwen]
+url = http://localhost:11435
+model_black_list = ["*"]
+model_white_list = ["qwen2.5:*"]
+
+[Any]
+url = http://localhost:11436
+"""
+
+
+class TestEligibility:
+    def test_glob_rules(self):
+        """
+        Should match white and black list entries as glob patterns
+        """
+        servers = get_config(test_config_glob, "read_string")
+        mq = ollama_queues.ModelLoadedQueue(servers)
+        names = lambda model: {server[0] for server in mq._eligible_servers(model)}
+        assert names("llama3.2:1b") == {"Any"}
+        assert names("qwen2.5:7b") == {"Small", "Qwen", "Any"}
+        assert names("qwen2:7b") == {"Small", "Any"}
+
+    def test_memoized(self, model_queue):
+        """
+        Should return the same group for a model until the servers change
+        """
+        servers, mq = model_queue
+        group = mq._eligible_servers("llama3.2:1b")
+        assert mq._eligible_servers("llama3.2:1b") is group
+        assert group.names == {servers[1][0]}
+
+        mq.add_server(("LocalServer03", {"url": "http://localhost:11437", "model_wl": None, "model_bl": None}))
+        assert mq._eligible_servers("llama3.2:1b") is not group
+        assert mq._eligible_servers("llama3.2:1b").names == {servers[1][0], "LocalServer03"}
+
+        mq.delete_server("LocalServer03")
+        assert mq._eligible_servers("llama3.2:1b").names == {servers[1][0]}
+
+    def test_delete_busy_server_drains(self, model_queue):
+        """
+        Should not schedule on a deleted server and forget it when its last request is done
+        """
+        servers, mq = model_queue
+        name = servers[0][0]
+        assert mq.enqueue()[0] == name
+        mq.delete_server(name)
+        for _ in range(2):
+            assert mq.enqueue()[0] != name
+        assert mq.get_length(name) == 1
+        mq.dequeue(name, ok=True)
+        assert mq.get_length(name) == 0
+        with pytest.raises(KeyError):
+            mq.dequeue(name)
+
+    def test_waiter_gets_added_server(self, model_queue):
+        """
+        Should hand a newly added server to a request waiting for the model
+        """
+        servers, mq = model_queue
+        ms = mq.enqueue({"model": "llama3.2:1b"})
+        assert ms[0] == servers[1][0]
+        result = []
+        waiter = threading.Thread(target=lambda: result.append(mq.enqueue({"model": "llama3.2:1b"}, timeout=5)))
+        waiter.start()
+        deadline = time.monotonic() + 5
+        while mq.waiting() == 0 and time.monotonic() < deadline:
+            time.sleep(0.001)
+        mq.add_server(("LocalServer03", {"url": "http://localhost:11437", "model_wl": None, "model_bl": None}))
+        waiter.join(5)
+        assert result[0][0] == "LocalServer03"
+        mq.dequeue(ms[0])
+        mq.dequeue("LocalServer03")
@@ -0,0 +1,153 @@
+import json
+
+import pytest
+
+from ollama_proxy_server.rate_limit import (
+    Limits,
+    RateLimited,
+    RateLimiter,
+    UsageMeter,
+    count_tokens,
+    get_limits,
+    retry_after_header,
+)
+
+limits_config = """
+[DEFAULT]
+rps = 2
+burst = 4
+
+[batch]
+concurrency = 2
+tokens = 100
+window = 60
+"""
+
+
+class TestRateLimiter:
+    def test_token_bucket(self):
+        """
+        Should admit a burst, then requests at the refill rate
+        """
+        limiter = RateLimiter(Limits(rps=2, burst=3))
+        for _ in range(3):
+            limiter.acquire("user1", now=0).release()
+        with pytest.raises(RateLimited) as ex:
+            limiter.acquire("user1", now=0)
+        assert ex.value.retry_after == pytest.approx(0.5)
+        limiter.acquire("user1", now=0.5).release()
+        # users have their own bucket
+        limiter.acquire("user2", now=0.5).release()
+        assert limiter.stats() == {"admitted": 5, "rejected": 1, "tracked": 2}
+
+    def test_concurrency(self):
+        """
+        Should limit the requests in flight, a ticket is released once
+        """
+        limiter = RateLimiter(limits={"batch": Limits(concurrency=2)})
+        first = limiter.acquire("batch")
+        limiter.acquire("batch")
+        with pytest.raises(RateLimited):
+            limiter.acquire("batch")
+        first.release()
+        first.release()
+        limiter.acquire("batch")
+        with pytest.raises(RateLimited):
+            limiter.acquire("batch")
+        # no limits, no ticket
+        assert limiter.acquire("other") is None
+
+    def test_token_quota(self):
+        """
+        Should reject a user over its tokens until the window is over
+        """
+        limiter = RateLimiter(Limits(tokens=100, window=60))
+        limits = limiter.acquire("user1", now=0).limits
+        limiter.release("user1", limits, 60, now=5)
+        limiter.acquire("user1", now=10)
+        limiter.release("user1", limits, 50, now=15)
+        with pytest.raises(RateLimited) as ex:
+            limiter.acquire("user1", now=20)
+        assert ex.value.retry_after == pytest.approx(40)
+        assert limiter.acquire("user1", now=60) is not None
+
+    def test_jwt_override(self):
+        """
+        Should take the limits of the jwt claims over the file
+        """
+        limiter = RateLimiter(Limits(rps=10, burst=20))
+        assert limiter.limits_for("user1", {"sub": "user1"}) == Limits(rps=10, burst=20)
+        assert limiter.limits_for("user1", {"rps": 1}) == Limits(rps=1, burst=1)
+        assert limiter.limits_for("user1", {"rps": 1, "burst": 5, "tokens": "many"}) == Limits(rps=1, burst=5)
+        assert limiter.limits_for("user1", {"rps": 0}) == Limits()
+        limiter.acquire("user1", {"rps": 1}, now=0)
+        with pytest.raises(RateLimited):
+            limiter.acquire("user1", {"rps": 1}, now=0)
+
+    def test_prune(self):
+        """
+        Should forget idle users once there are too many
+        """
+        limiter = RateLimiter(Limits(rps=1), max_idle=2)
+        limiter.acquire("user1", now=0).release()
+        limiter.acquire("user2", now=0)
+        limiter.acquire("user3", now=10)
+        assert limiter.stats()["tracked"] == 2
+
+    def test_get_limits(self):
+        """
+        Should read the default and the limits of every section
+        """
+        default, limits = get_limits(limits_config, "read_string")
+        assert default == Limits(rps=2, burst=4)
+        assert limits == {"batch": Limits(rps=2, burst=4, concurrency=2, tokens=100, window=60)}
+        with pytest.raises(ValueError):
+            get_limits("[DEFAULT]\nrps = fast\n", "read_string")
+        assert retry_after_header(0.2) == "1"
+        assert retry_after_header(2.5) == "3"
+
+
+class TestUsageMeter:
+    def test_stream(self):
+        """
+        Should count the tokens of the last chunk and pass the writes on
+        """
+        out = []
+
+        class File:
+            def write(self, data):
+                out.append(data)
+
+            def flush(self):
+                pass
+
+        meter = UsageMeter(File())
+        meter.write(json.dumps({"response": "hi", "done": False}).encode() + b"\n")
+        meter.write(json.dumps({"response": "", "done": True, "prompt_eval_count": 12, "eval_count": 30}).encode() + b"\n")
+        meter.flush()
+        assert meter.tokens() == 42
+        assert len(out) == 2
+
+    def test_large_body(self):
+        """
+        Should find the counters after a large context
+        """
+        meter = UsageMeter()
+        meter.write(json.dumps({"response": "x" * 10000, "context": list(range(5000)), "prompt_eval_count": 7, "eval_count": 3}).encode())
+        assert meter.tokens() == 10
+
+    def test_openai(self):
+        """
+        Should count the usage of openai responses
+        """
+        meter = UsageMeter()
+        meter.write(b'data: {"choices": [], "usage": {"prompt_tokens": 5, "completion_tokens": 8, "total_tokens": 13}}\n\ndata: [DONE]\n\n')
+        assert meter.tokens() == 13
+        assert UsageMeter().tokens() == 0
+
+    def test_count_tokens(self):
+        """
+        Should count the prompt tokens of a whole embed response
+        """
+        assert count_tokens(json.dumps({"embeddings": [[0.1] * 4000], "prompt_eval_count": 12}).encode()) == 12
+        assert count_tokens(b'{"embedding": [0.1]}') == 0
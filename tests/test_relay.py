@@ -0,0 +1,139 @@
+import json
+import threading
+
+import pytest
+import requests
+
+from ollama_proxy_server.relay import NdjsonCoalescer, coalesce_window, relay_response
+
+from .fake_ollama import FakeOllama
+
+
+class RecordingFile:
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(bytes(data))
+
+    def flush(self):
+        pass
+
+    @property
+    def data(self):
+        return b"".join(self.writes)
+
+
+@pytest.fixture
+def backend():
+    with FakeOllama(tokens=[f"tok{i} " for i in range(50)]) as fake:
+        yield fake
+
+
+class TestNdjsonCoalescer:
+    def test_no_window(self):
+        """
+        Should pass every chunk straight through
+        """
+        co = NdjsonCoalescer(0)
+        assert co.feed(b'{"a": 1}\n', now=0) == b'{"a": 1}\n'
+        assert co.feed(b'{"a"', now=0) == b'{"a"'
+        assert co.flush() == b""
+
+    def test_window_keeps_lines_intact(self):
+        """
+        Should hold chunks for the window and only release whole lines
+        """
+        co = NdjsonCoalescer(0.05)
+        assert co.feed(b'{"a": 1}\n', now=1.0) is None
+        assert co.feed(b'{"b": 2}\n{"c"', now=1.01) is None
+        assert co.feed(b": 3}", now=1.06) == b'{"a": 1}\n{"b": 2}\n'
+        assert co.feed(b"\n", now=1.07) is None
+        assert co.feed(b'{"d": 4}\n', now=1.2) == b'{"c": 3}\n{"d": 4}\n'
+        assert co.flush() == b""
+
+    def test_flush(self):
+        """
+        Should return what is left at the end
+        """
+        co = NdjsonCoalescer(1)
+        co.feed(b'{"a": 1}\n{"b"', now=0)
+        assert co.flush() == b'{"a": 1}\n{"b"'
+
+    def test_pending(self):
+        """
+        Should tell when the complete lines held back are due
+        """
+        co = NdjsonCoalescer(0.05)
+        assert co.pending(now=1.0) is None
+        co.feed(b'{"a"', now=1.0)
+        assert co.pending(now=1.01) is None
+        co.feed(b": 1}\n", now=1.02)
+        assert co.pending(now=1.03) == pytest.approx(0.02)
+        assert co.pending(now=2.0) == 0.0
+        assert co.feed(b"", now=2.0) == b'{"a": 1}\n'
+        assert co.pending(now=2.0) is None
+
+    def test_window_from_header(self):
+        """
+        Should fall back to the default and clamp the window
+        """
+        assert coalesce_window(None, 20) == 0.02
+        assert coalesce_window("5", 20) == 0.005
+        assert coalesce_window("bad", 20) == 0.02
+        assert coalesce_window("-3") == 0.0
+        assert coalesce_window("100000") == 1.0
+
+
+class TestRelay:
+    def test_stream_per_token(self, backend):
+        """
+        Should write every ndjson line as its own write
+        """
+        res = requests.post(backend.url + "/api/generate", json={"model": "m"}, stream=True, timeout=5)
+        out = RecordingFile()
+        n = relay_response(res, out, stream=True)
+        assert len(out.writes) == 51
+        assert all(w.endswith(b"\n") for w in out.writes)
+        assert n == len(out.data)
+        assert json.loads(out.writes[-1])["done"] is True
+
+    def test_stream_coalesced(self, backend):
+        """
+        Should merge lines into fewer writes without splitting them
+        """
+        res = requests.post(backend.url + "/api/generate", json={"model": "m"}, stream=True, timeout=5)
+        out = RecordingFile()
+        relay_response(res, out, stream=True, window=1.0)
+        assert len(out.writes) < 51
+        assert all(w.endswith(b"\n") for w in out.writes)
+        lines = out.data.splitlines()
+        assert len(lines) == 51
+        assert "".join(json.loads(line)["response"] for line in lines).startswith("tok0 tok1 ")
+
+    def test_slow_second_chunk(self):
+        """
+        Should write the held lines when the window ends, not when the next chunk arrives
+        """
+        with FakeOllama(tokens=["a", "b"], tokens_per_second=2) as slow:
+            res = requests.post(slow.url + "/api/generate", json={"model": "m"}, stream=True, timeout=5)
+            before = set(threading.enumerate())
+            out = RecordingFile()
+            relay_response(res, out, stream=True, window=0.05)
+            started = set(threading.enumerate()) - before
+        assert len(out.writes) == 3
+        assert json.loads(out.writes[0])["response"] == "a"
+        # no thread besides the one of the fake server
+        assert all("process_request" in thread.name for thread in started)
+
+    def test_large_body(self, backend):
+        """
+        Should copy a big body with few large writes
+        """
+        inputs = [f"text {i}" for i in range(5000)]
+        res = requests.post(backend.url + "/api/embed", json={"model": "m", "input": inputs}, stream=True, timeout=5)
+        out = RecordingFile()
+        n = relay_response(res, out, stream=False, buffer_size=65536)
+        assert len(json.loads(out.data)["embeddings"]) == 5000
+        assert n > 100000
+        assert len(out.writes) <= n // 1024 // 8
@@ -0,0 +1,163 @@
+import os
+import signal
+import time
+
+import pytest
+
+from ollama_proxy_server import ollama_queues
+from ollama_proxy_server.main import get_authorized_users, get_config
+from ollama_proxy_server.reload import ConfigReloader, diff_servers
+
+config_v1 = """
+[Server0]
+url = http://localhost:11434
+
+[Server1]
+url = http://localhost:11435
+model_black_list = ["llama3.2"]
+"""
+
+config_v2 = """
+[Server1]
+url = http://localhost:11435
+model_black_list = ["llama3.2", "qwen2.5"]
+
+[Server2]
+url = http://localhost:11436
+"""
+
+
+@pytest.fixture
+def files(tmp_path):
+    config = tmp_path / "config.ini"
+    users = tmp_path / "authorized_users.txt"
+    config.write_text(config_v1)
+    users.write_text("user1:key1\n")
+    return config, users
+
+
+@pytest.fixture
+def reloader(files):
+    config, users = files
+    servers = get_config(str(config))
+    mq = ollama_queues.ModelLoadedQueue(servers)
+    swapped = []
+    removed = []
+    rl = ConfigReloader(str(config), str(users), mq, servers, get_config, get_authorized_users, on_users=swapped.append, on_server_removed=removed.append)
+    rl._users = get_authorized_users(str(users))
+    return rl, mq, servers, swapped, removed
+
+
+class TestDiffServers:
+    def test_diff(self):
+        """
+        Should report added, changed and removed servers only
+        """
+        old = get_config(config_v1, "read_string")
+        old[0][1]["last_seen"] = 1
+        changed, removed = diff_servers(old, get_config(config_v2, "read_string"))
+        assert [server[0] for server in changed] == ["Server1", "Server2"]
+        assert removed == ["Server0"]
+        assert diff_servers(old, get_config(config_v1, "read_string")) == ([], [])
+
+
+class TestConfigReloader:
+    def test_reload_servers(self, files, reloader):
+        """
+        Should apply the new server list to the live queue
+        """
+        config, _ = files
+        rl, mq, servers, swapped, removed = reloader
+        config.write_text(config_v2)
+        rl.reload()
+
+        assert [server[0] for server in servers] == ["Server1", "Server2"]
+        assert removed == ["Server0", "Server1"]
+        assert swapped == []
+        assert mq.enqueue({"model": "qwen2.5"})[0] == "Server2"
+        mq.dequeue("Server2")
+
+    def test_drain_removed_server(self, files, reloader):
+        """
+        Should let the requests on a removed server finish
+        """
+        config, _ = files
+        rl, mq, _, _, _ = reloader
+        assert mq.enqueue()[0] == "Server0"
+        config.write_text(config_v2)
+        rl.reload()
+        assert mq.get_length("Server0") == 1
+        assert mq.enqueue()[0] != "Server0"
+        mq.dequeue("Server0", ok=True)
+        assert mq.get_length("Server0") == 0
+
+    def test_change_running_server(self, files, reloader):
+        """
+        Should finish a request on a server whose settings changed and keep the model it ran last
+        """
+        config, _ = files
+        rl, mq, _, _, _ = reloader
+        assert mq.enqueue({"model": "qwen2.5", "exclude": {"Server0"}})[0] == "Server1"
+        mq.dequeue("Server1", ok=True)
+        assert mq.enqueue({"model": "qwen2.5", "exclude": {"Server0"}})[0] == "Server1"
+        config.write_text(config_v2)
+        rl.reload()
+        mq.dequeue("Server1", ok=True)
+        assert mq.get_length("Server1") == 0
+        assert mq.get_servers()[0][1]["last_model"][0] == "qwen2.5"
+
+    def test_swap_users(self, files, reloader):
+        """
+        Should swap the users only when the file changed
+        """
+        _, users = files
+        rl, _, _, swapped, _ = reloader
+        rl.reload()
+        assert swapped == []
+        users.write_text("user1:key1\nuser2:key2\n")
+        rl.reload()
+        assert swapped == [{"user1": "key1", "user2": "key2"}]
+
+    def test_broken_config_keeps_servers(self, files, reloader):
+        """
+        Should keep the old state when the new config can not be read
+        """
+        config, _ = files
+        rl, _, servers, _, _ = reloader
+        config.write_text("[Server0]\n")
+        rl.reload()
+        assert [server[0] for server in servers] == ["Server0", "Server1"]
+
+    def test_check_mtime(self, files, reloader):
+        """
+        Should only reload the file that changed
+        """
+        _, users = files
+        rl, _, servers, swapped, _ = reloader
+        rl.check()
+        assert swapped == []
+        users.write_text("user2:key2\n")
+        os.utime(users, ns=(time.time_ns(), time.time_ns() + 10**9))
+        rl.check()
+        assert swapped == [{"user2": "key2"}]
+        assert [server[0] for server in servers] == ["Server0", "Server1"]
+
+    @pytest.mark.skipif(not hasattr(signal, "SIGHUP"), reason="no SIGHUP on this platform")
+    def test_sighup(self, files, reloader):
+        """
+        Should reload on SIGHUP
+        """
+        _, users = files
+        rl, _, _, swapped, _ = reloader
+        previous = signal.getsignal(signal.SIGHUP)
+        rl.start(rl._users)
+        try:
+            users.write_text("user3:key3\n")
+            os.kill(os.getpid(), signal.SIGHUP)
+            deadline = time.monotonic() + 5
+            while not swapped and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            rl.stop()
+            signal.signal(signal.SIGHUP, previous)
+        assert swapped == [{"user3": "key3"}]
@@ -0,0 +1,87 @@
+import io
+import json
+import mmap
+
+import pytest
+
+from ollama_proxy_server.request_body import BodyError, RequestBody
+from ollama_proxy_server.upstream_pool import UpstreamPool
+
+from .fake_ollama import FakeOllama
+
+
+def chunked(data, size=1000):
+    out = b"".join(b"%x\r\n%s\r\n" % (len(data[i : i + size]), data[i : i + size]) for i in range(0, len(data), size))
+    return io.BytesIO(out + b"0\r\nX-Trailer: 1\r\n\r\nnext request")
+
+
+def large_body(image_size=300 * 1024):
+    return json.dumps({"model": "llava", "images": ["A" * image_size], "stream": False}).encode("utf-8")
+
+
+class TestRequestBody:
+    def test_content_length(self):
+        """
+        Should read exactly Content-Length bytes and keep small bodies in memory
+        """
+        body = RequestBody.read_from(io.BytesIO(b'{"model": "m"}rest'), {"Content-Length": "14"})
+        assert len(body) == 14
+        assert not body.spooled
+        assert body.view() == b'{"model": "m"}'
+        assert body.peek() == {"model": "m"}
+        body.close()
+
+    def test_chunked(self):
+        """
+        Should decode a chunked upload and stop after the trailers
+        """
+        data = large_body(5000)
+        rfile = chunked(data)
+        body = RequestBody.read_from(rfile, {"Transfer-Encoding": "chunked"}, block_size=512)
+        assert b"".join(body) == data
+        assert rfile.read() == b"next request"
+        body.close()
+
+    def test_spool(self):
+        """
+        Should move large bodies to a temp file and read them back in blocks
+        """
+        data = large_body()
+        body = RequestBody.read_from(io.BytesIO(data), {"Content-Length": str(len(data))}, spool_threshold=64 * 1024, block_size=4096)
+        assert body.spooled
+        assert isinstance(body.view(), mmap.mmap)
+        assert body.peek() == {"model": "llava", "stream": False}
+        blocks = list(body)
+        assert max(len(block) for block in blocks) == 4096
+        # can be sent again
+        assert b"".join(blocks) == b"".join(body) == data
+        body.close()
+
+    @pytest.mark.parametrize(
+        "rfile,headers",
+        [
+            (io.BytesIO(b"short"), {"Content-Length": "10"}),
+            (io.BytesIO(b"zz\r\n"), {"Transfer-Encoding": "chunked"}),
+            (io.BytesIO(b"10\r\nshort"), {"Transfer-Encoding": "chunked"}),
+        ],
+    )
+    def test_broken(self, rfile, headers):
+        """
+        Should raise BodyError on truncated or broken bodies
+        """
+        with pytest.raises(BodyError):
+            RequestBody.read_from(rfile, headers)
+
+    def test_send_with_requests(self):
+        """
+        Should be sent upstream with a Content-Length in blocks
+        """
+        data = large_body()
+        body = RequestBody.read_from(io.BytesIO(data), {"Content-Length": str(len(data))}, spool_threshold=64 * 1024)
+        pool = UpstreamPool()
+        with FakeOllama() as fake:
+            res = pool.request("fake", "POST", fake.url + "/api/generate", data=body, timeout=5)
+            assert res.status_code == 200
+            assert fake.requests[-1] == ("POST", "/api/generate", data)
+        pool.close()
+        body.close()
@@ -0,0 +1,121 @@
+import io
+
+import pytest
+
+from ollama_proxy_server.response_cache import (
+    ResponseCache,
+    cache_key,
+    is_deterministic,
+)
+
+GREEDY = {"temperature": 0, "seed": 42}
+
+
+class TestCacheKey:
+    @pytest.mark.parametrize(
+        "options",
+        [None, {}, {"temperature": 0}, {"seed": 1}, {"temperature": 0.7, "seed": 1}, {"temperature": False, "seed": 1}, {"temperature": 0, "seed": "1"}],
+    )
+    def test_not_deterministic(self, options):
+        """
+        Should never cache requests without temperature 0 and a seed
+        """
+        body = {"model": "llama3.2", "prompt": "hi", "options": options}
+        assert not is_deterministic(body)
+        assert cache_key("/api/generate", body) is None
+
+    def test_canonical(self):
+        """
+        Should give the same key for the same request written differently
+        """
+        key = cache_key("/api/generate", {"model": "llama3.2", "prompt": "hi", "options": GREEDY})
+        assert key == cache_key("/api/generate", {"options": {"seed": 42, "temperature": 0}, "prompt": "hi", "model": "llama3.2:latest", "keep_alive": "5m"})
+        assert key == cache_key("/api/generate", {"model": "llama3.2", "prompt": "hi", "options": GREEDY, "stream": True})
+        assert key != cache_key("/api/generate", {"model": "llama3.2", "prompt": "hi", "options": GREEDY, "stream": False})
+        assert key != cache_key("/api/generate", {"model": "llama3.2", "prompt": "ho", "options": GREEDY})
+        assert key != cache_key("/api/chat", {"model": "llama3.2", "prompt": "hi", "options": GREEDY})
+        assert cache_key("/v1/chat/completions", {"model": "llama3.2", "options": GREEDY}) is None
+
+
+class TestResponseCache:
+    def test_lru_by_bytes(self):
+        """
+        Should evict the least recently used responses when over max_bytes
+        """
+        cache = ResponseCache(max_bytes=100, max_entry_bytes=50)
+        assert cache.put("a", "application/json", [b"x" * 40])
+        assert cache.put("b", "application/json", [b"x" * 40])
+        assert cache.get("a") is not None
+        assert cache.put("c", "application/json", [b"x" * 40])
+        assert cache.get("b") is None
+        assert cache.get("a").chunks == (b"x" * 40,)
+        assert not cache.put("d", "application/json", [b"x" * 51])
+        assert cache.stats() == {"hits": 2, "misses": 1, "size": 2, "bytes": 80}
+
+    def test_ttl(self):
+        """
+        Should forget responses after ttl seconds
+        """
+        cache = ResponseCache(ttl=10)
+        cache.put("a", None, [b"x"], now=0)
+        assert cache.get("a", now=5) is not None
+        assert cache.get("a", now=11) is None
+        assert cache.stats()["bytes"] == 0
+
+    def test_recorder(self):
+        """
+        Should keep complete responses chunk by chunk and pass the writes on
+        """
+        cache = ResponseCache()
+        out = io.BytesIO()
+        recorder = cache.recorder("a", "application/x-ndjson", out)
+        chunks = [b'{"response": "Hel", "done": false}\n', b'{"response": "lo", "done": false}\n', b'{"response": "", "done": true}\n']
+        for chunk in chunks:
+            recorder.write(memoryview(chunk))
+        assert recorder.commit()
+        assert out.getvalue() == b"".join(chunks)
+        assert cache.get("a").chunks == tuple(chunks)
+
+    @pytest.mark.parametrize(
+        "chunks",
+        [
+            [b'{"response": "Hel", "done": false}\n'],
+            [b'{"error": "model not found"}'],
+            [b'{"response": "Hel", "done": false}\n{"response": "", "do'],
+            [],
+        ],
+    )
+    def test_recorder_incomplete(self, chunks):
+        """
+        Should not keep cut or failed responses
+        """
+        cache = ResponseCache()
+        recorder = cache.recorder("a", None)
+        for chunk in chunks:
+            recorder.write(chunk)
+        assert not recorder.commit()
+        assert cache.get("a") is None
+
+    def test_recorder_client_gone(self):
+        """
+        Should not keep a response the client did not get all of
+        """
+
+        class Broken:
+            def write(self, data):
+                raise BrokenPipeError
+
+        cache = ResponseCache()
+        recorder = cache.recorder("a", None, Broken())
+        with pytest.raises(BrokenPipeError):
+            recorder.write(b'{"done": true}\n')
+        assert not recorder.commit()
+
+    def test_recorder_too_large(self):
+        """
+        Should stop copying responses larger than max_entry_bytes
+        """
+        cache = ResponseCache(max_entry_bytes=10)
+        recorder = cache.recorder("a", None)
+        recorder.write(b'{"response": "long", "done": true}\n')
+        assert not recorder.commit()
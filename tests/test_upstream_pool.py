@@ -0,0 +1,74 @@
+import time
+
+import pytest
+
+from ollama_proxy_server.upstream_pool import UpstreamPool
+
+from .fake_ollama import FakeOllama
+
+
+@pytest.fixture
+def backend():
+    with FakeOllama() as fake:
+        yield fake
+
+
+class TestUpstreamPool:
+    def test_reuse(self, backend):
+        """
+        Should open one connection and reuse it for the following requests
+        """
+        pool = UpstreamPool(pool_size=2)
+        for _ in range(5):
+            res = pool.request("fake", "POST", backend.url + "/api/embed", json={"model": "m", "input": "a"}, timeout=5)
+            assert res.ok
+        assert pool.stats()["fake"] == {"connections": 1, "requests": 5, "reused": 4}
+        pool.close()
+
+    def test_session_per_server(self, backend):
+        """
+        Should keep a session per server name
+        """
+        pool = UpstreamPool()
+        assert pool.session("a") is pool.session("a")
+        assert pool.session("a") is not pool.session("b")
+        pool.close()
+
+    def test_streamed_response_reuse(self, backend):
+        """
+        Should give the connection back after the stream is consumed
+        """
+        pool = UpstreamPool()
+        for _ in range(3):
+            res = pool.request("fake", "POST", backend.url + "/api/generate", json={"model": "m"}, stream=True, timeout=5)
+            assert len(list(res.iter_lines())) == 5
+            res.close()
+        assert pool.stats()["fake"]["reused"] == 2
+        pool.close()
+
+    def test_evict_idle(self, backend):
+        """
+        Should close idle sessions and keep their counters
+        """
+        pool = UpstreamPool(idle_timeout=10)
+        session = pool.session("fake")
+        session.get(backend.url, timeout=5)
+        assert pool.evict_idle() == []
+        assert pool.evict_idle(time.monotonic() + 11) == ["fake"]
+        assert pool.session("fake") is not session
+        pool.request("fake", "GET", backend.url, timeout=5)
+        assert pool.stats()["fake"] == {"connections": 2, "requests": 2, "reused": 0}
+
+        pool.remove("fake")
+        assert pool.stats() == {}
+
+    def test_connect_time(self, backend):
+        """
+        Should report the time spent connecting, 0 when the connection is reused
+        """
+        pool = UpstreamPool()
+        pool.request("fake", "GET", backend.url + "/api/version", timeout=5).close()
+        assert pool.connect_time() > 0
+        pool.request("fake", "GET", backend.url + "/api/version", timeout=5).close()
+        assert pool.connect_time() == 0
+        pool.close()